@@ -1,20 +1,82 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, g, Response, stream_with_context, \
+    session, make_response, has_request_context, request_started, request_finished, got_request_exception
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
+import click
+from sqlalchemy import func, and_, or_, text, select, bindparam, case, event, inspect as sa_inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload, selectinload
+from werkzeug.exceptions import NotFound, ServiceUnavailable
+from datetime import datetime, timedelta, date
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, UnicodeDammit
+from html.parser import HTMLParser
 import re
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 import time
 import random
-from dataclasses import dataclass
-from typing import List, Dict, Optional
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional, Iterable, Iterator, Tuple
+from collections import OrderedDict, deque
+from bisect import bisect_left
+import base64
+import csv
+import gzip
+import io
+import os
+import hashlib
+import multiprocessing
+import queue
+import sqlite3
+import threading
 import json
+import logging
+import numpy as np
+
+try:
+    from scipy.optimize import linprog
+except ImportError:  # scipy is optional, the NumPy simplex is used instead
+    linprog = None
+
+try:
+    from lxml import etree as lxml_etree, html as lxml_html
+except ImportError:  # lxml is optional, the streaming html.parser backend is used instead
+    lxml_etree = lxml_html = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///pricing_system.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///pricing_system.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['COST_CACHE_SIZE'] = 1024
+app.config['DASHBOARD_CACHE_TTL'] = 30  # seconds
+app.config['SCRAPER_BASE_URL'] = 'https://www.jumia.co.ke'
+app.config['SCRAPER_CACHE_DIR'] = os.path.join(app.instance_path, 'http_cache')
+app.config['SCRAPER_CACHE_TTL'] = 900  # seconds before a cached page is revalidated
+app.config['SCRAPER_CACHE_MAX_BYTES'] = 256 * 1024 * 1024
+app.config['SCRAPER_CACHE_MODE'] = os.environ.get('SCRAPER_CACHE_MODE', 'default')  # default, offline, off
+app.config['SIMULATION_MAX_SAMPLES'] = 25_000_000  # scenarios x products kept for percentiles
+app.config['COST_ANALYSIS_HOT_DAYS'] = 30
+app.config['COST_ANALYSIS_ARCHIVE_DIR'] = os.path.join(app.instance_path, 'archive')
+app.config['JOB_POLL_INTERVAL'] = 1.0
+app.config['JOB_STALE_AFTER'] = timedelta(hours=1)
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED') == '1'
+app.config['REQUEST_LOG_ENABLED'] = os.environ.get('REQUEST_LOG_ENABLED') == '1'  # one JSON log line per request
+app.config['SLOW_QUERY_THRESHOLD'] = 0.25  # seconds
+app.config['SLOW_QUERY_SAMPLES'] = 50
+app.config['DATABASE_PROFILE'] = os.environ.get('DATABASE_PROFILE', 'default')  # default, production
+app.config['WRITE_QUEUE_TIMEOUT'] = 30.0  # seconds a request waits for its queued write
+
+if app.config['DATABASE_PROFILE'] == 'production':
+    # Several workers share one SQLite file; see SQLITE_PRODUCTION_PRAGMAS
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_timeout': 30,
+        'connect_args': {'timeout': 30, 'check_same_thread': False}
+    }
 
 db = SQLAlchemy(app)
 
@@ -28,7 +90,7 @@ class RawMaterial(db.Model):
     stock_quantity = db.Column(db.Float, default=0)
     minimum_stock = db.Column(db.Float, default=0)
     supplier = db.Column(db.String(100))
-    last_updated = db.Column(db.DateTime, default=datetime.utcnow)
+    last_updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 
 class Product(db.Model):
@@ -41,6 +103,7 @@ class Product(db.Model):
     packaging_cost = db.Column(db.Float, default=0)
     profit_margin_percentage = db.Column(db.Float, default=25.0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 
 # Updated Recipe Model - Replace the existing Recipe class in your app.py
@@ -61,6 +124,13 @@ class Recipe(db.Model):
     product = db.relationship('Product', backref='recipes')
     material = db.relationship('RawMaterial', backref='recipes')
 
+    __table_args__ = (
+        # A unique index rather than a constraint so migrations can add it to existing tables
+        db.Index('uq_recipe_product_material', 'product_id', 'material_id', unique=True),
+        db.Index('ix_recipe_material_id', 'material_id'),
+        db.Index('ix_recipe_updated_at', 'updated_at'),
+    )
+
     def __repr__(self):
         return f'<Recipe {self.material.name}: {self.quantity_per_batch}>'
 
@@ -71,15 +141,45 @@ class Recipe(db.Model):
         return f"{self.quantity_per_batch:.3f}"
 
 
+class ProductComponent(db.Model):
+    """An intermediate product (e.g. a surfactant premix) used as an ingredient of another product"""
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    component_product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity_per_batch = db.Column(db.Float, nullable=False)  # units of the component per standard batch
+    notes = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    product = db.relationship('Product', foreign_keys=[product_id], backref='components')
+    component = db.relationship('Product', foreign_keys=[component_product_id], backref='used_in', lazy='joined')
+
+    __table_args__ = (
+        db.Index('uq_product_component_product_component', 'product_id', 'component_product_id', unique=True),
+        db.Index('ix_product_component_component_product_id', 'component_product_id'),
+    )
+
+    def __repr__(self):
+        return f'<ProductComponent {self.component.name}: {self.quantity_per_batch}>'
+
+
 
 class MarketPrice(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    product_name = db.Column(db.String(100), nullable=False)
-    competitor = db.Column(db.String(100))
+    product_name = db.Column(db.String(100), nullable=False, index=True)
+    competitor = db.Column(db.String(100), index=True)
     price = db.Column(db.Float, nullable=False)
     url = db.Column(db.String(500))
-    scraped_at = db.Column(db.DateTime, default=datetime.utcnow)
+    scraped_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     size_info = db.Column(db.String(100))  # e.g., "1kg", "500ml"
+    size_quantity = db.Column(db.Float)  # Pack size in size_unit
+    size_unit = db.Column(db.String(10))  # g, ml, pieces
+    normalized_price = db.Column(db.Float)  # Price per kg, litre or piece
+
+    __table_args__ = (
+        db.Index('ix_market_price_competitor_url', 'competitor', 'url'),
+        db.Index('ix_market_price_size_unit_normalized_price', 'size_unit', 'normalized_price'),
+    )
 
 
 class CostAnalysis(db.Model):
@@ -92,415 +192,4315 @@ class CostAnalysis(db.Model):
     packaging_cost = db.Column(db.Float, nullable=False)
     total_cost = db.Column(db.Float, nullable=False)
     recommended_price = db.Column(db.Float, nullable=False)
-    calculated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    calculated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     product = db.relationship('Product', backref='cost_analyses')
 
+    __table_args__ = (
+        db.Index('ix_cost_analysis_product_calculated_at', 'product_id', 'calculated_at'),
+    )
 
-# Market Scraper Class
-class MarketScraper:
-    def __init__(self):
-        self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
 
-    def scrape_jumia_prices(self, search_term: str, max_results: int = 10) -> List[Dict]:
-        """Scrape product prices from Jumia"""
-        try:
-            search_url = f"https://www.jumia.co.ke/catalog/?q={search_term.replace(' ', '+')}"
-            response = self.session.get(search_url, timeout=10)
-            response.raise_for_status()
+class CostAnalysisDaily(db.Model):
+    """Per-product daily summary of CostAnalysis rows that were archived"""
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    analysis_count = db.Column(db.Integer, nullable=False)
+    min_total_cost = db.Column(db.Float, nullable=False)
+    max_total_cost = db.Column(db.Float, nullable=False)
+    total_cost_sum = db.Column(db.Float, nullable=False)
+    recommended_price_sum = db.Column(db.Float, nullable=False)
+    last_batch_size = db.Column(db.Float, nullable=False)
+    last_total_cost = db.Column(db.Float, nullable=False)
+    last_recommended_price = db.Column(db.Float, nullable=False)
+    last_calculated_at = db.Column(db.DateTime, nullable=False)
 
-            soup = BeautifulSoup(response.content, 'html.parser')
-            products = []
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'day', name='uq_cost_analysis_daily_product_day'),
+    )
 
-            # Find product containers (adjust selectors based on actual Jumia structure)
-            product_cards = soup.find_all('article', class_='prd', limit=max_results)
 
-            for card in product_cards:
-                try:
-                    name_elem = card.find('h3', class_='name')
-                    price_elem = card.find('div', class_='prc')
-                    link_elem = card.find('a')
-
-                    if name_elem and price_elem:
-                        name = name_elem.get_text().strip()
-                        price_text = price_elem.get_text().strip()
-
-                        # Extract price number
-                        price_match = re.search(r'KSh\s*([\d,]+)', price_text)
-                        if price_match:
-                            price = float(price_match.group(1).replace(',', ''))
-                            url = urljoin('https://www.jumia.co.ke', link_elem.get('href', '')) if link_elem else ''
-
-                            products.append({
-                                'name': name,
-                                'price': price,
-                                'url': url,
-                                'competitor': 'Jumia',
-                                'size_info': self._extract_size_info(name)
-                            })
-                except Exception as e:
-                    continue
+class PriceSeries(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # material, competitor
+    key = db.Column(db.String(600), nullable=False)  # material id or competitor|url
+    name = db.Column(db.String(200))
 
-            return products
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'key', name='uq_price_series_kind_key'),
+    )
 
-        except Exception as e:
-            print(f"Error scraping Jumia: {e}")
-            return []
 
-    def _extract_size_info(self, product_name: str) -> str:
-        """Extract size information from product name"""
-        size_patterns = [
-            r'(\d+(?:\.\d+)?\s*(?:kg|KG|g|G|ml|ML|l|L))',
-            r'(\d+(?:\.\d+)?\s*(?:litre|liter|gram)s?)'
-        ]
+class PricePoint(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    series_id = db.Column(db.Integer, db.ForeignKey('price_series.id'), nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=False)
+    price = db.Column(db.Float, nullable=False)
 
-        for pattern in size_patterns:
-            match = re.search(pattern, product_name, re.IGNORECASE)
-            if match:
-                return match.group(1)
+    __table_args__ = (
+        db.Index('ix_price_point_series_recorded_at', 'series_id', 'recorded_at'),
+    )
 
-        return 'Unknown'
 
+class PriceRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    series_id = db.Column(db.Integer, db.ForeignKey('price_series.id'), nullable=False)
+    period = db.Column(db.String(10), nullable=False)  # day, week
+    period_start = db.Column(db.Date, nullable=False)
+    min_price = db.Column(db.Float, nullable=False)
+    max_price = db.Column(db.Float, nullable=False)
+    price_sum = db.Column(db.Float, nullable=False)
+    point_count = db.Column(db.Integer, nullable=False)
+    first_price = db.Column(db.Float, nullable=False)
+    first_at = db.Column(db.DateTime, nullable=False)
+    last_price = db.Column(db.Float, nullable=False)
+    last_at = db.Column(db.DateTime, nullable=False)
 
-# Helper Functions
+    __table_args__ = (
+        db.UniqueConstraint('series_id', 'period', 'period_start', name='uq_price_rollup_period'),
+    )
 
-def check_stock_availability(product_id: int, batch_size: float) -> Dict:
-    """Check if sufficient stock is available for production"""
-    product = Product.query.get_or_404(product_id)
-    scale_factor = batch_size / product.batch_size
+    def to_dict(self) -> Dict:
+        return {
+            'period_start': self.period_start.isoformat(),
+            'min': self.min_price,
+            'max': self.max_price,
+            'mean': self.price_sum / self.point_count,
+            'first': self.first_price,
+            'last': self.last_price,
+            'count': self.point_count
+        }
 
-    availability = {
-        'can_produce': True,
-        'missing_materials': [],
-        'low_stock_materials': []
-    }
 
-    for recipe in product.recipes:
-        required_quantity = recipe.quantity_per_batch * scale_factor
-        material = recipe.material
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # scrape, costing
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, completed, failed
+    payload = db.Column(db.Text)  # JSON encoded job arguments
+    result = db.Column(db.Text)  # JSON encoded job result
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
 
-        if material.stock_quantity < required_quantity:
-            availability['can_produce'] = False
-            availability['missing_materials'].append({
-                'material': material.name,
-                'required': required_quantity,
-                'available': material.stock_quantity,
-                'shortage': required_quantity - material.stock_quantity
-            })
-        elif material.stock_quantity <= material.minimum_stock:
-            availability['low_stock_materials'].append({
-                'material': material.name,
-                'current_stock': material.stock_quantity,
-                'minimum_stock': material.minimum_stock
-            })
+    __table_args__ = (
+        db.Index('ix_job_status_id', 'status', 'id'),
+    )
 
-    return availability
+    def to_dict(self, include_result: bool = True) -> Dict:
+        data = {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None,
+            'started_at': self.started_at.strftime('%Y-%m-%d %H:%M:%S') if self.started_at else None,
+            'finished_at': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else None
+        }
+        if include_result:
+            data['result'] = json.loads(self.result) if self.result else None
+        return data
 
 
-# Routes
-@app.route('/')
-def dashboard():
-    total_products = Product.query.count()
-    total_materials = RawMaterial.query.count()
-    low_stock_materials = RawMaterial.query.filter(
-        RawMaterial.stock_quantity <= RawMaterial.minimum_stock
-    ).count()
+class SchemaMigration(db.Model):
+    """Versioned schema migrations applied to this database"""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    recent_analyses = CostAnalysis.query.order_by(
-        CostAnalysis.calculated_at.desc()
-    ).limit(5).all()
 
-    recent_market_data = MarketPrice.query.order_by(
-        MarketPrice.scraped_at.desc()
-    ).limit(5).all()
+# Instrumentation
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
-    return render_template('dashboard.html',
-                           total_products=total_products,
-                           total_materials=total_materials,
-                           low_stock_materials=low_stock_materials,
-                           recent_analyses=recent_analyses,
-                           recent_market_data=recent_market_data)
 
+def _prometheus_labels(names: Tuple[str, ...], values: Tuple) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{escaped}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
 
-@app.route('/materials')
-def materials():
-    materials = RawMaterial.query.all()
-    return render_template('materials.html', materials=materials)
 
+class MetricCounter:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
 
-@app.route('/materials/add', methods=['GET', 'POST'])
-def add_material():
-    if request.method == 'POST':
-        material = RawMaterial(
-            name=request.form['name'],
-            unit=request.form['unit'],
-            current_price=float(request.form['current_price']),
-            stock_quantity=float(request.form.get('stock_quantity', 0)),
-            minimum_stock=float(request.form.get('minimum_stock', 0)),
-            supplier=request.form.get('supplier', '')
-        )
-        db.session.add(material)
-        db.session.commit()
-        flash('Material added successfully!', 'success')
-        return redirect(url_for('materials'))
+    def observe(self, labels: Tuple, value: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + value
 
-    return render_template('add_material.html')
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_prometheus_labels(self.label_names, labels)} {value:g}')
+        return lines
 
 
-@app.route('/products')
-def products():
-    products = Product.query.all()
-    return render_template('products.html', products=products)
+class MetricHistogram:
+    """Latency histogram per label set, rendered with cumulative Prometheus buckets"""
 
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = METRIC_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # labels -> per-bucket counts (+Inf last), sum, count
 
-@app.route('/products/add', methods=['GET', 'POST'])
-def add_product():
-    if request.method == 'POST':
-        product = Product(
-            name=request.form['name'],
-            category=request.form.get('category', ''),
-            batch_size=float(request.form['batch_size']),
-            labor_cost_per_batch=float(request.form.get('labor_cost_per_batch', 0)),
-            overhead_percentage=float(request.form.get('overhead_percentage', 15)),
-            packaging_cost=float(request.form.get('packaging_cost', 0)),
-            profit_margin_percentage=float(request.form.get('profit_margin_percentage', 25))
-        )
-        db.session.add(product)
-        db.session.commit()
-        flash('Product added successfully!', 'success')
-        return redirect(url_for('products'))
+    def observe(self, labels: Tuple, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
 
-    return render_template('add_product.html')
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            bounds = [f'{bound:g}' for bound in self.buckets] + ['+Inf']
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                bucket_labels = _prometheus_labels(self.label_names + ('le',), labels + (bound,))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_prometheus_labels(self.label_names, labels)} {total:g}')
+            lines.append(f'{self.name}_count{_prometheus_labels(self.label_names, labels)} {count}')
+        return lines
 
 
-@app.route('/products/<int:product_id>/recipe')
-def product_recipe(product_id):
-    product = Product.query.get_or_404(product_id)
-    materials = RawMaterial.query.all()
-    return render_template('product_recipe.html', product=product, materials=materials)
+class Metrics:
+    """Process-local request, SQL and scraper metrics.
 
+    Recording is a no-op until install_instrumentation() enables it, so
+    callers such as the scraper can report unconditionally.
+    """
 
-# Updated add_recipe_item route
-@app.route('/products/<int:product_id>/recipe/add', methods=['POST'])
-def add_recipe_item(product_id):
-    material_id = request.form['material_id']
-    quantity_type = request.form.get('quantity_type', 'absolute')
-    notes = request.form.get('notes', '')
+    def __init__(self, slow_query_samples: int = 50):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.request_duration = MetricHistogram('pricing_http_request_duration_seconds',
+                                                'HTTP request latency by route', ('method', 'endpoint', 'status'))
+        self.request_exceptions = MetricCounter('pricing_http_request_exceptions_total',
+                                                'Unhandled exceptions by route', ('endpoint',))
+        self.sql_statements = MetricCounter('pricing_db_statements_total', 'SQL statements executed', ('endpoint',))
+        self.sql_seconds = MetricCounter('pricing_db_statement_seconds_total', 'Time spent executing SQL', ('endpoint',))
+        self.sql_slow_statements = MetricCounter('pricing_db_slow_statements_total',
+                                                 'SQL statements slower than SLOW_QUERY_THRESHOLD', ('endpoint',))
+        self.scraper_fetch = MetricHistogram('pricing_scraper_fetch_seconds', 'Scraper page fetch latency',
+                                             ('host', 'outcome'))
+        self.scraper_parse = MetricHistogram('pricing_scraper_parse_seconds', 'Scraper page parse time')
+        self.scraper_errors = MetricCounter('pricing_scraper_errors_total', 'Scraper failures by stage', ('stage',))
+        self.scraper_cache = MetricCounter('pricing_scraper_cache_total', 'Scraper response cache events',
+                                           ('result',))
+        self.slow_queries = deque(maxlen=slow_query_samples)
 
-    # Handle percentage vs absolute quantities
-    if quantity_type == 'percentage':
-        quantity = float(request.form['actual_quantity'])
-        percentage_value = float(request.form['percentage_value'])
-        is_percentage_based = True
-    else:
-        quantity = float(request.form['quantity'])
-        percentage_value = None
-        is_percentage_based = False
+    def observe(self, metric, labels: Tuple = (), value: float = 1.0):
+        if not self.enabled:
+            return
+        with self._lock:
+            metric.observe(labels, value)
 
-    # Check if recipe item already exists
-    existing = Recipe.query.filter_by(
-        product_id=product_id,
-        material_id=material_id
-    ).first()
+    def record_slow_query(self, statement: str, duration: float, endpoint: str):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.slow_queries.append({
+                'statement': statement[:1000],
+                'duration_ms': round(duration * 1000, 3),
+                'endpoint': endpoint,
+                'at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            })
 
-    if existing:
-        existing.quantity_per_batch = quantity
-        existing.is_percentage_based = is_percentage_based
-        existing.percentage_value = percentage_value
-        existing.notes = notes
-        existing.updated_at = datetime.utcnow()
-        flash('Recipe item updated successfully!', 'success')
-    else:
-        recipe = Recipe(
-            product_id=product_id,
-            material_id=material_id,
-            quantity_per_batch=quantity,
-            is_percentage_based=is_percentage_based,
-            percentage_value=percentage_value,
-            notes=notes
-        )
-        db.session.add(recipe)
-        flash('Recipe item added successfully!', 'success')
+    def render(self) -> str:
+        with self._lock:
+            lines = []
+            for metric in (self.request_duration, self.request_exceptions, self.sql_statements,
+                           self.sql_seconds, self.sql_slow_statements, self.scraper_fetch,
+                           self.scraper_parse, self.scraper_errors, self.scraper_cache):
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
 
-    db.session.commit()
-    return redirect(url_for('product_recipe', product_id=product_id))
 
+metrics = Metrics(app.config['SLOW_QUERY_SAMPLES'])
+request_logger = logging.getLogger('pricing.requests')
 
-# Helper function to calculate percentage from absolute quantity
-def calculate_percentage_from_absolute(recipe, product):
-    """Calculate what percentage an absolute quantity represents"""
-    if not recipe.is_percentage_based:
-        # Estimate percentage for display purposes
-        batch_size = product.batch_size
-        material = recipe.material
 
-        if material.unit == 'kg':
-            # Assume 20g per unit as default batch weight
-            estimated_batch_weight = batch_size * 0.02
-            if estimated_batch_weight > 0:
-                return (recipe.quantity_per_batch / estimated_batch_weight) * 100
-        elif material.unit in ['ml', 'L']:
-            # For liquids, calculate based on volume
-            batch_volume = batch_size * (0.001 if material.unit == 'L' else 1)
-            if batch_volume > 0:
-                return (recipe.quantity_per_batch / batch_volume) * 100
-        else:
-            # For pieces
-            if batch_size > 0:
-                return (recipe.quantity_per_batch / batch_size) * 100
+def _request_started(sender, **extra):
+    g._metrics_started = time.perf_counter()
+    g._metrics_sql = [0, 0.0]
 
-    return recipe.percentage_value
 
+def _request_finished(sender, response, **extra):
+    started = g.pop('_metrics_started', None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    metrics.observe(metrics.request_duration, (request.method, endpoint, str(response.status_code)), duration)
 
-# Enhanced cost calculation function
-def calculate_product_cost(product_id: int, custom_batch_size: Optional[float] = None) -> Dict:
-    """Calculate comprehensive cost for a product with percentage support"""
-    product = Product.query.get_or_404(product_id)
-    batch_size = custom_batch_size or product.batch_size
-    scale_factor = batch_size / product.batch_size
+    if app.config['REQUEST_LOG_ENABLED']:
+        sql_count, sql_seconds = g.pop('_metrics_sql', (0, 0.0))
+        request_logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': endpoint,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 3),
+            'sql_count': sql_count,
+            'sql_ms': round(sql_seconds * 1000, 3)
+        }))
 
-    # Calculate material costs
-    material_cost = 0
-    material_details = []
 
-    for recipe in product.recipes:
-        # Scale quantity appropriately
-        if recipe.is_percentage_based and recipe.percentage_value:
-            # Recalculate percentage-based quantities for the new batch size
-            if recipe.material.unit == 'kg':
-                estimated_batch_weight = batch_size * 0.02  # 20g per unit
-                scaled_quantity = (recipe.percentage_value / 100) * estimated_batch_weight
-            elif recipe.material.unit in ['ml', 'L']:
-                batch_volume = batch_size * (0.001 if recipe.material.unit == 'L' else 1)
-                scaled_quantity = (recipe.percentage_value / 100) * batch_volume
-            else:
-                scaled_quantity = (recipe.percentage_value / 100) * batch_size
-        else:
-            # Standard scaling for absolute quantities
-            scaled_quantity = recipe.quantity_per_batch * scale_factor
+def _request_exception(sender, exception, **extra):
+    metrics.observe(metrics.request_exceptions, (request.endpoint or 'unmatched',))
 
-        cost = scaled_quantity * recipe.material.current_price
-        material_cost += cost
 
-        material_details.append({
-            'material': recipe.material.name,
-            'quantity': scaled_quantity,
-            'original_quantity': recipe.quantity_per_batch,
-            'is_percentage': recipe.is_percentage_based,
-            'percentage_value': recipe.percentage_value,
-            'unit': recipe.material.unit,
-            'unit_price': recipe.material.current_price,
-            'total_cost': cost,
-            'notes': recipe.notes
-        })
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
 
-    # Calculate other costs (same as before)
-    labor_cost = product.labor_cost_per_batch * scale_factor
-    overhead_cost = material_cost * (product.overhead_percentage / 100)
-    packaging_cost = product.packaging_cost * scale_factor
 
-    total_cost = material_cost + labor_cost + overhead_cost + packaging_cost
-    recommended_price = total_cost * (1 + product.profit_margin_percentage / 100)
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - context._metrics_started
+    endpoint = 'none'
+    if has_request_context():
+        endpoint = request.endpoint or 'unmatched'
+        tally = g.get('_metrics_sql')
+        if tally is not None:
+            tally[0] += 1
+            tally[1] += duration
 
-    return {
-        'product': product,
-        'batch_size': batch_size,
-        'material_cost': material_cost,
-        'labor_cost': labor_cost,
-        'overhead_cost': overhead_cost,
-        'packaging_cost': packaging_cost,
-        'total_cost': total_cost,
-        'recommended_price': recommended_price,
-        'cost_per_unit': total_cost / batch_size,
-        'price_per_unit': recommended_price / batch_size,
-        'material_details': material_details
-    }
+    metrics.observe(metrics.sql_statements, (endpoint,))
+    metrics.observe(metrics.sql_seconds, (endpoint,), duration)
+    if duration >= app.config['SLOW_QUERY_THRESHOLD']:
+        metrics.observe(metrics.sql_slow_statements, (endpoint,))
+        metrics.record_slow_query(statement, duration, endpoint)
+        app.logger.warning('Slow query (%.3fs) in %s: %s', duration, endpoint, statement[:200])
 
 
-@app.route('/cost-analysis')
-def cost_analysis():
-    products = Product.query.all()
-    return render_template('cost_analysis.html', products=products)
+def install_instrumentation():
+    """Hook request signals and engine events; nothing is hooked while disabled"""
+    metrics.enabled = app.config['METRICS_ENABLED']
+    request_started.connect(_request_started, app)
+    request_finished.connect(_request_finished, app)
+    got_request_exception.connect(_request_exception, app)
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
 
 
-@app.route('/api/calculate-cost', methods=['POST'])
-def api_calculate_cost():
-    data = request.json
-    product_id = data.get('product_id')
-    batch_size = data.get('batch_size')
+if app.config['METRICS_ENABLED'] or app.config['REQUEST_LOG_ENABLED']:
+    install_instrumentation()
 
-    try:
-        cost_data = calculate_product_cost(product_id, batch_size)
-        stock_data = check_stock_availability(product_id, batch_size)
 
-        # Save analysis
-        analysis = CostAnalysis(
-            product_id=product_id,
-            batch_size=batch_size,
-            material_cost=cost_data['material_cost'],
-            labor_cost=cost_data['labor_cost'],
-            overhead_cost=cost_data['overhead_cost'],
-            packaging_cost=cost_data['packaging_cost'],
-            total_cost=cost_data['total_cost'],
-            recommended_price=cost_data['recommended_price']
-        )
-        db.session.add(analysis)
-        db.session.commit()
+# Database profile
+SQLITE_PRODUCTION_PRAGMAS = (
+    ('journal_mode', 'WAL'),  # readers no longer block behind the writer
+    ('synchronous', 'NORMAL'),  # durable at checkpoints, safe with WAL
+    ('busy_timeout', '30000'),  # wait for the write lock instead of failing with "database is locked"
+    ('cache_size', '-65536'),  # 64 MiB page cache per connection
+    ('temp_store', 'MEMORY'),
+    ('mmap_size', str(256 * 1024 * 1024)),
+)
 
-        return jsonify({
-            'success': True,
-            'cost_data': {
-                'material_cost': cost_data['material_cost'],
-                'labor_cost': cost_data['labor_cost'],
-                'overhead_cost': cost_data['overhead_cost'],
-                'packaging_cost': cost_data['packaging_cost'],
-                'total_cost': cost_data['total_cost'],
-                'recommended_price': cost_data['recommended_price'],
-                'cost_per_unit': cost_data['cost_per_unit'],
-                'price_per_unit': cost_data['price_per_unit'],
-                'material_details': cost_data['material_details']
-            },
-            'stock_data': stock_data
-        })
 
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRODUCTION_PRAGMAS:
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
 
 
-@app.route('/market-intelligence')
-def market_intelligence():
-    market_data = MarketPrice.query.order_by(MarketPrice.scraped_at.desc()).all()
-    return render_template('market_intelligence.html', market_data=market_data)
+class WriteQueue:
+    """Single writer thread that group-commits queued write functions.
 
+    SQLite lets one connection write at a time, so many short write
+    transactions from request threads mostly wait on each other. Funnelling
+    the high-frequency inserts of a process through one thread turns them
+    into one transaction per batch. Each function runs in the writer's own
+    session and its future resolves once the batch has committed; if a batch
+    fails, its functions are retried one by one so only the failing one
+    reports the error.
+    """
 
-@app.route('/api/scrape-prices', methods=['POST'])
-def api_scrape_prices():
-    data = request.json
-    search_term = data.get('search_term', '')
+    def __init__(self, max_batch: int = 200, max_delay: float = 0.005):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
 
-    if not search_term:
-        return jsonify({'success': False, 'error': 'Search term is required'})
+    def _ensure_thread(self):
+        # A forked worker inherits the queue object but not the thread
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._run, name='write-queue', daemon=True).start()
+                    self._pid = os.getpid()
 
-    try:
-        scraper = MarketScraper()
-        results = scraper.scrape_jumia_prices(search_term)
+    def submit(self, func) -> Future:
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((func, future))
+        return future
 
-        # Save to database
-        for result in results:
-            market_price = MarketPrice(
-                product_name=result['name'],
-                competitor=result['competitor'],
-                price=result['price'],
+    def _next_batch(self) -> List[Tuple]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                # Writes whose caller gave up waiting are dropped
+                batch = [task for task in self._next_batch() if task[1].set_running_or_notify_cancel()]
+                if not batch:
+                    continue
+                try:
+                    self._commit(batch)
+                finally:
+                    db.session.close()
+
+    def _commit(self, batch: List[Tuple]):
+        try:
+            results = [func() for func, _ in batch]
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+            else:
+                for task in batch:
+                    self._commit([task])
+            return
+
+        self.batches += 1
+        self.writes += len(batch)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self) -> Dict:
+        return {'batches': self.batches, 'writes': self.writes,
+                'pending': self._queue.qsize() if self._queue is not None else 0}
+
+
+write_queue = WriteQueue() if app.config['DATABASE_PROFILE'] == 'production' else None
+
+if app.config['DATABASE_PROFILE'] == 'production':
+    event.listen(Engine, 'connect', _apply_sqlite_pragmas)
+
+
+def run_write(func):
+    """Run a write function and commit it, through the writer queue when there is one.
+
+    The function uses db.session and should return plain data, as it may run
+    on the writer thread's session. A queued write still waiting after
+    WRITE_QUEUE_TIMEOUT is cancelled and reported as 503 Service Unavailable.
+    """
+    if write_queue is None:
+        result = func()
+        db.session.commit()
+        return result
+
+    future = write_queue.submit(func)
+    try:
+        return future.result(timeout=app.config['WRITE_QUEUE_TIMEOUT'])
+    except FutureTimeoutError:
+        if future.cancel():
+            raise ServiceUnavailable('The database is busy, the write was not applied; try again')
+        raise ServiceUnavailable('The database is busy, the write is still in progress')
+
+
+# Market Scraper Class
+PRICE_RE = re.compile(r'KSh\s*([\d,]+)')
+SIZE_INFO_PATTERNS = (
+    re.compile(r'(\d+(?:\.\d+)?\s*(?:kg|KG|g|G|ml|ML|l|L))', re.IGNORECASE),
+    re.compile(r'(\d+(?:\.\d+)?\s*(?:litre|liter|gram)s?)', re.IGNORECASE)
+)
+PARSER_BACKENDS = ('auto', 'lxml', 'stream', 'soup')
+
+# Elements html.parser's tree builder never leaves open
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta',
+    'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+    'nextid', 'spacer'
+])
+
+if lxml_html is not None:
+    def _class_xpath(tag: str, css_class: str) -> str:
+        return f"{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {css_class} ')]"
+
+    CARD_XPATH = lxml_etree.XPath('//' + _class_xpath('article', 'prd'))
+    CARD_NAME_XPATH = lxml_etree.XPath('.//' + _class_xpath('h3', 'name'))
+    CARD_PRICE_XPATH = lxml_etree.XPath('.//' + _class_xpath('div', 'prc'))
+    CARD_LINK_XPATH = lxml_etree.XPath('.//a')
+
+
+class JumiaCardParser(HTMLParser):
+    """Event parser that only keeps the fields of ``article.prd`` cards.
+
+    No tree is built: open tags are tracked by name the way BeautifulSoup's
+    html.parser builder closes them, and text is only collected inside the
+    first ``h3.name`` and ``div.prc`` of each open card. Cards are
+    ``[name parts, price parts, href]`` in document order, with None for
+    missing fields; ``href`` is '' for a link without one.
+    """
+
+    def __init__(self, max_results: Optional[int] = None):
+        super().__init__(convert_charrefs=True)
+        self.max_results = max_results
+        self.cards = []
+        self._stack = []
+        self._open_cards = []  # (stack depth, card)
+        self._captures = []  # (stack depth, text parts)
+
+    @property
+    def done(self) -> bool:
+        """Every wanted card has been seen and closed"""
+        return self.max_results is not None and len(self.cards) >= self.max_results and not self._open_cards
+
+    def handle_starttag(self, tag, attrs):
+        depth = len(self._stack)
+        if tag in ('article', 'h3', 'div'):
+            classes = ''
+            for name, value in attrs:
+                if name == 'class':
+                    classes = value or ''
+            classes = classes.split()
+
+            if tag == 'article' and 'prd' in classes and (
+                self.max_results is None or len(self.cards) < self.max_results
+            ):
+                card = [None, None, None]
+                self.cards.append(card)
+                self._open_cards.append((depth, card))
+            elif self._open_cards and ((tag == 'h3' and 'name' in classes) or (tag == 'div' and 'prc' in classes)):
+                field = 0 if tag == 'h3' else 1
+                targets = [card for _, card in self._open_cards if card[field] is None]
+                if targets:
+                    parts = []
+                    for card in targets:
+                        card[field] = parts
+                    self._captures.append((depth, parts))
+        elif tag == 'a' and self._open_cards:
+            href = ''
+            for name, value in attrs:
+                if name == 'href':
+                    href = value or ''
+            for _, card in self._open_cards:
+                if card[2] is None:
+                    card[2] = href
+
+        if tag not in VOID_ELEMENTS:
+            self._stack.append(tag)
+
+    def handle_endtag(self, tag):
+        stack = self._stack
+        for index in range(len(stack) - 1, -1, -1):
+            if stack[index] == tag:
+                del stack[index:]
+                while self._captures and self._captures[-1][0] >= index:
+                    self._captures.pop()
+                while self._open_cards and self._open_cards[-1][0] >= index:
+                    self._open_cards.pop()
+                return
+
+    def handle_data(self, data):
+        for _, parts in self._captures:
+            parts.append(data)
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing calls at least 1/rate seconds apart"""
+
+    def __init__(self, rate: Optional[float]):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ResponseCacheMiss(requests.RequestException):
+    """Raised in offline replay mode for a URL that was never cached"""
+
+
+class ResponseCache:
+    """On-disk cache of scraped pages keyed by URL.
+
+    Bodies are stored gzip-compressed next to a small JSON header holding the
+    ETag and Last-Modified validators, so entries older than the TTL are
+    revalidated with a conditional GET instead of downloaded again. The total
+    size is kept under ``max_bytes`` by evicting the least recently used
+    entries. In offline mode only cached pages are served, whatever their age.
+    """
+
+    def __init__(self, directory: str, ttl: float = 900, max_bytes: int = 256 * 1024 * 1024,
+                 offline: bool = False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._index = None  # key -> [size in bytes, last used]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stored = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.directory, key[:2], key)
+        return base + '.json', base + '.gz'
+
+    def _load_index(self) -> Dict[str, list]:
+        """Sizes and last use of the entries on disk, scanned once per process"""
+        if self._index is None:
+            self._index = {}
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if not name.endswith('.json'):
+                        continue
+                    meta_path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(meta_path)
+                        size = stat.st_size + os.path.getsize(meta_path[:-5] + '.gz')
+                    except OSError:
+                        continue
+                    self._index[name[:-5]] = [size, stat.st_mtime]
+        return self._index
+
+    def _record(self, result: str):
+        with self._lock:
+            setattr(self, result, getattr(self, result) + 1)
+        metrics.observe(metrics.scraper_cache, (result,))
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def get(self, url: str) -> Optional[Dict]:
+        """The cached header for a URL with the body under ``content``, or None"""
+        meta_path, body_path = self._paths(self._key(url))
+        try:
+            with open(meta_path) as f:
+                entry = json.load(f)
+            with open(body_path, 'rb') as f:
+                entry['content'] = gzip.decompress(f.read())
+        except (OSError, EOFError, ValueError):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def is_fresh(self, entry: Dict) -> bool:
+        return time.time() - entry['stored_at'] < self.ttl
+
+    def lookup(self, url: str) -> Tuple[Optional[Dict], bool]:
+        """(entry, servable): servable entries are fresh or the cache is offline"""
+        entry = self.get(url)
+        if entry is not None and (self.offline or self.is_fresh(entry)):
+            self._record('hits')
+            self._touch(url)
+            return entry, True
+        self._record('misses')
+        if self.offline:
+            raise ResponseCacheMiss(f'{url} is not in the response cache')
+        return entry, False
+
+    def _touch(self, url: str):
+        key = self._key(url)
+        now = time.time()
+        with self._lock:
+            entry = self._load_index().get(key)
+            if entry is not None:
+                entry[1] = now
+        try:
+            os.utime(self._paths(key)[0], (now, now))
+        except OSError:
+            pass
+
+    def _write_meta(self, key: str, entry: Dict) -> int:
+        meta = json.dumps({field: value for field, value in entry.items() if field != 'content'}).encode()
+        self._write_atomic(self._paths(key)[0], meta)
+        return len(meta)
+
+    def store(self, url: str, response: requests.Response) -> Dict:
+        entry = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_type': response.headers.get('Content-Type'),
+            'stored_at': time.time(),
+            'content': response.content
+        }
+        key = self._key(url)
+        body = gzip.compress(response.content, compresslevel=6)
+        self._write_atomic(self._paths(key)[1], body)
+        size = len(body) + self._write_meta(key, entry)
+
+        with self._lock:
+            self._load_index()[key] = [size, entry['stored_at']]
+        self._record('stored')
+        self._evict()
+        return entry
+
+    def revalidate(self, url: str, entry: Dict, response: requests.Response) -> Dict:
+        """Restart the TTL of an entry the server answered 304 Not Modified for"""
+        entry = dict(entry, stored_at=time.time(),
+                     etag=response.headers.get('ETag', entry.get('etag')),
+                     last_modified=response.headers.get('Last-Modified', entry.get('last_modified')))
+        self._write_meta(self._key(url), entry)
+        self._touch(url)
+        self._record('revalidated')
+        return entry
+
+    def _evict(self):
+        with self._lock:
+            index = self._load_index()
+            total = sum(size for size, _ in index.values())
+            if total <= self.max_bytes:
+                return
+            victims = []
+            for key, (size, _) in sorted(index.items(), key=lambda item: item[1][1]):
+                if total <= self.max_bytes:
+                    break
+                victims.append(key)
+                total -= size
+            for key in victims:
+                del index[key]
+
+        for key in victims:
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._record('evicted')
+
+    def clear(self) -> int:
+        with self._lock:
+            keys = list(self._load_index())
+            self._index = {}
+        for key in keys:
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return len(keys)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            index = self._load_index()
+            return {
+                'entries': len(index),
+                'bytes': sum(size for size, _ in index.values()),
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'offline': self.offline,
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated,
+                'stored': self.stored,
+                'evicted': self.evicted
+            }
+
+
+class MarketScraper:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url: str = 'https://www.jumia.co.ke', max_workers: int = 8,
+                 per_host_limit: int = 4, requests_per_second: Optional[float] = 5.0,
+                 max_retries: int = 3, backoff_factor: float = 0.5, timeout: float = 10,
+                 parser: str = 'auto', cache: Optional[ResponseCache] = None):
+        self.headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+        }
+        self.base_url = base_url.rstrip('/')
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.cache = cache
+
+        if parser not in PARSER_BACKENDS:
+            raise ValueError(f"parser must be one of {', '.join(PARSER_BACKENDS)}")
+        if parser == 'lxml' and lxml_html is None:
+            raise ValueError('the lxml parser backend needs lxml installed')
+        if parser == 'auto':
+            parser = 'lxml' if lxml_html is not None else 'stream'
+        self.parser = parser
+
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._rate_limiter = RateLimiter(requests_per_second)
+        self._host_slots = {}
+        self._host_slots_lock = threading.Lock()
+
+    def _search_url(self, search_term: str, page: int = 1) -> str:
+        url = f"{self.base_url}/catalog/?q={search_term.replace(' ', '+')}"
+        return url if page <= 1 else f"{url}&page={page}"
+
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_slots[host]
+
+    def _cached(self, url: str) -> Tuple[Optional[requests.Response], Optional[Dict]]:
+        """A response served from the cache, or the stale entry to revalidate"""
+        if self.cache is None:
+            return None, None
+        entry, servable = self.cache.lookup(url)
+        return (self._cached_response(url, entry), None) if servable else (None, entry)
+
+    @staticmethod
+    def _cached_response(url: str, entry: Dict) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = entry['content']
+        if entry.get('content_type'):
+            response.headers['Content-Type'] = entry['content_type']
+        return response
+
+    def _download(self, url: str, stale: Optional[Dict] = None) -> requests.Response:
+        """One GET, conditional when a stale cache entry has validators"""
+        headers = {}
+        if stale is not None:
+            if stale.get('etag'):
+                headers['If-None-Match'] = stale['etag']
+            if stale.get('last_modified'):
+                headers['If-Modified-Since'] = stale['last_modified']
+
+        host = urlparse(url).netloc
+        started = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=self.timeout, headers=headers)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.observe(metrics.scraper_fetch, (host, e.__class__.__name__), time.perf_counter() - started)
+            raise
+        metrics.observe(metrics.scraper_fetch, (host, str(response.status_code)), time.perf_counter() - started)
+
+        if self.cache is not None:
+            if response.status_code == 304 and stale is not None:
+                return self._cached_response(url, self.cache.revalidate(url, stale, response))
+            if response.status_code == 200:
+                self.cache.store(url, response)
+        return response
+
+    def _fetch(self, url: str) -> bytes:
+        """GET a page honouring the host limit and rate limit, retrying with backoff"""
+        response, stale = self._cached(url)
+        if response is not None:
+            return response.content
+
+        attempt = 0
+        while True:
+            try:
+                with self._host_slot(url):
+                    self._rate_limiter.wait()
+                    response = self._download(url, stale)
+                if response.status_code not in self.RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response.content
+                error = requests.HTTPError(f"{response.status_code} for {url}", response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt >= self.max_retries:
+                raise error
+            time.sleep(self.backoff_factor * (2 ** attempt) + random.uniform(0, self.backoff_factor))
+            attempt += 1
+
+    def scrape_jumia_prices(self, search_term: str, max_results: int = 10) -> List[Dict]:
+        """Scrape product prices from Jumia"""
+        try:
+            search_url = self._search_url(search_term)
+            response, stale = self._cached(search_url)
+            if response is None:
+                response = self._download(search_url, stale)
+            response.raise_for_status()
+
+            return self._parse_jumia_page(response.content, max_results)
+
+        except Exception as e:
+            metrics.observe(metrics.scraper_errors, ('scrape',))
+            app.logger.warning("Error scraping Jumia for '%s': %s", search_term, e)
+            return []
+
+    def scrape_jumia_bulk(self, search_terms: Iterable[str], max_pages: int = 3,
+                          max_results: Optional[int] = None) -> Iterator[Dict]:
+        """Scrape many search terms and their result pages concurrently.
+
+        Pages are fetched on a bounded thread pool and results are yielded as
+        soon as each page is parsed, tagged with their search term and page.
+        The next page of a term is only requested once the current one
+        returned products.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {}
+            for term in dict.fromkeys(t.strip() for t in search_terms if t and t.strip()):
+                future = executor.submit(self._fetch, self._search_url(term, 1))
+                pending[future] = (term, 1)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    term, page = pending.pop(future)
+                    try:
+                        products = self._parse_jumia_page(future.result(), max_results)
+                    except Exception as e:
+                        metrics.observe(metrics.scraper_errors, ('bulk',))
+                        app.logger.warning("Error scraping Jumia for '%s' page %s: %s", term, page, e)
+                        continue
+
+                    if products and page < max_pages:
+                        next_future = executor.submit(self._fetch, self._search_url(term, page + 1))
+                        pending[next_future] = (term, page + 1)
+
+                    for product in products:
+                        yield dict(product, search_term=term, page=page)
+
+    def _parse_jumia_page(self, content: bytes, max_results: Optional[int] = None) -> List[Dict]:
+        """Extract product cards from a Jumia catalog page.
+
+        Every parser backend yields the same (name, price text, href) fields,
+        so the products do not depend on which one is installed.
+        """
+        started = time.perf_counter()
+        products = []
+
+        for name, price_text, href in getattr(self, f'_{self.parser}_cards')(content, max_results):
+            if name is None or price_text is None:
+                continue
+
+            # Extract price number
+            price_match = PRICE_RE.search(price_text)
+            if not price_match:
+                continue
+            try:
+                price = float(price_match.group(1).replace(',', ''))
+            except ValueError:
+                continue
+
+            name = name.strip()
+            products.append({
+                'name': name,
+                'price': price,
+                'url': urljoin(self.base_url, href) if href is not None else '',
+                'competitor': 'Jumia',
+                'size_info': self._extract_size_info(name)
+            })
+
+        metrics.observe(metrics.scraper_parse, (), time.perf_counter() - started)
+        return products
+
+    @staticmethod
+    def _soup_cards(content: bytes, max_results: Optional[int]) -> Iterator[Tuple]:
+        """Reference backend: a full BeautifulSoup tree"""
+        soup = BeautifulSoup(content, 'html.parser')
+        for card in soup.find_all('article', class_='prd', limit=max_results):
+            name_elem = card.find('h3', class_='name')
+            price_elem = card.find('div', class_='prc')
+            link_elem = card.find('a')
+            yield (name_elem.get_text() if name_elem else None,
+                   price_elem.get_text() if price_elem else None,
+                   link_elem.get('href', '') if link_elem else None)
+
+    @staticmethod
+    def _decode_page(content) -> str:
+        if isinstance(content, str):
+            return content
+        # The same encoding detection BeautifulSoup applies to bytes
+        return UnicodeDammit(content, is_html=True).unicode_markup or ''
+
+    def _stream_cards(self, content: bytes, max_results: Optional[int]) -> Iterator[Tuple]:
+        """html.parser events, feeding the page in blocks until enough cards closed"""
+        markup = self._decode_page(content)
+        parser = JumiaCardParser(max_results)
+        for start in range(0, len(markup), 16384):
+            parser.feed(markup[start:start + 16384])
+            if parser.done:
+                break
+        parser.close()
+
+        for name_parts, price_parts, href in parser.cards:
+            yield (''.join(name_parts) if name_parts is not None else None,
+                   ''.join(price_parts) if price_parts is not None else None,
+                   href)
+
+    def _lxml_cards(self, content: bytes, max_results: Optional[int]) -> Iterator[Tuple]:
+        """libxml2 parse with precompiled XPath selectors"""
+        markup = self._decode_page(content)
+        if not markup.strip():
+            return
+        cards = CARD_XPATH(lxml_html.fromstring(markup))
+        for card in cards[:max_results] if max_results is not None else cards:
+            name_elems = CARD_NAME_XPATH(card)
+            price_elems = CARD_PRICE_XPATH(card)
+            link_elems = CARD_LINK_XPATH(card)
+            yield (name_elems[0].text_content() if name_elems else None,
+                   price_elems[0].text_content() if price_elems else None,
+                   link_elems[0].get('href', '') if link_elems else None)
+
+    @staticmethod
+    def _extract_size_info(product_name: str) -> str:
+        """Extract size information from product name"""
+        for pattern in SIZE_INFO_PATTERNS:
+            match = pattern.search(product_name)
+            if match:
+                return match.group(1)
+
+        return 'Unknown'
+
+
+response_cache = ResponseCache(
+    app.config['SCRAPER_CACHE_DIR'],
+    ttl=app.config['SCRAPER_CACHE_TTL'],
+    max_bytes=app.config['SCRAPER_CACHE_MAX_BYTES'],
+    offline=app.config['SCRAPER_CACHE_MODE'] == 'offline'
+) if app.config['SCRAPER_CACHE_MODE'] != 'off' else None
+
+
+def make_scraper(**kwargs) -> MarketScraper:
+    """MarketScraper for the configured site, sharing the response cache"""
+    return MarketScraper(app.config['SCRAPER_BASE_URL'], cache=response_cache, **kwargs)
+
+
+# Size normalization
+SIZE_UNIT_FACTORS = {
+    'kg': (1000.0, 'g'), 'kgs': (1000.0, 'g'),
+    'g': (1.0, 'g'), 'gm': (1.0, 'g'), 'gms': (1.0, 'g'), 'gram': (1.0, 'g'), 'grams': (1.0, 'g'),
+    'l': (1000.0, 'ml'), 'ltr': (1000.0, 'ml'), 'ltrs': (1000.0, 'ml'),
+    'litre': (1000.0, 'ml'), 'litres': (1000.0, 'ml'), 'liter': (1000.0, 'ml'), 'liters': (1000.0, 'ml'),
+    'ml': (1.0, 'ml'),
+}
+# Price of a g/ml/piece quantity is quoted per kg/litre/piece
+NORMALIZED_PRICE_DIVISORS = {'g': 1000.0, 'ml': 1000.0, 'pieces': 1.0}
+
+_SIZE_UNITS_PATTERN = '|'.join(sorted(SIZE_UNIT_FACTORS, key=len, reverse=True))
+MULTIPACK_SIZE_RE = re.compile(
+    r'(\d+)\s*[x\u00d7]\s*(\d+(?:\.\d+)?)\s*(' + _SIZE_UNITS_PATTERN + r')\b', re.IGNORECASE
+)
+SIZE_RE = re.compile(r'(\d+(?:\.\d+)?)\s*(' + _SIZE_UNITS_PATTERN + r')\b', re.IGNORECASE)
+PIECES_RE = re.compile(r'(\d+)\s*(?:pcs|pc|pieces|bars|tablets|pods|sachets)\b', re.IGNORECASE)
+
+
+def parse_size(product_name: str) -> Tuple[Optional[float], Optional[str]]:
+    """Parse a pack size into a quantity in a canonical unit (g, ml or pieces)"""
+    match = MULTIPACK_SIZE_RE.search(product_name)
+    if match:
+        count, quantity, unit = int(match.group(1)), float(match.group(2)), match.group(3).lower()
+        factor, canonical_unit = SIZE_UNIT_FACTORS[unit]
+        return count * quantity * factor, canonical_unit
+
+    match = SIZE_RE.search(product_name)
+    if match:
+        factor, canonical_unit = SIZE_UNIT_FACTORS[match.group(2).lower()]
+        return float(match.group(1)) * factor, canonical_unit
+
+    match = PIECES_RE.search(product_name)
+    if match:
+        return float(match.group(1)), 'pieces'
+
+    return None, None
+
+
+def normalized_size_fields(product_name: str, price: float) -> Dict:
+    """size_quantity, size_unit and normalized_price columns for a listing"""
+    quantity, unit = parse_size(product_name)
+    normalized_price = None
+    if quantity:
+        normalized_price = price / (quantity / NORMALIZED_PRICE_DIVISORS[unit])
+    return {'size_quantity': quantity, 'size_unit': unit, 'normalized_price': normalized_price}
+
+
+def backfill_market_sizes(chunk_size: int = 1000) -> int:
+    """Fill the normalized size columns of rows stored before they existed"""
+    table = MarketPrice.__table__
+    update = table.update().where(table.c.id == bindparam('row_id')).values(
+        size_quantity=bindparam('size_quantity'),
+        size_unit=bindparam('size_unit'),
+        normalized_price=bindparam('normalized_price')
+    )
+
+    updated = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(MarketPrice.id, MarketPrice.product_name, MarketPrice.price).filter(
+            MarketPrice.id > last_id, MarketPrice.size_unit.is_(None)
+        ).order_by(MarketPrice.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        params = [dict(normalized_size_fields(row.product_name, row.price), row_id=row.id) for row in rows]
+        params = [p for p in params if p['size_unit'] is not None]
+        if params:
+            db.session.execute(update, params)
+            db.session.commit()
+            updated += len(params)
+    return updated
+
+
+# Market price ingestion
+class MarketPriceIngestor:
+    """Buffer scraped results and write them to MarketPrice in bulk.
+
+    Listings are identified by (competitor, url), or by product name when a
+    result has no url. A row is only written when the listing is new or its
+    price differs from the last stored one, so the table holds a compact
+    price-change history instead of one row per scrape.
+    """
+
+    def __init__(self, chunk_size: int = 500):
+        self.chunk_size = chunk_size
+        self.inserted = 0
+        self.skipped = 0
+        self._pending = OrderedDict()
+
+    @staticmethod
+    def _listing_key(competitor: Optional[str], url: Optional[str], name: str):
+        return (competitor, url) if url else (competitor, None, name)
+
+    def add(self, result: Dict):
+        key = self._listing_key(result['competitor'], result['url'], result['name'])
+        if key in self._pending:
+            # Only the latest observation within a chunk matters
+            self.skipped += 1
+            del self._pending[key]
+        self._pending[key] = result
+        if len(self._pending) >= self.chunk_size:
+            self.flush()
+
+    def _latest_prices(self, keys) -> Dict:
+        """Last stored price for each listing key, in a couple of queries"""
+        urls = {key[1] for key in keys if key[1]}
+        names = {key[2] for key in keys if not key[1]}
+        conditions = []
+        if urls:
+            conditions.append(MarketPrice.url.in_(urls))
+        if names:
+            conditions.append(and_(
+                or_(MarketPrice.url.is_(None), MarketPrice.url == ''),
+                MarketPrice.product_name.in_(names)
+            ))
+
+        latest_ids = db.session.query(func.max(MarketPrice.id)).filter(
+            or_(*conditions)
+        ).group_by(MarketPrice.competitor, MarketPrice.url, MarketPrice.product_name)
+        rows = db.session.query(
+            MarketPrice.competitor, MarketPrice.url, MarketPrice.product_name, MarketPrice.price, MarketPrice.id
+        ).filter(MarketPrice.id.in_(latest_ids)).order_by(MarketPrice.id)
+
+        prices = {}
+        for row in rows:
+            prices[self._listing_key(row.competitor, row.url, row.product_name)] = row.price
+        return prices
+
+    def _write(self, pending: OrderedDict) -> Tuple[int, int]:
+        """Insert the changed listings of a chunk; returns (inserted, unchanged)"""
+        latest = self._latest_prices(pending.keys())
+        now = datetime.utcnow()
+        rows = []
+        for key, result in pending.items():
+            if latest.get(key) == result['price']:
+                continue
+            rows.append(dict(
+                normalized_size_fields(result['name'], result['price']),
+                product_name=result['name'],
+                competitor=result['competitor'],
+                price=result['price'],
                 url=result['url'],
-                size_info=result['size_info']
+                size_info=result['size_info'],
+                scraped_at=now
+            ))
+
+        if rows:
+            db.session.execute(MarketPrice.__table__.insert(), rows)
+            record_price_points('competitor', [{
+                'key': competitor_series_key(row['competitor'], row['url'], row['product_name']),
+                'name': row['product_name'],
+                'price': row['price'],
+                'recorded_at': row['scraped_at']
+            } for row in rows])
+        return len(rows), len(pending) - len(rows)
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, OrderedDict()
+
+        inserted, unchanged = run_write(lambda: self._write(pending))
+        self.inserted += inserted
+        self.skipped += unchanged
+        if inserted:
+            dashboard_cache.invalidate()
+
+    def stats(self) -> Dict:
+        return {'inserted': self.inserted, 'skipped': self.skipped}
+
+
+def ingest_market_prices(results: Iterable[Dict], chunk_size: int = 500) -> Dict:
+    """Deduplicate and bulk insert scraped results, returning inserted/skipped counts"""
+    ingestor = MarketPriceIngestor(chunk_size)
+    for result in results:
+        ingestor.add(result)
+    ingestor.flush()
+    return ingestor.stats()
+
+
+# Market data listing
+MARKET_PAGE_SIZE = 50
+MARKET_MAX_PAGE_SIZE = 200
+
+
+def encode_market_cursor(market_price: MarketPrice) -> str:
+    raw = f"{market_price.scraped_at.isoformat()}|{market_price.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_market_cursor(cursor: str):
+    scraped_at, market_price_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(scraped_at), int(market_price_id)
+
+
+def parse_market_filters(args) -> Dict:
+    """Read listing filters from query arguments, raising ValueError on bad input"""
+    filters = {
+        'competitor': args.get('competitor') or None,
+        'date_from': None,
+        'date_to': None,
+        'min_price': float(args['min_price']) if args.get('min_price') else None,
+        'max_price': float(args['max_price']) if args.get('max_price') else None
+    }
+    if args.get('date_from'):
+        filters['date_from'] = datetime.strptime(args['date_from'], '%Y-%m-%d')
+    if args.get('date_to'):
+        # Inclusive of the whole end day
+        filters['date_to'] = datetime.strptime(args['date_to'], '%Y-%m-%d') + timedelta(days=1)
+    return filters
+
+
+def query_market_prices(filters: Dict, cursor: Optional[str] = None,
+                        limit: int = MARKET_PAGE_SIZE):
+    """One page of market prices, newest first, using keyset pagination.
+
+    Returns the rows and the cursor of the next page (None on the last page).
+    Each page is a bounded index range scan, however deep the cursor is.
+    """
+    limit = max(1, min(limit, MARKET_MAX_PAGE_SIZE))
+    query = MarketPrice.query.filter(MarketPrice.scraped_at.isnot(None))
+
+    if filters.get('competitor'):
+        query = query.filter(MarketPrice.competitor == filters['competitor'])
+    if filters.get('date_from'):
+        query = query.filter(MarketPrice.scraped_at >= filters['date_from'])
+    if filters.get('date_to'):
+        query = query.filter(MarketPrice.scraped_at < filters['date_to'])
+    if filters.get('min_price') is not None:
+        query = query.filter(MarketPrice.price >= filters['min_price'])
+    if filters.get('max_price') is not None:
+        query = query.filter(MarketPrice.price <= filters['max_price'])
+
+    if cursor:
+        cursor_at, cursor_id = decode_market_cursor(cursor)
+        query = query.filter(or_(
+            MarketPrice.scraped_at < cursor_at,
+            and_(MarketPrice.scraped_at == cursor_at, MarketPrice.id < cursor_id)
+        ))
+
+    rows = query.order_by(MarketPrice.scraped_at.desc(), MarketPrice.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_market_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+# Market product search
+MARKET_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS market_price_fts USING fts5(
+        product_name, size_info, content='market_price', content_rowid='id'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS market_price_fts_insert AFTER INSERT ON market_price BEGIN
+        INSERT INTO market_price_fts(rowid, product_name, size_info)
+        VALUES (new.id, new.product_name, new.size_info);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS market_price_fts_delete AFTER DELETE ON market_price BEGIN
+        INSERT INTO market_price_fts(market_price_fts, rowid, product_name, size_info)
+        VALUES ('delete', old.id, old.product_name, old.size_info);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS market_price_fts_update AFTER UPDATE ON market_price BEGIN
+        INSERT INTO market_price_fts(market_price_fts, rowid, product_name, size_info)
+        VALUES ('delete', old.id, old.product_name, old.size_info);
+        INSERT INTO market_price_fts(rowid, product_name, size_info)
+        VALUES (new.id, new.product_name, new.size_info);
+    END""",
+]
+
+
+def create_market_search_index():
+    """Create the FTS5 index over scraped product names and keep it in sync with triggers"""
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    with db.engine.begin() as connection:
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'market_price_fts'"
+        )).first()
+        for statement in MARKET_SEARCH_DDL:
+            connection.execute(text(statement))
+        if not exists:
+            # Index rows scraped before the search index existed
+            connection.execute(text("INSERT INTO market_price_fts(market_price_fts) VALUES ('rebuild')"))
+    app.extensions['market_search_available'] = True
+    return True
+
+
+def market_search_available() -> bool:
+    if 'market_search_available' not in app.extensions:
+        available = False
+        if db.engine.dialect.name == 'sqlite':
+            with db.engine.connect() as connection:
+                available = connection.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'market_price_fts'"
+                )).first() is not None
+        app.extensions['market_search_available'] = available
+    return app.extensions['market_search_available']
+
+
+def product_search_query(product: Product) -> Optional[str]:
+    """FTS5 query for listings resembling a product.
+
+    A listing must share at least one name token. Name tokens appear in both
+    halves of the query, so bm25 weighs them above category and size tokens.
+    """
+    def quote(tokens):
+        return ' OR '.join('"{}"'.format(token) for token in dict.fromkeys(tokens))
+
+    name_tokens = re.findall(r'\w+', product.name.lower())
+    if not name_tokens:
+        return None
+    extra_tokens = re.findall(r'\w+', (product.category or '').lower())
+    size = MarketScraper._extract_size_info(product.name)
+    if size != 'Unknown':
+        extra_tokens.append(re.sub(r'\s+', '', size.lower()))
+
+    return f"({quote(name_tokens)}) AND ({quote(name_tokens + extra_tokens)})"
+
+
+def find_competitor_price_ids(product: Product, limit: int = 10) -> List[int]:
+    """Ids of scraped listings most relevant to a product, best match first"""
+    if not market_search_available():
+        return [market_price_id for market_price_id, in db.session.query(MarketPrice.id).filter(
+            MarketPrice.product_name.contains(product.name.split()[0])
+        ).order_by(MarketPrice.scraped_at.desc()).limit(limit)]
+
+    match = product_search_query(product)
+    if match is None:
+        return []
+
+    return db.session.execute(text("""
+        SELECT rowid FROM market_price_fts
+        WHERE market_price_fts MATCH :match
+        ORDER BY bm25(market_price_fts, 10.0, 2.0), rowid DESC
+        LIMIT :limit
+    """), {'match': match, 'limit': limit}).scalars().all()
+
+
+def find_competitor_prices(product: Product, limit: int = 10, sort: str = 'relevance') -> List[MarketPrice]:
+    """Scraped listings matching a product, by relevance or by normalized unit price"""
+    ranked = find_competitor_price_ids(product, limit)
+    if not ranked:
+        return []
+
+    query = MarketPrice.query.filter(MarketPrice.id.in_(ranked))
+    if sort == 'unit_price':
+        return query.order_by(
+            MarketPrice.size_unit, MarketPrice.normalized_price.is_(None), MarketPrice.normalized_price
+        ).all()
+
+    market_prices = {mp.id: mp for mp in query}
+    return [market_prices[market_price_id] for market_price_id in ranked if market_price_id in market_prices]
+
+
+def competitor_unit_price_summary(market_price_ids: List[int]) -> List[Dict]:
+    """Min/mean/max normalized price per canonical unit, aggregated in SQL"""
+    if not market_price_ids:
+        return []
+    rows = db.session.query(
+        MarketPrice.size_unit,
+        func.count(MarketPrice.id),
+        func.min(MarketPrice.normalized_price),
+        func.avg(MarketPrice.normalized_price),
+        func.max(MarketPrice.normalized_price)
+    ).filter(
+        MarketPrice.id.in_(market_price_ids), MarketPrice.normalized_price.isnot(None)
+    ).group_by(MarketPrice.size_unit).order_by(MarketPrice.size_unit)
+
+    return [{
+        'size_unit': size_unit,
+        'per': {'g': 'kg', 'ml': 'litre', 'pieces': 'piece'}[size_unit],
+        'count': count,
+        'min_price': min_price,
+        'mean_price': mean_price,
+        'max_price': max_price
+    } for size_unit, count, min_price, mean_price, max_price in rows]
+
+
+# Price history
+ROLLUP_PERIODS = ('day', 'week')
+
+
+def period_start(period: str, moment: datetime) -> date:
+    day = moment.date()
+    return day - timedelta(days=day.weekday()) if period == 'week' else day
+
+
+def material_series_key(material_id: int) -> str:
+    return str(material_id)
+
+
+def competitor_series_key(competitor: Optional[str], url: Optional[str], name: str) -> str:
+    return f"{competitor or ''}|{url or name}"
+
+
+def resolve_price_series(kind: str, names_by_key: Dict[str, str]) -> Dict[str, int]:
+    """Series ids for keys of one kind, creating the missing series in bulk"""
+    keys = list(names_by_key)
+    series = {}
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        series.update(db.session.query(PriceSeries.key, PriceSeries.id).filter(
+            PriceSeries.kind == kind, PriceSeries.key.in_(chunk)
+        ))
+
+    missing = [{'kind': kind, 'key': key, 'name': names_by_key[key]} for key in keys if key not in series]
+    if missing:
+        db.session.execute(PriceSeries.__table__.insert(), missing)
+        missing_keys = [row['key'] for row in missing]
+        for start in range(0, len(missing_keys), 500):
+            series.update(db.session.query(PriceSeries.key, PriceSeries.id).filter(
+                PriceSeries.kind == kind, PriceSeries.key.in_(missing_keys[start:start + 500])
+            ))
+    return series
+
+
+def record_price_points(kind: str, points: List[Dict]):
+    """Append price points and fold them into the daily and weekly rollups.
+
+    Each point is a dict with ``key``, ``name``, ``price`` and ``recorded_at``.
+    Points are inserted with one executemany; rollups are pre-aggregated per
+    period in memory and merged with a single upsert statement each, so the
+    cost of an insert does not depend on how much history exists.
+    The caller commits.
+    """
+    if not points:
+        return
+    series = resolve_price_series(kind, {point['key']: point['name'] for point in points})
+
+    db.session.execute(PricePoint.__table__.insert(), [{
+        'series_id': series[point['key']],
+        'recorded_at': point['recorded_at'],
+        'price': point['price']
+    } for point in points])
+
+    buckets = {}
+    for point in sorted(points, key=lambda p: p['recorded_at']):
+        for period in ROLLUP_PERIODS:
+            bucket_key = (series[point['key']], period, period_start(period, point['recorded_at']))
+            bucket = buckets.get(bucket_key)
+            if bucket is None:
+                buckets[bucket_key] = {
+                    'series_id': bucket_key[0], 'period': period, 'period_start': bucket_key[2],
+                    'min_price': point['price'], 'max_price': point['price'],
+                    'price_sum': point['price'], 'point_count': 1,
+                    'first_price': point['price'], 'first_at': point['recorded_at'],
+                    'last_price': point['price'], 'last_at': point['recorded_at']
+                }
+            else:
+                bucket['min_price'] = min(bucket['min_price'], point['price'])
+                bucket['max_price'] = max(bucket['max_price'], point['price'])
+                bucket['price_sum'] += point['price']
+                bucket['point_count'] += 1
+                bucket['last_price'] = point['price']
+                bucket['last_at'] = point['recorded_at']
+
+    table = PriceRollup.__table__
+    insert = sqlite_insert(table)
+    upsert = insert.on_conflict_do_update(
+        index_elements=['series_id', 'period', 'period_start'],
+        set_={
+            'min_price': func.min(table.c.min_price, insert.excluded.min_price),
+            'max_price': func.max(table.c.max_price, insert.excluded.max_price),
+            'price_sum': table.c.price_sum + insert.excluded.price_sum,
+            'point_count': table.c.point_count + insert.excluded.point_count,
+            'first_price': case((insert.excluded.first_at < table.c.first_at, insert.excluded.first_price),
+                                else_=table.c.first_price),
+            'first_at': func.min(table.c.first_at, insert.excluded.first_at),
+            'last_price': case((insert.excluded.last_at >= table.c.last_at, insert.excluded.last_price),
+                               else_=table.c.last_price),
+            'last_at': func.max(table.c.last_at, insert.excluded.last_at)
+        }
+    )
+    db.session.execute(upsert, list(buckets.values()))
+
+
+def record_material_prices(materials: Iterable[RawMaterial], recorded_at: Optional[datetime] = None):
+    """Record the current price of materials as history points"""
+    record_price_points('material', [{
+        'key': material_series_key(material.id),
+        'name': material.name,
+        'price': material.current_price,
+        'recorded_at': recorded_at or material.last_updated or datetime.utcnow()
+    } for material in materials])
+
+
+def seed_material_price_history() -> int:
+    """Start a history for materials that have none, from their current price"""
+    tracked = {key for key, in db.session.query(PriceSeries.key).filter(PriceSeries.kind == 'material')}
+    materials = [material for material in RawMaterial.query
+                 if material_series_key(material.id) not in tracked]
+    record_material_prices(materials)
+    db.session.commit()
+    return len(materials)
+
+
+def get_price_trend(series_id: int, period: str = 'day', start: Optional[date] = None,
+                    end: Optional[date] = None) -> List[Dict]:
+    """Min/max/mean/first/last per period, read from the rollups only"""
+    if period not in ROLLUP_PERIODS:
+        raise ValueError(f"Unknown period: {period}")
+    query = PriceRollup.query.filter(PriceRollup.series_id == series_id, PriceRollup.period == period)
+    if start:
+        query = query.filter(PriceRollup.period_start >= period_start(period, datetime.combine(start, datetime.min.time())))
+    if end:
+        query = query.filter(PriceRollup.period_start <= end)
+    return [rollup.to_dict() for rollup in query.order_by(PriceRollup.period_start)]
+
+
+def prices_as_of(series_ids: List[int], as_of: datetime) -> Dict[int, float]:
+    """Price of each series at a moment, from the daily rollups.
+
+    The last daily rollup on or before the day gives the closing price; raw
+    points are only probed (by index) when that day has points after as_of.
+    Series with no history before as_of are left out.
+    """
+    if not series_ids:
+        return {}
+    latest_days = db.session.query(
+        PriceRollup.series_id, func.max(PriceRollup.period_start).label('period_start')
+    ).filter(
+        PriceRollup.series_id.in_(series_ids),
+        PriceRollup.period == 'day',
+        PriceRollup.period_start <= as_of.date()
+    ).group_by(PriceRollup.series_id).subquery()
+    rollups = PriceRollup.query.join(latest_days, and_(
+        PriceRollup.series_id == latest_days.c.series_id,
+        PriceRollup.period_start == latest_days.c.period_start
+    )).filter(PriceRollup.period == 'day')
+
+    prices = {}
+    for rollup in rollups:
+        if rollup.last_at <= as_of:
+            prices[rollup.series_id] = rollup.last_price
+            continue
+        point = db.session.query(PricePoint.price).filter(
+            PricePoint.series_id == rollup.series_id, PricePoint.recorded_at <= as_of
+        ).order_by(PricePoint.recorded_at.desc()).first()
+        if point is not None:
+            prices[rollup.series_id] = point.price
+        else:
+            # All of the day's points are later; fall back to the previous day
+            previous = PriceRollup.query.filter(
+                PriceRollup.series_id == rollup.series_id,
+                PriceRollup.period == 'day',
+                PriceRollup.period_start < rollup.period_start
+            ).order_by(PriceRollup.period_start.desc()).first()
+            if previous is not None:
+                prices[rollup.series_id] = previous.last_price
+    return prices
+
+
+def parse_as_of(value: str) -> datetime:
+    """ISO date or datetime; a bare date means the end of that day"""
+    moment = datetime.fromisoformat(value)
+    if len(value) == 10:
+        moment = datetime.combine(moment.date(), datetime.max.time())
+    return moment
+
+
+def material_prices_as_of(material_ids: Iterable[int], as_of: datetime) -> Dict[int, float]:
+    """Historical price per material id (materials without history are left out)"""
+    keys = {material_series_key(material_id): material_id for material_id in material_ids}
+    series = dict(db.session.query(PriceSeries.id, PriceSeries.key).filter(
+        PriceSeries.kind == 'material', PriceSeries.key.in_(list(keys))
+    ))
+    return {keys[series[series_id]]: price for series_id, price in prices_as_of(list(series), as_of).items()}
+
+
+def material_volatility_from_history(days: int = 90) -> Dict[int, float]:
+    """Standard deviation of daily log returns of each material's closing price"""
+    since = datetime.utcnow().date() - timedelta(days=days)
+    rows = db.session.query(PriceSeries.key, PriceRollup.last_price).join(
+        PriceRollup, PriceRollup.series_id == PriceSeries.id
+    ).filter(
+        PriceSeries.kind == 'material',
+        PriceRollup.period == 'day',
+        PriceRollup.period_start >= since
+    ).order_by(PriceSeries.key, PriceRollup.period_start)
+
+    closes = {}
+    for key, price in rows:
+        if price and price > 0:
+            closes.setdefault(int(key), []).append(price)
+    return {
+        material_id: float(np.std(np.diff(np.log(prices)), ddof=1))
+        for material_id, prices in closes.items() if len(prices) > 2
+    }
+
+
+# Helper Functions
+
+def get_product_with_recipes(product_id: int) -> Product:
+    """Fetch a product with its recipes and their materials eagerly loaded.
+
+    The result is memoized on ``g`` so cost and stock calculations within the
+    same request share one set of queries.
+    """
+    loaded = g.setdefault('products_with_recipes', {})
+    key = int(product_id) if product_id is not None else None
+    if key not in loaded:
+        loaded[key] = Product.query.options(
+            selectinload(Product.recipes).joinedload(Recipe.material)
+        ).filter(Product.id == key).first_or_404()
+    return loaded[key]
+
+
+def check_stock_availability(product_id: int, batch_size: Optional[float] = None) -> Dict:
+    """Check if sufficient stock is available for production.
+
+    Intermediate products are made as part of the batch, so their raw
+    materials are drawn from stock as well; only the product's own part of
+    the bill of materials is exploded for that.
+    """
+    product = get_product_with_recipes(product_id)
+    scale_factor = (batch_size or product.batch_size) / product.batch_size
+
+    # Quantity required per material id, next to the material's stock levels
+    requirements = {}
+    for recipe in product.recipes:
+        material = recipe.material
+        requirements.setdefault(material.id, {
+            'material': material.name,
+            'stock_quantity': material.stock_quantity,
+            'minimum_stock': material.minimum_stock,
+            'required': 0.0
+        })['required'] += recipe.quantity_per_batch * scale_factor
+
+    if product.components:
+        matrix = CostMatrix.build([component.component_product_id for component in product.components])
+        product_index = {int(component_id): i for i, component_id in enumerate(matrix.product_ids)}
+        component_units = np.zeros(len(matrix.product_ids))
+        for component in product.components:
+            component_units[product_index[component.component_product_id]] += \
+                component.quantity_per_batch * scale_factor
+        component_required = matrix.exploded_quantities().rdot(component_units)
+        for j in np.flatnonzero(component_required):
+            requirements.setdefault(int(matrix.material_ids[j]), {
+                'material': matrix.material_names[j],
+                'stock_quantity': float(matrix.stock_quantities[j]),
+                'minimum_stock': float(matrix.minimum_stocks[j]),
+                'required': 0.0
+            })['required'] += float(component_required[j])
+
+    availability = {
+        'can_produce': True,
+        'missing_materials': [],
+        'low_stock_materials': []
+    }
+
+    for requirement in requirements.values():
+        required_quantity = requirement['required']
+        stock_quantity = requirement['stock_quantity']
+
+        if stock_quantity < required_quantity:
+            availability['can_produce'] = False
+            availability['missing_materials'].append({
+                'material': requirement['material'],
+                'required': required_quantity,
+                'available': stock_quantity,
+                'shortage': required_quantity - stock_quantity
+            })
+        elif stock_quantity <= requirement['minimum_stock']:
+            availability['low_stock_materials'].append({
+                'material': requirement['material'],
+                'current_stock': stock_quantity,
+                'minimum_stock': requirement['minimum_stock']
+            })
+
+    return availability
+
+
+# Dashboard summary
+def load_dashboard_summary() -> Dict:
+    """Counters and recent lists shown on the dashboard, as plain data"""
+    counts = db.session.query(
+        db.session.query(func.count(Product.id)).scalar_subquery(),
+        db.session.query(func.count(RawMaterial.id)).scalar_subquery(),
+        db.session.query(func.count(RawMaterial.id)).filter(
+            RawMaterial.stock_quantity <= RawMaterial.minimum_stock
+        ).scalar_subquery()
+    ).one()
+
+    recent_analyses = db.session.query(
+        Product.name, CostAnalysis.total_cost, CostAnalysis.recommended_price, CostAnalysis.calculated_at
+    ).join(Product, Product.id == CostAnalysis.product_id).order_by(
+        CostAnalysis.calculated_at.desc()
+    ).limit(5).all()
+
+    recent_market_data = db.session.query(
+        MarketPrice.product_name, MarketPrice.price, MarketPrice.competitor, MarketPrice.scraped_at
+    ).order_by(MarketPrice.scraped_at.desc()).limit(5).all()
+
+    return {
+        'total_products': counts[0],
+        'total_materials': counts[1],
+        'low_stock_materials': counts[2],
+        'recent_analyses': [{
+            'product': {'name': row.name},
+            'total_cost': row.total_cost,
+            'recommended_price': row.recommended_price,
+            'calculated_at': row.calculated_at
+        } for row in recent_analyses],
+        'recent_market_data': [{
+            'product_name': row.product_name,
+            'price': row.price,
+            'competitor': row.competitor,
+            'scraped_at': row.scraped_at
+        } for row in recent_market_data]
+    }
+
+
+class DashboardCache:
+    """Dashboard summary kept for a short TTL and dropped by write paths.
+
+    The TTL bounds staleness across worker processes; within a process writes
+    call invalidate() so the next view sees them immediately.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._summary = None
+        self._etag = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._summary is not None and time.monotonic() < self._expires:
+                return self._summary, self._etag
+
+        summary = load_dashboard_summary()
+        etag = hashlib.sha1(json.dumps(summary, default=str, sort_keys=True).encode()).hexdigest()
+        with self._lock:
+            self._summary, self._etag = summary, etag
+            self._expires = time.monotonic() + self.ttl
+        return summary, etag
+
+    def invalidate(self):
+        with self._lock:
+            self._summary = None
+
+
+dashboard_cache = DashboardCache(app.config['DASHBOARD_CACHE_TTL'])
+
+
+# Routes
+@app.route('/')
+def dashboard():
+    summary, etag = dashboard_cache.get()
+
+    # Pending flash messages make the page differ from what the client has
+    if '_flashes' not in session and request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render_template('dashboard.html', **summary))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/api/dashboard')
+def api_dashboard():
+    summary, etag = dashboard_cache.get()
+
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(json.dumps(dict(summary, success=True), default=str))
+        response.mimetype = 'application/json'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/materials')
+def materials():
+    materials = RawMaterial.query.all()
+    return render_template('materials.html', materials=materials)
+
+
+@app.route('/materials/add', methods=['GET', 'POST'])
+def add_material():
+    if request.method == 'POST':
+        material = RawMaterial(
+            name=request.form['name'],
+            unit=request.form['unit'],
+            current_price=float(request.form['current_price']),
+            stock_quantity=float(request.form.get('stock_quantity', 0)),
+            minimum_stock=float(request.form.get('minimum_stock', 0)),
+            supplier=request.form.get('supplier', '')
+        )
+        db.session.add(material)
+        db.session.flush()
+        record_material_prices([material])
+        db.session.commit()
+        dashboard_cache.invalidate()
+        flash('Material added successfully!', 'success')
+        return redirect(url_for('materials'))
+
+    return render_template('add_material.html')
+
+
+@app.route('/products')
+def products():
+    products = Product.query.all()
+    return render_template('products.html', products=products)
+
+
+@app.route('/products/add', methods=['GET', 'POST'])
+def add_product():
+    if request.method == 'POST':
+        product = Product(
+            name=request.form['name'],
+            category=request.form.get('category', ''),
+            batch_size=float(request.form['batch_size']),
+            labor_cost_per_batch=float(request.form.get('labor_cost_per_batch', 0)),
+            overhead_percentage=float(request.form.get('overhead_percentage', 15)),
+            packaging_cost=float(request.form.get('packaging_cost', 0)),
+            profit_margin_percentage=float(request.form.get('profit_margin_percentage', 25))
+        )
+        db.session.add(product)
+        db.session.commit()
+        cost_cache.invalidate_product(product.id)
+        dashboard_cache.invalidate()
+        flash('Product added successfully!', 'success')
+        return redirect(url_for('products'))
+
+    return render_template('add_product.html')
+
+
+@app.route('/products/<int:product_id>/recipe')
+def product_recipe(product_id):
+    product = get_product_with_recipes(product_id)
+    materials = RawMaterial.query.all()
+
+    component_lines = []
+    if product.components:
+        unit_costs = component_unit_costs([component.component_product_id for component in product.components])
+        component_lines = [{
+            'component': component,
+            'unit_cost': unit_costs[component.component_product_id],
+            'total_cost': component.quantity_per_batch * unit_costs[component.component_product_id]
+        } for component in product.components]
+    # Products that already use this one, directly or indirectly, would close a cycle
+    excluded = material_usage_index.ancestors(product.id) | {product.id}
+    candidates = db.session.query(Product.id, Product.name).filter(
+        Product.id.notin_(excluded)
+    ).order_by(Product.name).all()
+
+    return render_template('product_recipe.html', product=product, materials=materials,
+                           component_lines=component_lines, candidates=candidates,
+                           component_cost=sum(line['total_cost'] for line in component_lines))
+
+
+RECIPE_UPSERT_FIELDS = ('quantity_per_batch', 'is_percentage_based', 'percentage_value', 'notes')
+# RETURNING needs SQLite 3.35; older libraries read the upserted row back instead
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+def recipe_upsert_statement(keys: Iterable[str]):
+    """INSERT ... ON CONFLICT DO UPDATE for recipe rows with the given keys"""
+    table = Recipe.__table__
+    insert = sqlite_insert(table)
+    updates = {key: insert.excluded[key] for key in keys if key in RECIPE_UPSERT_FIELDS}
+    # onupdate defaults do not fire for the conflict branch
+    updates['updated_at'] = insert.excluded.updated_at
+    return insert.on_conflict_do_update(index_elements=['product_id', 'material_id'], set_=updates)
+
+
+def upsert_recipe_item(product_id: int, material_id: int, quantity: float, is_percentage_based: bool = False,
+                       percentage_value: Optional[float] = None, notes: str = '') -> bool:
+    """Insert or update one recipe line with one upsert, True when it was inserted"""
+    now = datetime.utcnow()
+    row = {
+        'product_id': product_id,
+        'material_id': material_id,
+        'quantity_per_batch': quantity,
+        'is_percentage_based': is_percentage_based,
+        'percentage_value': percentage_value,
+        'notes': notes,
+        'created_at': now,
+        'updated_at': now
+    }
+    if SQLITE_HAS_RETURNING:
+        created_at = db.session.execute(
+            recipe_upsert_statement(row).returning(Recipe.__table__.c.created_at), row
+        ).scalar()
+    else:
+        db.session.execute(recipe_upsert_statement(row), row)
+        created_at = db.session.query(Recipe.created_at).filter(
+            Recipe.product_id == product_id, Recipe.material_id == material_id
+        ).scalar()
+    # An updated line keeps its original created_at
+    return created_at == now
+
+
+def replace_product_recipe(product_id: int, items: List[Dict]) -> Dict:
+    """Replace a product's whole formulation: one executemany upsert plus one delete.
+
+    ``items`` are dicts with material_id, quantity_per_batch and optionally
+    is_percentage_based, percentage_value and notes. Lines for materials not
+    listed are removed; the caller commits.
+    """
+    now = datetime.utcnow()
+    rows = {}
+    for item in items:
+        rows[int(item['material_id'])] = {  # the last line for a material wins
+            'product_id': product_id,
+            'material_id': int(item['material_id']),
+            'quantity_per_batch': float(item['quantity_per_batch']),
+            'is_percentage_based': bool(item.get('is_percentage_based', False)),
+            'percentage_value': item.get('percentage_value'),
+            'notes': item.get('notes', ''),
+            'created_at': now,
+            'updated_at': now
+        }
+
+    table = Recipe.__table__
+    removed = db.session.execute(table.delete().where(
+        table.c.product_id == product_id, table.c.material_id.notin_(list(rows))
+    )).rowcount
+    if rows:
+        db.session.execute(recipe_upsert_statement(RECIPE_UPSERT_FIELDS), list(rows.values()))
+    return {'lines': len(rows), 'removed': removed}
+
+
+def component_upsert_statement():
+    """INSERT ... ON CONFLICT DO UPDATE for product component rows"""
+    insert = sqlite_insert(ProductComponent.__table__)
+    return insert.on_conflict_do_update(index_elements=['product_id', 'component_product_id'], set_={
+        'quantity_per_batch': insert.excluded.quantity_per_batch,
+        'notes': insert.excluded.notes,
+        'updated_at': insert.excluded.updated_at
+    })
+
+
+def replace_product_components(product_id: int, items: List[Dict], replace: bool = True) -> Dict:
+    """Upsert a product's intermediate products after checking the BOM stays acyclic.
+
+    ``items`` are dicts with component_product_id, quantity_per_batch and
+    optionally notes. With ``replace`` components not listed are removed;
+    the caller commits.
+    """
+    now = datetime.utcnow()
+    rows = {}
+    for item in items:
+        rows[int(item['component_product_id'])] = {  # the last line for a component wins
+            'product_id': product_id,
+            'component_product_id': int(item['component_product_id']),
+            'quantity_per_batch': float(item['quantity_per_batch']),
+            'notes': item.get('notes', ''),
+            'created_at': now,
+            'updated_at': now
+        }
+
+    unknown = set(rows) - {row_id for row_id, in Product.query.with_entities(Product.id).filter(
+        Product.id.in_(list(rows)))}
+    if unknown:
+        raise ValueError(f'Unknown component product ids: {sorted(unknown)}')
+
+    table = ProductComponent.__table__
+    kept = set(rows)
+    if not replace:
+        kept.update(component_id for component_id, in db.session.query(
+            ProductComponent.component_product_id).filter(ProductComponent.product_id == product_id))
+    check_product_components(product_id, kept)
+
+    removed = 0
+    if replace:
+        removed = db.session.execute(table.delete().where(
+            table.c.product_id == product_id, table.c.component_product_id.notin_(list(rows))
+        )).rowcount
+    if rows:
+        db.session.execute(component_upsert_statement(), list(rows.values()))
+    return {'components': len(rows), 'removed': removed}
+
+
+# Updated add_recipe_item route
+@app.route('/products/<int:product_id>/recipe/add', methods=['POST'])
+def add_recipe_item(product_id):
+    material_id = request.form['material_id']
+    quantity_type = request.form.get('quantity_type', 'absolute')
+    notes = request.form.get('notes', '')
+
+    # Handle percentage vs absolute quantities
+    if quantity_type == 'percentage':
+        quantity = float(request.form['actual_quantity'])
+        percentage_value = float(request.form['percentage_value'])
+        is_percentage_based = True
+    else:
+        quantity = float(request.form['quantity'])
+        percentage_value = None
+        is_percentage_based = False
+
+    # One atomic upsert on the (product_id, material_id) unique index
+    inserted = upsert_recipe_item(product_id, int(material_id), quantity, is_percentage_based,
+                                  percentage_value, notes)
+    db.session.commit()
+    flash('Recipe item added successfully!' if inserted else 'Recipe item updated successfully!', 'success')
+
+    invalidate_product_costs(product_id)
+    material_usage_index.invalidate()
+    return redirect(url_for('product_recipe', product_id=product_id))
+
+
+@app.route('/products/<int:product_id>/components/add', methods=['POST'])
+def add_product_component(product_id):
+    Product.query.get_or_404(product_id)
+    try:
+        replace_product_components(product_id, [{
+            'component_product_id': request.form['component_product_id'],
+            'quantity_per_batch': request.form['quantity'],
+            'notes': request.form.get('notes', '')
+        }], replace=False)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('product_recipe', product_id=product_id))
+
+    db.session.commit()
+    flash('Intermediate product saved successfully!', 'success')
+
+    invalidate_product_costs(product_id)
+    material_usage_index.invalidate()
+    return redirect(url_for('product_recipe', product_id=product_id))
+
+
+@app.route('/products/<int:product_id>/components/<int:component_id>/delete', methods=['POST'])
+def delete_product_component(product_id, component_id):
+    product = Product.query.get_or_404(product_id)
+    component = ProductComponent.query.filter_by(id=component_id, product_id=product_id).first_or_404()
+
+    db.session.delete(component)
+    # No component row is left to date the change, so stored costs see it on the product
+    product.updated_at = datetime.utcnow()
+    db.session.commit()
+    flash('Intermediate product removed successfully!', 'success')
+
+    invalidate_product_costs(product_id)
+    material_usage_index.invalidate()
+    return redirect(url_for('product_recipe', product_id=product_id))
+
+
+# Helper function to calculate percentage from absolute quantity
+def calculate_percentage_from_absolute(recipe, product):
+    """Calculate what percentage an absolute quantity represents"""
+    if not recipe.is_percentage_based:
+        # Estimate percentage for display purposes
+        batch_size = product.batch_size
+        material = recipe.material
+
+        if material.unit == 'kg':
+            # Assume 20g per unit as default batch weight
+            estimated_batch_weight = batch_size * 0.02
+            if estimated_batch_weight > 0:
+                return (recipe.quantity_per_batch / estimated_batch_weight) * 100
+        elif material.unit in ['ml', 'L']:
+            # For liquids, calculate based on volume
+            batch_volume = batch_size * (0.001 if material.unit == 'L' else 1)
+            if batch_volume > 0:
+                return (recipe.quantity_per_batch / batch_volume) * 100
+        else:
+            # For pieces
+            if batch_size > 0:
+                return (recipe.quantity_per_batch / batch_size) * 100
+
+    return recipe.percentage_value
+
+
+# Multi-level bill of materials
+class BomCycleError(ValueError):
+    """Product components that (directly or indirectly) contain themselves"""
+
+    def __init__(self, cycle: List[int]):
+        self.cycle = cycle
+        super().__init__(f"Product components form a cycle: {' -> '.join(map(str, cycle))}")
+
+
+def load_product_components() -> List:
+    """Every component edge as (product_id, component_product_id, quantity_per_batch, notes)"""
+    return db.session.query(
+        ProductComponent.product_id, ProductComponent.component_product_id,
+        ProductComponent.quantity_per_batch, ProductComponent.notes
+    ).order_by(ProductComponent.product_id, ProductComponent.id).all()
+
+
+def bom_topological_order(nodes: Iterable[int], edges: Iterable[Tuple[int, int]]) -> List[int]:
+    """Order products so every component comes before the products using it.
+
+    ``edges`` are (product, component) pairs among ``nodes``. Kahn's algorithm
+    is linear in nodes plus edges; if products are left over they sit on or
+    above a cycle, which is traced and raised as a BomCycleError.
+    """
+    edges = list(edges)
+    pending = {node: 0 for node in nodes}  # components not ordered yet
+    parents = {}
+    for product_id, component_id in edges:
+        pending[product_id] += 1
+        parents.setdefault(component_id, []).append(product_id)
+
+    order = [node for node, count in pending.items() if count == 0]
+    for node in order:  # grows while iterating
+        for parent in parents.get(node, ()):
+            pending[parent] -= 1
+            if pending[parent] == 0:
+                order.append(parent)
+
+    if len(order) < len(pending):
+        # Every left over product has a left over component, so following them must loop
+        components = {}
+        for product_id, component_id in edges:
+            if pending[product_id] and pending[component_id]:
+                components.setdefault(product_id, component_id)
+        node = min(node for node, count in pending.items() if count)
+        path, seen = [], {}
+        while node not in seen:
+            seen[node] = len(path)
+            path.append(node)
+            node = components[node]
+        raise BomCycleError(path[seen[node]:] + [node])
+    return order
+
+
+def bom_descendants(product_ids: Iterable[int], edges: Iterable[Tuple[int, int]]) -> set:
+    """Products reachable from ``product_ids`` through their components"""
+    components = {}
+    for product_id, component_id in edges:
+        components.setdefault(product_id, []).append(component_id)
+
+    found = set()
+    stack = list(product_ids)
+    while stack:
+        for component_id in components.get(stack.pop(), ()):
+            if component_id not in found:
+                found.add(component_id)
+                stack.append(component_id)
+    return found
+
+
+def check_product_components(product_id: int, component_ids: Iterable[int]):
+    """Raise BomCycleError if giving a product these components would create a cycle"""
+    edges = [(row.product_id, row.component_product_id) for row in load_product_components()
+             if row.product_id != product_id]
+    edges.extend((product_id, int(component_id)) for component_id in component_ids)
+    bom_topological_order({node for edge in edges for node in edge}, edges)
+
+
+def component_unit_costs(product_ids: List[int], as_of: Optional[datetime] = None) -> Dict[int, float]:
+    """Total cost per unit of products used as components, rolled up through their sub-graphs"""
+    matrix = CostMatrix.build(product_ids)
+    prices = None
+    if as_of:
+        used = matrix.material_ids[matrix.quantities.nonzero_columns()]
+        historical = material_prices_as_of([int(material_id) for material_id in used], as_of)
+        prices = np.array([historical.get(int(material_id), price)
+                           for material_id, price in zip(matrix.material_ids, matrix.prices)], dtype=float)
+
+    unit_totals = matrix.rollup(prices)[1]
+    index = {int(product_id): i for i, product_id in enumerate(matrix.product_ids)}
+    return {int(product_id): float(unit_totals[index[int(product_id)]]) for product_id in product_ids}
+
+
+# Enhanced cost calculation function
+def calculate_product_cost(product_id: int, custom_batch_size: Optional[float] = None,
+                           as_of: Optional[datetime] = None) -> Dict:
+    """Calculate comprehensive cost for a product with percentage support.
+
+    With ``as_of`` materials are priced from the price history at that moment
+    (falling back to the current price for materials without earlier history).
+    Component products count as materials priced at their rolled up cost per unit.
+    """
+    product = get_product_with_recipes(product_id)
+    batch_size = custom_batch_size or product.batch_size
+    scale_factor = batch_size / product.batch_size
+    historical_prices = material_prices_as_of(
+        [recipe.material_id for recipe in product.recipes], as_of
+    ) if as_of else {}
+
+    # Calculate material costs
+    material_cost = 0
+    material_details = []
+
+    for recipe in product.recipes:
+        # Scale quantity appropriately
+        if recipe.is_percentage_based and recipe.percentage_value:
+            # Recalculate percentage-based quantities for the new batch size
+            if recipe.material.unit == 'kg':
+                estimated_batch_weight = batch_size * 0.02  # 20g per unit
+                scaled_quantity = (recipe.percentage_value / 100) * estimated_batch_weight
+            elif recipe.material.unit in ['ml', 'L']:
+                batch_volume = batch_size * (0.001 if recipe.material.unit == 'L' else 1)
+                scaled_quantity = (recipe.percentage_value / 100) * batch_volume
+            else:
+                scaled_quantity = (recipe.percentage_value / 100) * batch_size
+        else:
+            # Standard scaling for absolute quantities
+            scaled_quantity = recipe.quantity_per_batch * scale_factor
+
+        unit_price = historical_prices.get(recipe.material_id, recipe.material.current_price)
+        cost = scaled_quantity * unit_price
+        material_cost += cost
+
+        material_details.append({
+            'material': recipe.material.name,
+            'quantity': scaled_quantity,
+            'original_quantity': recipe.quantity_per_batch,
+            'is_percentage': recipe.is_percentage_based,
+            'percentage_value': recipe.percentage_value,
+            'unit': recipe.material.unit,
+            'unit_price': unit_price,
+            'total_cost': cost,
+            'notes': recipe.notes
+        })
+
+    # Intermediate products at their own rolled up cost per unit (components load lazily,
+    # so stock checks sharing the memoized product skip the query)
+    if product.components:
+        unit_costs = component_unit_costs([component.component_product_id for component in product.components],
+                                          as_of)
+        for component in product.components:
+            scaled_quantity = component.quantity_per_batch * scale_factor
+            unit_price = unit_costs[component.component_product_id]
+            cost = scaled_quantity * unit_price
+            material_cost += cost
+
+            material_details.append({
+                'material': component.component.name,
+                'component_product_id': component.component_product_id,
+                'quantity': scaled_quantity,
+                'original_quantity': component.quantity_per_batch,
+                'is_percentage': False,
+                'percentage_value': None,
+                'unit': 'units',
+                'unit_price': unit_price,
+                'total_cost': cost,
+                'notes': component.notes
+            })
+
+    # Calculate other costs (same as before)
+    labor_cost = product.labor_cost_per_batch * scale_factor
+    overhead_cost = material_cost * (product.overhead_percentage / 100)
+    packaging_cost = product.packaging_cost * scale_factor
+
+    total_cost = material_cost + labor_cost + overhead_cost + packaging_cost
+    recommended_price = total_cost * (1 + product.profit_margin_percentage / 100)
+
+    return {
+        'product': product,
+        'batch_size': batch_size,
+        'material_cost': material_cost,
+        'labor_cost': labor_cost,
+        'overhead_cost': overhead_cost,
+        'packaging_cost': packaging_cost,
+        'total_cost': total_cost,
+        'recommended_price': recommended_price,
+        'cost_per_unit': total_cost / batch_size,
+        'price_per_unit': recommended_price / batch_size,
+        'material_details': material_details
+    }
+
+
+# Batch costing engine
+PERCENTAGE_UNIT_FACTORS = {
+    'kg': 0.02,  # 20g per unit
+    'ml': 1.0,
+    'L': 0.001,
+}
+
+
+def recipe_unit_quantity(quantity_per_batch: float, is_percentage_based: bool,
+                         percentage_value: Optional[float], unit: str,
+                         standard_batch_size: float) -> float:
+    """Quantity of a recipe line per unit of batch size"""
+    if is_percentage_based and percentage_value:
+        return (percentage_value / 100) * PERCENTAGE_UNIT_FACTORS.get(unit, 1.0)
+    return quantity_per_batch / standard_batch_size
+
+
+@dataclass
+class SparseMatrix:
+    """Compressed sparse rows on plain NumPy arrays.
+
+    A recipe uses a handful of the catalog's materials, so a products x
+    materials array is almost all zeros; only the entries are kept here, with
+    the few products the costing code needs.
+    """
+    indptr: np.ndarray  # entries of row i are indptr[i]:indptr[i + 1]
+    indices: np.ndarray  # column of each entry
+    data: np.ndarray
+    shape: Tuple[int, int]
+
+    @classmethod
+    def from_entries(cls, rows: np.ndarray, columns: np.ndarray, values: np.ndarray,
+                     shape: Tuple[int, int]) -> 'SparseMatrix':
+        """Build from (row, column, value) triples, summing repeated positions"""
+        width = max(shape[1], 1)
+        keys, inverse = np.unique(np.asarray(rows, dtype=np.int64) * width + np.asarray(columns, dtype=np.int64),
+                                  return_inverse=True)
+        data = np.bincount(inverse.ravel(), weights=np.asarray(values, dtype=float), minlength=len(keys))
+        rows, columns = np.divmod(keys, width)
+        return cls(np.searchsorted(rows, np.arange(shape[0] + 1)), columns.astype(int), data, shape)
+
+    @property
+    def row_ids(self) -> np.ndarray:
+        """Row of each entry"""
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    def row(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Columns and values of one row"""
+        entries = slice(self.indptr[i], self.indptr[i + 1])
+        return self.indices[entries], self.data[entries]
+
+    def dot(self, x: np.ndarray) -> np.ndarray:
+        """``self @ x`` for a vector or a matrix with one row per column"""
+        x = np.asarray(x, dtype=float)
+        out = np.zeros((self.shape[0],) + x.shape[1:])
+        filled = np.flatnonzero(np.diff(self.indptr))
+        if len(filled):
+            terms = self.data.reshape((-1,) + (1,) * (x.ndim - 1)) * x[self.indices]
+            out[filled] = np.add.reduceat(terms, self.indptr[filled], axis=0)
+        return out
+
+    def rdot(self, y: np.ndarray) -> np.ndarray:
+        """``y @ self`` for a vector with one value per row"""
+        return np.bincount(self.indices, weights=self.data * np.asarray(y, dtype=float)[self.row_ids],
+                           minlength=self.shape[1])
+
+    def take_rows(self, rows: np.ndarray) -> 'SparseMatrix':
+        rows = np.asarray(rows, dtype=int)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(int)
+        positions = np.arange(indptr[-1]) - np.repeat(indptr[:-1] - starts, lengths)
+        return SparseMatrix(indptr, self.indices[positions], self.data[positions], (len(rows), self.shape[1]))
+
+    def take_columns(self, columns: np.ndarray) -> 'SparseMatrix':
+        """Keep only the given columns, renumbered in the order given"""
+        position = np.full(self.shape[1], -1)
+        position[columns] = np.arange(len(columns))
+        keep = position[self.indices] >= 0
+        indptr = np.searchsorted(self.row_ids[keep], np.arange(self.shape[0] + 1))
+        return SparseMatrix(indptr, position[self.indices[keep]], self.data[keep], (self.shape[0], len(columns)))
+
+    def scale_rows(self, factors: np.ndarray) -> 'SparseMatrix':
+        return SparseMatrix(self.indptr, self.indices, self.data * np.repeat(factors, np.diff(self.indptr)),
+                            self.shape)
+
+    def nonzero_rows(self) -> np.ndarray:
+        """Mask of rows with at least one non-zero entry"""
+        return np.bincount(self.row_ids[self.data != 0], minlength=self.shape[0]) > 0
+
+    def nonzero_columns(self) -> np.ndarray:
+        """Mask of columns with at least one non-zero entry"""
+        return np.bincount(self.indices[self.data != 0], minlength=self.shape[1]) > 0
+
+    def toarray(self) -> np.ndarray:
+        dense = np.zeros(self.shape)
+        dense[self.row_ids, self.indices] = self.data
+        return dense
+
+
+@dataclass
+class CostMatrix:
+    """Array-backed snapshot of the catalog for costing many products at once.
+
+    Every recipe line is stored as a quantity per unit of batch size, so the
+    material cost of any batch is just ``batch_size * (quantities @ prices)``
+    plus, for products made from intermediates, the component edges rolled up
+    by ``rollup``. Building for a subset of products also loads every product
+    below them in the bill of materials; ``requested`` marks the subset.
+    """
+    product_ids: np.ndarray
+    product_names: List[str]
+    standard_batch_sizes: np.ndarray
+    labor_costs: np.ndarray
+    overhead_rates: np.ndarray
+    packaging_costs: np.ndarray
+    margin_rates: np.ndarray
+    material_ids: np.ndarray
+    material_names: List[str]
+    material_units: List[str]
+    prices: np.ndarray
+    stock_quantities: np.ndarray
+    minimum_stocks: np.ndarray
+    quantities: SparseMatrix  # products x materials, quantity per unit of batch size
+    recipe_rows: List[Dict]
+    row_products: np.ndarray
+    row_materials: np.ndarray
+    row_unit_quantities: np.ndarray
+    requested: np.ndarray
+    component_rows: List[Dict]
+    edge_parents: np.ndarray  # component edges sorted by product
+    edge_children: np.ndarray
+    edge_unit_quantities: np.ndarray  # component units per unit of batch size
+    edge_starts: np.ndarray  # edges of product i are edge_starts[i]:edge_starts[i + 1]
+    rollup_order: np.ndarray  # products with components, each after its components
+    _rollup: Optional[Tuple[np.ndarray, np.ndarray]] = field(default=None, repr=False)
+    _exploded: Dict[bool, SparseMatrix] = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def build(cls, product_ids: Optional[List[int]] = None) -> 'CostMatrix':
+        """Load products, materials, recipes and components with one query each"""
+        components = load_product_components()
+        requested_ids = None
+        if product_ids is not None:
+            # Costing a product needs every product below it in the BOM
+            requested_ids = {int(product_id) for product_id in product_ids}
+            edges = [(row.product_id, row.component_product_id) for row in components]
+            product_ids = list(requested_ids | bom_descendants(requested_ids, edges))
+
+        product_query = db.session.query(
+            Product.id, Product.name, Product.batch_size, Product.labor_cost_per_batch,
+            Product.overhead_percentage, Product.packaging_cost, Product.profit_margin_percentage
+        )
+        if product_ids is not None:
+            product_query = product_query.filter(Product.id.in_(product_ids))
+        products = product_query.order_by(Product.id).all()
+
+        materials = db.session.query(
+            RawMaterial.id, RawMaterial.name, RawMaterial.unit, RawMaterial.current_price,
+            RawMaterial.stock_quantity, RawMaterial.minimum_stock
+        ).order_by(RawMaterial.id).all()
+
+        recipe_query = db.session.query(
+            Recipe.product_id, Recipe.material_id, Recipe.quantity_per_batch,
+            Recipe.is_percentage_based, Recipe.percentage_value, Recipe.notes
+        )
+        if product_ids is not None:
+            recipe_query = recipe_query.filter(Recipe.product_id.in_(product_ids))
+        recipes = recipe_query.order_by(Recipe.product_id, Recipe.id).all()
+
+        product_index = {row.id: i for i, row in enumerate(products)}
+        material_index = {row.id: j for j, row in enumerate(materials)}
+
+        standard_batch_sizes = np.array([p.batch_size for p in products], dtype=float)
+
+        recipe_rows = []
+        row_products = []
+        row_materials = []
+        row_unit_quantities = []
+        for recipe in recipes:
+            i = product_index.get(recipe.product_id)
+            j = material_index.get(recipe.material_id)
+            if i is None or j is None:
+                continue
+            material = materials[j]
+
+            unit_quantity = recipe_unit_quantity(
+                recipe.quantity_per_batch, recipe.is_percentage_based, recipe.percentage_value,
+                material.unit, standard_batch_sizes[i]
+            )
+
+            recipe_rows.append({
+                'material': material.name,
+                'original_quantity': recipe.quantity_per_batch,
+                'is_percentage': recipe.is_percentage_based,
+                'percentage_value': recipe.percentage_value,
+                'unit': material.unit,
+                'unit_price': material.current_price,
+                'notes': recipe.notes
+            })
+            row_products.append(i)
+            row_materials.append(j)
+            row_unit_quantities.append(unit_quantity)
+
+        row_products = np.array(row_products, dtype=int)
+        row_materials = np.array(row_materials, dtype=int)
+        row_unit_quantities = np.array(row_unit_quantities, dtype=float)
+        quantities = SparseMatrix.from_entries(row_products, row_materials, row_unit_quantities,
+                                               (len(products), len(materials)))
+
+        # Component rows arrive ordered by product, matching the CSR layout of the edges
+        component_rows = []
+        edge_parents = []
+        edge_children = []
+        edge_unit_quantities = []
+        for component in components:
+            i = product_index.get(component.product_id)
+            k = product_index.get(component.component_product_id)
+            if i is None or k is None:
+                continue
+            component_rows.append({
+                'material': products[k].name,
+                'component_product_id': component.component_product_id,
+                'original_quantity': component.quantity_per_batch,
+                'is_percentage': False,
+                'percentage_value': None,
+                'unit': 'units',
+                'notes': component.notes
+            })
+            edge_parents.append(i)
+            edge_children.append(k)
+            edge_unit_quantities.append(component.quantity_per_batch / standard_batch_sizes[i])
+
+        edge_parents = np.array(edge_parents, dtype=int)
+        edge_children = np.array(edge_children, dtype=int)
+        order = bom_topological_order(product_index, [
+            (products[i].id, products[k].id) for i, k in zip(edge_parents, edge_children)
+        ])
+        has_components = np.bincount(edge_parents, minlength=len(products)) > 0
+
+        return cls(
+            product_ids=np.array([p.id for p in products], dtype=int),
+            product_names=[p.name for p in products],
+            standard_batch_sizes=standard_batch_sizes,
+            labor_costs=np.array([p.labor_cost_per_batch or 0 for p in products], dtype=float),
+            overhead_rates=np.array([p.overhead_percentage or 0 for p in products], dtype=float) / 100,
+            packaging_costs=np.array([p.packaging_cost or 0 for p in products], dtype=float),
+            margin_rates=np.array([p.profit_margin_percentage or 0 for p in products], dtype=float) / 100,
+            material_ids=np.array([m.id for m in materials], dtype=int),
+            material_names=[m.name for m in materials],
+            material_units=[m.unit for m in materials],
+            prices=np.array([m.current_price for m in materials], dtype=float),
+            stock_quantities=np.array([m.stock_quantity or 0 for m in materials], dtype=float),
+            minimum_stocks=np.array([m.minimum_stock or 0 for m in materials], dtype=float),
+            quantities=quantities,
+            recipe_rows=recipe_rows,
+            row_products=row_products,
+            row_materials=row_materials,
+            row_unit_quantities=row_unit_quantities,
+            requested=(np.isin([p.id for p in products], list(requested_ids)) if requested_ids is not None
+                       else np.ones(len(products), dtype=bool)),
+            component_rows=component_rows,
+            edge_parents=edge_parents,
+            edge_children=edge_children,
+            edge_unit_quantities=np.array(edge_unit_quantities, dtype=float),
+            edge_starts=np.searchsorted(edge_parents, np.arange(len(products) + 1)),
+            rollup_order=np.array([product_index[product_id] for product_id in order
+                                   if has_components[product_index[product_id]]], dtype=int)
+        )
+
+    def rollup(self, prices: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Material cost and total cost per unit of every product, rolled up through the BOM.
+
+        Components are charged at their own total cost per unit (materials,
+        overhead, labor and packaging, but no margin). Products with components
+        are visited once, after all of their components, so each intermediate
+        is costed once per pass and the pass is linear in the recipe edges.
+        The result for the matrix's own prices is memoized.
+        """
+        if prices is None and self._rollup is not None:
+            return self._rollup
+
+        unit_material = self.quantities.dot(self.prices if prices is None else prices)
+        fixed = (self.labor_costs + self.packaging_costs) / self.standard_batch_sizes
+        unit_total = unit_material * (1 + self.overhead_rates) + fixed
+        for i in self.rollup_order:
+            edges = slice(self.edge_starts[i], self.edge_starts[i + 1])
+            unit_material[i] += self.edge_unit_quantities[edges] @ unit_total[self.edge_children[edges]]
+            unit_total[i] = unit_material[i] * (1 + self.overhead_rates[i]) + fixed[i]
+
+        if prices is None:
+            self._rollup = (unit_material, unit_total)
+        return unit_material, unit_total
+
+    def exploded_quantities(self, cost_weighted: bool = False) -> SparseMatrix:
+        """Raw material quantities per unit, including those inside components.
+
+        This is what producing a product (and its intermediates) draws from
+        stock. With ``cost_weighted`` a component's materials are scaled by its
+        overhead rate as well, which makes the rows the sensitivity of material
+        cost per unit to each material price. Only rows of products with
+        components change, so those are rebuilt and the rest are shared.
+        """
+        if cost_weighted not in self._exploded:
+            weights = 1 + self.overhead_rates if cost_weighted else np.ones(len(self.product_ids))
+            exploded_rows = {}
+
+            def row(i):
+                return exploded_rows[i] if i in exploded_rows else self.quantities.row(i)
+
+            for i in self.rollup_order:
+                edges = slice(self.edge_starts[i], self.edge_starts[i + 1])
+                parts = [row(i)]
+                for k, quantity in zip(self.edge_children[edges], self.edge_unit_quantities[edges]):
+                    columns, values = row(k)
+                    parts.append((columns, values * quantity * weights[k]))
+                columns, inverse = np.unique(np.concatenate([columns for columns, _ in parts]),
+                                             return_inverse=True)
+                values = np.bincount(inverse.ravel(), weights=np.concatenate([values for _, values in parts]),
+                                     minlength=len(columns))
+                exploded_rows[int(i)] = (columns, values)
+
+            exploded = self.quantities
+            if exploded_rows:
+                kept = ~np.isin(self.quantities.row_ids, self.rollup_order)
+                rebuilt = list(exploded_rows)
+                exploded = SparseMatrix.from_entries(
+                    np.concatenate([self.quantities.row_ids[kept]] +
+                                   [np.full(len(exploded_rows[i][0]), i) for i in rebuilt]),
+                    np.concatenate([self.quantities.indices[kept]] + [exploded_rows[i][0] for i in rebuilt]),
+                    np.concatenate([self.quantities.data[kept]] + [exploded_rows[i][1] for i in rebuilt]),
+                    self.quantities.shape
+                )
+            self._exploded[cost_weighted] = exploded
+        return self._exploded[cost_weighted]
+
+    def compute(self, batch_sizes: Optional[List[float]] = None) -> Dict[str, np.ndarray]:
+        """Cost every product for every batch size in one pass.
+
+        Returns arrays shaped (products, batch sizes). Without explicit batch
+        sizes each product is costed at its own standard batch size.
+        """
+        if batch_sizes:
+            sizes = np.broadcast_to(np.asarray(batch_sizes, dtype=float),
+                                    (len(self.product_ids), len(batch_sizes)))
+        else:
+            sizes = self.standard_batch_sizes[:, None]
+        scale = sizes / self.standard_batch_sizes[:, None]
+
+        unit_material_cost = self.rollup()[0]
+        material_cost = unit_material_cost[:, None] * sizes
+        labor_cost = self.labor_costs[:, None] * scale
+        overhead_cost = material_cost * self.overhead_rates[:, None]
+        packaging_cost = self.packaging_costs[:, None] * scale
+        total_cost = material_cost + labor_cost + overhead_cost + packaging_cost
+        recommended_price = total_cost * (1 + self.margin_rates[:, None])
+
+        return {
+            'batch_size': sizes,
+            'material_cost': material_cost,
+            'labor_cost': labor_cost,
+            'overhead_cost': overhead_cost,
+            'packaging_cost': packaging_cost,
+            'total_cost': total_cost,
+            'recommended_price': recommended_price,
+            'cost_per_unit': total_cost / sizes,
+            'price_per_unit': recommended_price / sizes
+        }
+
+    def material_details(self, sizes: np.ndarray) -> List[List[List[Dict]]]:
+        """Per recipe line breakdown, grouped by product then batch size"""
+        row_quantities = self.row_unit_quantities[:, None] * sizes[self.row_products]
+        row_costs = row_quantities * self.prices[self.row_materials][:, None]
+
+        details = [[[] for _ in range(sizes.shape[1])] for _ in self.product_ids]
+        for r, row in enumerate(self.recipe_rows):
+            product_details = details[self.row_products[r]]
+            for b in range(sizes.shape[1]):
+                product_details[b].append(dict(
+                    row,
+                    quantity=float(row_quantities[r, b]),
+                    total_cost=float(row_costs[r, b])
+                ))
+
+        if self.component_rows:
+            unit_totals = self.rollup()[1]
+            edge_quantities = self.edge_unit_quantities[:, None] * sizes[self.edge_parents]
+            for e, row in enumerate(self.component_rows):
+                unit_price = float(unit_totals[self.edge_children[e]])
+                product_details = details[self.edge_parents[e]]
+                for b in range(sizes.shape[1]):
+                    product_details[b].append(dict(
+                        row,
+                        unit_price=unit_price,
+                        quantity=float(edge_quantities[e, b]),
+                        total_cost=float(edge_quantities[e, b] * unit_price)
+                    ))
+        return details
+
+
+def calculate_batch_costs(product_ids: Optional[List[int]] = None,
+                          batch_sizes: Optional[List[float]] = None,
+                          include_details: bool = True) -> List[Dict]:
+    """Calculate costs for many products and batch sizes with the batch engine"""
+    matrix = CostMatrix.build(product_ids)
+    costs = matrix.compute(batch_sizes)
+    details = matrix.material_details(costs['batch_size']) if include_details else None
+
+    results = []
+    for i in np.flatnonzero(matrix.requested):
+        product_id = matrix.product_ids[i]
+        for b in range(costs['batch_size'].shape[1]):
+            cost_data = {key: float(values[i, b]) for key, values in costs.items()}
+            if details is not None:
+                cost_data['material_details'] = details[i][b]
+            results.append({
+                'product_id': int(product_id),
+                'name': matrix.product_names[i],
+                'cost_data': cost_data
+            })
+    return results
+
+
+class CostMatrixCache:
+    """Keeps the full-catalog CostMatrix until products, recipes or materials change"""
+
+    def __init__(self):
+        self._matrix = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def catalog_version(include_prices: bool = True):
+        """Stamp of the catalog shared by every process; without prices it only covers the recipe structure"""
+        products = db.session.query(func.count(Product.id), func.max(Product.id), func.max(Product.updated_at)).one()
+        recipes = db.session.query(func.count(Recipe.id), func.max(Recipe.updated_at)).one()
+        materials = db.session.query(
+            func.count(RawMaterial.id), func.max(RawMaterial.last_updated if include_prices else RawMaterial.id)
+        ).one()
+        components = db.session.query(func.count(ProductComponent.id), func.max(ProductComponent.updated_at)).one()
+        return tuple(products) + tuple(recipes) + tuple(materials) + tuple(components)
+
+    def get(self) -> CostMatrix:
+        version = self.catalog_version()
+        with self._lock:
+            if self._matrix is None or self._version != version:
+                self._matrix = CostMatrix.build()
+                self._version = version
+            return self._matrix
+
+    def invalidate(self):
+        with self._lock:
+            self._matrix = None
+
+
+cost_matrix_cache = CostMatrixCache()
+
+
+# Production planning
+def plan_production(orders: List[Dict]) -> Dict:
+    """Check whether a set of production orders can be made from current stock.
+
+    Each order is a dict with ``product_id`` and optional ``batch_size``
+    (defaults to the product's standard batch) and ``batches`` (defaults to 1).
+    Requirements of all orders are aggregated per material in one matrix
+    product, so batches competing for the same material are accounted for.
+    Low stock means the material would be at or below its minimum after the plan.
+    """
+    product_ids = list({int(order['product_id']) for order in orders})
+    matrix = cost_matrix_cache.get()
+    product_index = {product_id: i for i, product_id in enumerate(matrix.product_ids)}
+
+    missing = [product_id for product_id in product_ids if product_id not in product_index]
+    if missing:
+        raise ValueError(f"Unknown product id(s): {', '.join(map(str, sorted(missing)))}")
+
+    order_products = np.array([product_index[int(order['product_id'])] for order in orders], dtype=int)
+    order_sizes = np.array([
+        float(order.get('batch_size') or matrix.standard_batch_sizes[i])
+        for order, i in zip(orders, order_products)
+    ])
+    order_batches = np.array([float(order.get('batches', 1)) for order in orders])
+
+    # Total units planned per product, then material requirements in one pass
+    planned_units = np.bincount(order_products, weights=order_sizes * order_batches,
+                                minlength=len(matrix.product_ids))
+    # Intermediates are made as part of the order, from raw material stock
+    quantities = matrix.exploded_quantities()
+    required = quantities.rdot(planned_units)
+    remaining = matrix.stock_quantities - required
+
+    used = required > 0
+    short = used & (remaining < 0)
+    low = used & ~short & (remaining <= matrix.minimum_stocks)
+
+    # Batches of each order's size that current stock alone could support
+    per_batch = quantities.take_rows(order_products).scale_rows(order_sizes)
+    drawn = per_batch.data > 0
+    max_batches = np.full(len(orders), np.inf)
+    np.minimum.at(max_batches, per_batch.row_ids[drawn],
+                  matrix.stock_quantities[per_batch.indices[drawn]] / per_batch.data[drawn])
+    max_batches = np.floor(max_batches)
+
+    return {
+        'can_produce': not short.any(),
+        'orders': [{
+            'product_id': int(matrix.product_ids[i]),
+            'name': matrix.product_names[i],
+            'batch_size': float(order_sizes[n]),
+            'batches': float(order_batches[n]),
+            'max_feasible_batches': None if np.isinf(max_batches[n]) else int(max_batches[n])
+        } for n, i in enumerate(order_products)],
+        'missing_materials': [{
+            'material': matrix.material_names[j],
+            'unit': matrix.material_units[j],
+            'required': float(required[j]),
+            'available': float(matrix.stock_quantities[j]),
+            'shortage': float(-remaining[j])
+        } for j in np.flatnonzero(short)],
+        'low_stock_materials': [{
+            'material': matrix.material_names[j],
+            'unit': matrix.material_units[j],
+            'required': float(required[j]),
+            'current_stock': float(matrix.stock_quantities[j]),
+            'remaining_stock': float(remaining[j]),
+            'minimum_stock': float(matrix.minimum_stocks[j])
+        } for j in np.flatnonzero(low)]
+    }
+
+
+# Production mix optimization
+optimizer_metrics = {
+    'solves': 0,
+    'total_solve_ms': 0.0,
+    'last_solve_ms': None,
+    'last_solver': None,
+    'last_size': None
+}
+
+
+def simplex_maximize(c: np.ndarray, A: np.ndarray, b: np.ndarray,
+                     max_iterations: int = 100000, tol: float = 1e-9):
+    """Maximize c @ x subject to A @ x <= b, x >= 0 for b >= 0.
+
+    Dense tableau simplex starting from the all-slack basis, which is
+    feasible because b is non-negative. Uses Dantzig's rule and falls back to
+    Bland's rule after a run of degenerate pivots to avoid cycling.
+    Returns the solution and the number of pivots.
+    """
+    m, n = A.shape
+    tableau = np.zeros((m + 1, n + m + 1))
+    tableau[:m, :n] = A
+    tableau[:m, n:n + m] = np.eye(m)
+    tableau[:m, -1] = b
+    tableau[-1, :n] = -c
+    basis = np.arange(n, n + m)
+
+    degenerate_run = 0
+    for iteration in range(max_iterations):
+        costs = tableau[-1, :-1]
+        if degenerate_run > 50:
+            candidates = np.flatnonzero(costs < -tol)
+            if not len(candidates):
+                break
+            col = candidates[0]
+        else:
+            col = int(np.argmin(costs))
+            if costs[col] >= -tol:
+                break
+
+        column = tableau[:m, col]
+        positive = column > tol
+        if not positive.any():
+            raise ValueError('Production mix is unbounded')
+        ratios = np.full(m, np.inf)
+        ratios[positive] = tableau[:m, -1][positive] / column[positive]
+        row = int(np.argmin(ratios))
+        degenerate_run = degenerate_run + 1 if ratios[row] <= tol else 0
+
+        tableau[row] /= tableau[row, col]
+        pivot_column = tableau[:, col].copy()
+        pivot_column[row] = 0
+        tableau -= np.outer(pivot_column, tableau[row])
+        basis[row] = col
+    else:
+        raise ValueError('Simplex did not converge')
+
+    x = np.zeros(n + m)
+    x[basis] = tableau[:m, -1]
+    return x[:n], iteration
+
+
+def optimize_production_mix(product_ids: Optional[List[int]] = None,
+                            max_batches: Optional[Dict[int, float]] = None,
+                            solver: str = 'auto') -> Dict:
+    """Find the mix of standard batches that maximizes margin within current stock.
+
+    Margin per batch is recommended price minus total cost at the standard
+    batch size. Only products with a positive margin are considered and only
+    the materials they use become constraints. ``max_batches`` caps the
+    batches of individual products (e.g. for demand limits). The LP relaxation
+    is solved with scipy's HiGHS when available, otherwise with the NumPy
+    simplex; whole batches are the relaxed plan rounded down, which stays
+    within stock.
+    """
+    build_started = time.perf_counter()
+    matrix = cost_matrix_cache.get()
+    costs = matrix.compute()
+    margins = (costs['recommended_price'] - costs['total_cost'])[:, 0]
+    usage = matrix.exploded_quantities().scale_rows(matrix.standard_batch_sizes)  # per standard batch
+
+    candidates = margins > 0
+    if product_ids is not None:
+        candidates &= np.isin(matrix.product_ids, [int(p) for p in product_ids])
+
+    caps = np.full(len(matrix.product_ids), np.inf)
+    for product_id, cap in (max_batches or {}).items():
+        caps[matrix.product_ids == int(product_id)] = float(cap)
+
+    uses_materials = usage.nonzero_rows()
+    unbounded = candidates & ~uses_materials & np.isinf(caps)
+    candidates &= ~unbounded
+
+    products = np.flatnonzero(candidates)
+    usage = usage.take_rows(products)
+    materials = np.flatnonzero(usage.nonzero_columns())
+    # The LP solvers take a dense constraint matrix, over the used materials only
+    A = usage.take_columns(materials).toarray().T
+    b = np.maximum(matrix.stock_quantities[materials], 0)
+
+    capped = products[np.isfinite(caps[products])]
+    if len(capped):
+        cap_rows = (products[None, :] == capped[:, None]).astype(float)
+        A = np.vstack([A, cap_rows])
+        b = np.concatenate([b, caps[capped]])
+    c = margins[products]
+    build_ms = (time.perf_counter() - build_started) * 1000
+
+    solve_started = time.perf_counter()
+    iterations = 0
+    if not len(products):
+        x = np.zeros(0)
+        used_solver = 'none'
+    elif linprog is not None and solver in ('auto', 'scipy'):
+        result = linprog(-c, A_ub=A, b_ub=b, bounds=(0, None), method='highs')
+        if not result.success:
+            raise ValueError(f"Optimization failed: {result.message}")
+        x = result.x
+        iterations = int(getattr(result, 'nit', 0))
+        used_solver = 'scipy-highs'
+    elif solver in ('auto', 'numpy'):
+        x, iterations = simplex_maximize(c, A, b)
+        used_solver = 'numpy-simplex'
+    else:
+        raise ValueError(f"Solver '{solver}' is not available")
+    solve_ms = (time.perf_counter() - solve_started) * 1000
+
+    optimizer_metrics['solves'] += 1
+    optimizer_metrics['total_solve_ms'] += solve_ms
+    optimizer_metrics['last_solve_ms'] = solve_ms
+    optimizer_metrics['last_solver'] = used_solver
+    optimizer_metrics['last_size'] = [int(A.shape[0]), int(A.shape[1])]
+
+    x = np.maximum(x, 0)
+    whole = np.floor(x + 1e-9)
+    plan = [{
+        'product_id': int(matrix.product_ids[i]),
+        'name': matrix.product_names[i],
+        'batch_size': float(matrix.standard_batch_sizes[i]),
+        'batches': float(x[k]),
+        'whole_batches': int(whole[k]),
+        'margin_per_batch': float(margins[i]),
+        'margin': float(margins[i] * x[k])
+    } for k, i in enumerate(products) if x[k] > 1e-9]
+
+    return {
+        'plan': plan,
+        'objective': float(c @ x) if len(products) else 0.0,
+        'whole_batch_objective': float(c @ whole) if len(products) else 0.0,
+        'binding_materials': [{
+            'material': matrix.material_names[j],
+            'used': float(A[k] @ x),
+            'available': float(b[k])
+        } for k, j in enumerate(materials) if b[k] - A[k] @ x <= 1e-6 * max(b[k], 1)],
+        'unbounded_products': [int(p) for p in matrix.product_ids[unbounded]],
+        'metrics': {
+            'solver': used_solver,
+            'products': int(len(products)),
+            'constraints': int(A.shape[0]),
+            'iterations': iterations,
+            'build_ms': build_ms,
+            'solve_ms': solve_ms
+        }
+    }
+
+
+# Price sensitivity simulation
+def simulate_price_sensitivity(volatility: Optional[Dict[int, float]] = None,
+                               default_volatility: float = 0.1,
+                               scenarios: int = 10000,
+                               product_ids: Optional[List[int]] = None,
+                               percentiles: Iterable[float] = (5, 25, 50, 75, 95),
+                               chunk_size: int = 2000,
+                               seed: Optional[int] = None,
+                               top_drivers: int = 5,
+                               history_days: Optional[int] = None,
+                               horizon_days: int = 30) -> Dict:
+    """Monte Carlo distribution of standard-batch costs under material price volatility.
+
+    Each scenario draws every used material price from a mean-preserving
+    lognormal around its current price with the given volatility (standard
+    deviation of log returns). Scenarios are sampled in chunks so the working
+    set stays at chunk_size x materials; only the material cost per product
+    is kept, since total cost, cost per unit, recommended price and margin at
+    today's recommended price are all affine in it. Variance drivers are the
+    exact per-material variance contributions of the linear cost model.
+
+    With ``history_days`` the volatility of materials with enough price
+    history is estimated from their daily closes, scaled to ``horizon_days``;
+    explicit ``volatility`` entries still take precedence.
+    """
+    started = time.perf_counter()
+    matrix = cost_matrix_cache.get()
+
+    products = np.arange(len(matrix.product_ids))
+    if product_ids is not None:
+        products = np.flatnonzero(np.isin(matrix.product_ids, [int(p) for p in product_ids]))
+    if scenarios * len(products) > app.config['SIMULATION_MAX_SAMPLES']:
+        raise ValueError('Too many scenarios for this many products; lower scenarios or select products')
+    if history_days is not None and history_days <= 0:
+        raise ValueError('history_days must be positive')
+
+    # Material cost per batch is usage @ prices plus the labor, packaging and
+    # overhead carried in by component products, which does not depend on prices
+    sensitivities = matrix.exploded_quantities(cost_weighted=True)
+    component_costs = (matrix.rollup()[0] - sensitivities.dot(matrix.prices))[products] * \
+        matrix.standard_batch_sizes[products]
+    usage = sensitivities.take_rows(products).scale_rows(matrix.standard_batch_sizes[products])
+    materials = np.flatnonzero(usage.nonzero_columns())
+    usage = usage.take_columns(materials)
+    base_prices = matrix.prices[materials]
+
+    sigmas = np.full(len(materials), float(default_volatility))
+    material_position = {int(material_id): k for k, material_id in enumerate(matrix.material_ids[materials])}
+    if history_days:
+        for material_id, daily_sigma in material_volatility_from_history(history_days).items():
+            if material_id in material_position:
+                sigmas[material_position[material_id]] = daily_sigma * np.sqrt(horizon_days)
+    for material_id, sigma in (volatility or {}).items():
+        if int(material_id) in material_position:
+            sigmas[material_position[int(material_id)]] = float(sigma)
+
+    rng = np.random.default_rng(seed)
+    material_costs = np.empty((scenarios, len(products)), dtype=np.float32)
+    drift = -0.5 * sigmas ** 2
+    # Every usage entry is priced in every scenario of a chunk, so chunks
+    # shrink when there are more entries than materials
+    chunk_size = max(1, min(chunk_size, chunk_size * len(materials) // max(len(usage.data), 1)))
+    for start in range(0, scenarios, chunk_size):
+        stop = min(start + chunk_size, scenarios)
+        shocks = rng.standard_normal((stop - start, len(materials)))
+        prices = base_prices * np.exp(shocks * sigmas + drift)
+        material_costs[start:stop] = usage.dot(prices.T).T + component_costs
+
+    # Affine maps from material cost to the reported metrics
+    overhead = 1 + matrix.overhead_rates[products]
+    fixed = matrix.labor_costs[products] + matrix.packaging_costs[products]
+    markup = 1 + matrix.margin_rates[products]
+    batch_sizes = matrix.standard_batch_sizes[products]
+    current_price = ((usage.dot(base_prices) + component_costs) * overhead + fixed) * markup
+
+    levels = list(percentiles)
+    # Margin falls as cost rises, so its percentiles mirror the cost percentiles
+    material_percentiles = np.percentile(
+        material_costs, levels + [100 - level for level in levels], axis=0
+    )  # 2 x levels x products
+    total_percentiles = material_percentiles[:len(levels)] * overhead + fixed
+    margin_percentiles = current_price - (material_percentiles[len(levels):] * overhead + fixed)
+    loss_probability = (material_costs * overhead + fixed > current_price).mean(axis=0)
+
+    price_variance = base_prices ** 2 * (np.exp(sigmas ** 2) - 1)
+    # One contribution per usage entry, i.e. per product and material
+    contributions = usage.data ** 2 * price_variance[usage.indices] * overhead[usage.row_ids] ** 2
+
+    def named_percentiles(values):
+        return {f"p{level:g}": float(value) for level, value in zip(levels, values)}
+
+    def drivers(columns, variances):
+        total = variances.sum()
+        order = np.argsort(variances)[::-1][:top_drivers]
+        return [{
+            'material_id': int(matrix.material_ids[materials[columns[k]]]),
+            'material': matrix.material_names[materials[columns[k]]],
+            'variance_share': float(variances[k] / total) if total else 0.0
+        } for k in order if variances[k] > 0]
+
+    results = []
+    for n, i in enumerate(products):
+        totals = total_percentiles[:, n]
+        results.append({
+            'product_id': int(matrix.product_ids[i]),
+            'name': matrix.product_names[i],
+            'batch_size': float(batch_sizes[n]),
+            'current_recommended_price': float(current_price[n]),
+            'total_cost': named_percentiles(totals),
+            'cost_per_unit': named_percentiles(totals / batch_sizes[n]),
+            'recommended_price': named_percentiles(totals * markup[n]),
+            'margin': named_percentiles(margin_percentiles[:, n]),
+            'loss_probability': float(loss_probability[n]),
+            'variance_drivers': drivers(usage.indices[usage.indptr[n]:usage.indptr[n + 1]],
+                                        contributions[usage.indptr[n]:usage.indptr[n + 1]])
+        })
+
+    return {
+        'scenarios': scenarios,
+        'products': results,
+        'variance_drivers': drivers(np.arange(len(materials)),
+                                    np.bincount(usage.indices, weights=contributions, minlength=len(materials))),
+        'elapsed_ms': (time.perf_counter() - started) * 1000
+    }
+
+
+# Cost result cache
+class CostCache:
+    """In-process LRU cache of cost results with an optional shared backend.
+
+    Keys are (product_id, batch_size, version) where the version stamp changes
+    whenever the product row, its recipes or their materials change. A shared
+    backend only needs ``get(key)``, ``set(key, value)`` and ``delete(key)``
+    working on string keys and JSON-serializable values.
+    """
+
+    def __init__(self, maxsize: int = 1024, backend=None):
+        self.maxsize = maxsize
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._keys_by_product = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _backend_key(key) -> str:
+        return 'cost:{}:{}:{}'.format(*key)
+
+    def get(self, key) -> Optional[Dict]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        value = self.backend.get(self._backend_key(key)) if self.backend else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, value)
+        return value
+
+    def set(self, key, value: Dict):
+        with self._lock:
+            self._store(key, value)
+        if self.backend:
+            self.backend.set(self._backend_key(key), value)
+
+    def _store(self, key, value: Dict):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._keys_by_product.setdefault(key[0], set()).add(key)
+        while len(self._entries) > self.maxsize:
+            old_key, _ = self._entries.popitem(last=False)
+            self._forget(old_key)
+            self.evictions += 1
+
+    def _forget(self, key):
+        keys = self._keys_by_product.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_product[key[0]]
+
+    def invalidate_product(self, product_id: int) -> int:
+        """Drop every cached result for one product"""
+        with self._lock:
+            keys = self._keys_by_product.pop(product_id, set())
+            for key in keys:
+                self._entries.pop(key, None)
+        if self.backend:
+            for key in keys:
+                self.backend.delete(self._backend_key(key))
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_product.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'shared_backend': type(self.backend).__name__ if self.backend else None
+            }
+
+
+cost_cache = CostCache(app.config['COST_CACHE_SIZE'])
+
+
+def get_cost_version(product_id: int) -> str:
+    """Version stamp for a product's costing inputs, computed in one query.
+
+    The stamp covers the product's whole sub-graph of the bill of materials
+    (found with a recursive CTE), so a change to a component's recipe,
+    materials or own components anywhere below gives a new version in every
+    worker.
+    """
+    subgraph = select(Product.id.label('product_id')).where(Product.id == product_id).cte(
+        'bom_subgraph', recursive=True
+    )
+    subgraph = subgraph.union(select(ProductComponent.component_product_id).where(
+        ProductComponent.product_id == subgraph.c.product_id
+    ))
+    in_subgraph = select(subgraph.c.product_id)
+    stamps = [
+        select(func.max(Product.updated_at)).where(Product.id.in_(in_subgraph)),
+        select(func.count(Recipe.id)).where(Recipe.product_id.in_(in_subgraph)),
+        select(func.max(Recipe.updated_at)).where(Recipe.product_id.in_(in_subgraph)),
+        select(func.max(RawMaterial.last_updated)).join(Recipe, Recipe.material_id == RawMaterial.id).where(
+            Recipe.product_id.in_(in_subgraph)
+        ),
+        select(func.count(ProductComponent.id)).where(ProductComponent.product_id.in_(in_subgraph)),
+        select(func.max(ProductComponent.updated_at)).where(ProductComponent.product_id.in_(in_subgraph))
+    ]
+    row = db.session.query(
+        Product.batch_size, Product.labor_cost_per_batch, Product.overhead_percentage,
+        Product.packaging_cost, Product.profit_margin_percentage, *[stamp.scalar_subquery() for stamp in stamps]
+    ).filter(Product.id == product_id).first()
+
+    if row is None:
+        # Let the regular loader raise the usual 404
+        get_product_with_recipes(product_id)
+    return hashlib.sha1(repr(tuple(row)).encode()).hexdigest()[:16]
+
+
+def get_cached_product_cost(product_id: int, custom_batch_size: Optional[float] = None) -> Dict:
+    """calculate_product_cost through the cost cache (without the ORM product)"""
+    product_id = int(product_id)
+    batch_size = float(custom_batch_size) if custom_batch_size else None
+    key = (product_id, batch_size, get_cost_version(product_id))
+
+    cost_data = cost_cache.get(key)
+    if cost_data is None:
+        cost_data = calculate_product_cost(product_id, batch_size)
+        cost_data = {k: v for k, v in cost_data.items() if k != 'product'}
+        cost_cache.set(key, cost_data)
+    return dict(cost_data)
+
+
+def invalidate_material_costs(material_id: int) -> int:
+    """Drop cached costs of every product that uses a material, directly or through components"""
+    return sum(cost_cache.invalidate_product(product_id)
+               for product_id in material_usage_index.usages(material_id))
+
+
+def invalidate_product_costs(product_id: int) -> int:
+    """Drop cached costs of a product and of every product it is a component of"""
+    product_ids = {int(product_id)} | material_usage_index.ancestors(int(product_id))
+    return sum(cost_cache.invalidate_product(product_id) for product_id in product_ids)
+
+
+# Incremental cost propagation
+class MaterialUsageIndex:
+    """Reverse index from material id to the products whose recipes use it.
+
+    Each entry maps a product id to the material quantity per unit of batch
+    size, summed over that product's recipe lines. Products using the
+    material through intermediate products are found by walking the reverse
+    component edges from the direct users, so only the affected sub-graph is
+    visited; their entries are the sensitivity of material cost per unit to
+    the material price (component quantities times component overhead). The
+    index is stamped with the catalog version (without prices) and rebuilt
+    when it changes, so changes made by other workers are picked up too.
+    """
+
+    def __init__(self):
+        self._usages = None
+        self._version = None
+        self._parents = None  # component id -> {product id: component units per unit}
+        self._overhead_rates = None  # component id -> overhead rate
+        self._positions = None  # product id -> position in topological order
+        self._lock = threading.Lock()
+
+    def _build_components(self):
+        rows = db.session.query(
+            ProductComponent.product_id, ProductComponent.component_product_id,
+            ProductComponent.quantity_per_batch, Product.batch_size
+        ).join(Product, Product.id == ProductComponent.product_id).all()
+
+        parents = {}
+        for row in rows:
+            products = parents.setdefault(row.component_product_id, {})
+            products[row.product_id] = products.get(row.product_id, 0.0) + row.quantity_per_batch / row.batch_size
+
+        overhead_rates = {}
+        if parents:
+            overhead_rates = {product_id: (overhead or 0) / 100 for product_id, overhead in db.session.query(
+                Product.id, Product.overhead_percentage
+            ).filter(Product.id.in_(list(parents)))}
+
+        edges = [(row.product_id, row.component_product_id) for row in rows]
+        order = bom_topological_order({node for edge in edges for node in edge}, edges)
+        return parents, overhead_rates, {product_id: position for position, product_id in enumerate(order)}
+
+    def _ensure_built(self, version):
+        if self._usages is None or self._version != version:
+            self._usages = self._build()
+            self._parents, self._overhead_rates, self._positions = self._build_components()
+            self._version = version
+
+    def _build(self) -> Dict[int, Dict[int, float]]:
+        rows = db.session.query(
+            Recipe.material_id, Recipe.product_id, Recipe.quantity_per_batch,
+            Recipe.is_percentage_based, Recipe.percentage_value,
+            RawMaterial.unit, Product.batch_size
+        ).join(RawMaterial, RawMaterial.id == Recipe.material_id).join(
+            Product, Product.id == Recipe.product_id
+        ).all()
+
+        usages = {}
+        for row in rows:
+            quantity = recipe_unit_quantity(
+                row.quantity_per_batch, row.is_percentage_based, row.percentage_value,
+                row.unit, row.batch_size
             )
-            db.session.add(market_price)
+            products = usages.setdefault(row.material_id, {})
+            products[row.product_id] = products.get(row.product_id, 0.0) + quantity
+        return usages
+
+    def usages(self, material_id: int) -> Dict[int, float]:
+        version = CostMatrixCache.catalog_version(include_prices=False)
+        with self._lock:
+            self._ensure_built(version)
+            direct = self._usages.get(material_id, {})
+            parents, overhead_rates, positions = self._parents, self._overhead_rates, self._positions
+        if not parents:
+            return direct
+
+        # Push sensitivities up the affected sub-graph, components before their users
+        usages = dict(direct)
+        affected = set(direct) | self._ancestors(direct, parents)
+        for product_id in sorted(affected & positions.keys(), key=positions.__getitem__):
+            weight = usages.get(product_id, 0.0) * (1 + overhead_rates.get(product_id, 0.0))
+            for parent_id, quantity in parents.get(product_id, {}).items():
+                usages[parent_id] = usages.get(parent_id, 0.0) + quantity * weight
+        return usages
+
+    @staticmethod
+    def _ancestors(product_ids: Iterable[int], parents: Dict[int, Dict[int, float]]) -> set:
+        found = set()
+        stack = list(product_ids)
+        while stack:
+            for parent_id in parents.get(stack.pop(), ()):
+                if parent_id not in found:
+                    found.add(parent_id)
+                    stack.append(parent_id)
+        return found
+
+    def ancestors(self, product_id: int) -> set:
+        """Products that use this product as a component, directly or indirectly"""
+        version = CostMatrixCache.catalog_version(include_prices=False)
+        with self._lock:
+            self._ensure_built(version)
+            parents = self._parents
+        return self._ancestors([product_id], parents)
+
+    def invalidate(self):
+        with self._lock:
+            self._usages = None
+
+
+material_usage_index = MaterialUsageIndex()
+
+
+def latest_cost_analyses(product_ids: List[int]) -> Dict[int, CostAnalysis]:
+    """Most recent stored CostAnalysis per product"""
+    if not product_ids:
+        return {}
+    latest_ids = db.session.query(func.max(CostAnalysis.id)).filter(
+        CostAnalysis.product_id.in_(product_ids)
+    ).group_by(CostAnalysis.product_id)
+    analyses = CostAnalysis.query.filter(CostAnalysis.id.in_(latest_ids)).all()
+    return {analysis.product_id: analysis for analysis in analyses}
+
+
+def costing_inputs_changed_at(products: Dict[int, Product]) -> Dict[int, datetime]:
+    """Latest change to each product's own row, recipe lines or components"""
+    changed = {product_id: product.updated_at for product_id, product in products.items() if product.updated_at}
+    if not products:
+        return changed
+    product_ids = list(products)
+    for product_id, updated_at in db.session.query(Recipe.product_id, func.max(Recipe.updated_at)).filter(
+        Recipe.product_id.in_(product_ids)
+    ).group_by(Recipe.product_id).union_all(
+        db.session.query(ProductComponent.product_id, func.max(ProductComponent.updated_at)).filter(
+            ProductComponent.product_id.in_(product_ids)
+        ).group_by(ProductComponent.product_id)
+    ):
+        if updated_at and (product_id not in changed or updated_at > changed[product_id]):
+            changed[product_id] = updated_at
+    return changed
+
+
+def apply_material_price(material_id: int, new_price: float) -> Tuple[Dict, List[int]]:
+    """Change a material price and stage CostAnalysis snapshots of the affected products.
+
+    Only products whose recipes use the material, directly or through
+    intermediate products, are touched. Their latest stored cost is adjusted
+    by quantity x price delta (plus overhead) and saved as new snapshots in
+    one bulk insert. Affected products without a stored cost, or whose stored
+    cost predates a change to their recipe, are costed from scratch with the
+    batch engine. Nothing is committed; returns the result and the affected
+    product ids.
+    """
+    material = RawMaterial.query.get_or_404(material_id)
+    delta_price = new_price - material.current_price
+    usages = material_usage_index.usages(material.id)
+
+    material.current_price = new_price
+    material.last_updated = datetime.utcnow()
+    record_material_prices([material])
+
+    product_ids = list(usages)
+    products = {p.id: p for p in Product.query.filter(Product.id.in_(product_ids))} if product_ids else {}
+    changed_at = costing_inputs_changed_at(products)
+    stored = {
+        product_id: analysis for product_id, analysis in latest_cost_analyses(product_ids).items()
+        if product_id not in changed_at or (analysis.calculated_at and analysis.calculated_at >= changed_at[product_id])
+    }
+    now = datetime.utcnow()
+
+    snapshots = []
+    for product_id, analysis in stored.items():
+        product = products[product_id]
+        material_delta = usages[product_id] * analysis.batch_size * delta_price
+        material_cost = analysis.material_cost + material_delta
+        overhead_cost = analysis.overhead_cost + material_delta * (product.overhead_percentage / 100)
+        total_cost = material_cost + analysis.labor_cost + overhead_cost + analysis.packaging_cost
+        snapshots.append({
+            'product_id': product_id,
+            'batch_size': analysis.batch_size,
+            'material_cost': material_cost,
+            'labor_cost': analysis.labor_cost,
+            'overhead_cost': overhead_cost,
+            'packaging_cost': analysis.packaging_cost,
+            'total_cost': total_cost,
+            'recommended_price': total_cost * (1 + product.profit_margin_percentage / 100),
+            'calculated_at': now
+        })
+
+    missing_ids = [product_id for product_id in product_ids if product_id not in stored]
+    if missing_ids:
+        db.session.flush()
+        for result in calculate_batch_costs(missing_ids, include_details=False):
+            cost_data = result['cost_data']
+            snapshots.append({
+                'product_id': result['product_id'],
+                'batch_size': cost_data['batch_size'],
+                'material_cost': cost_data['material_cost'],
+                'labor_cost': cost_data['labor_cost'],
+                'overhead_cost': cost_data['overhead_cost'],
+                'packaging_cost': cost_data['packaging_cost'],
+                'total_cost': cost_data['total_cost'],
+                'recommended_price': cost_data['recommended_price'],
+                'calculated_at': now
+            })
+
+    db.session.bulk_insert_mappings(CostAnalysis, snapshots)
+
+    return {
+        'material_id': material.id,
+        'price': new_price,
+        'delta': delta_price,
+        'affected_products': len(product_ids),
+        'snapshots_created': len(snapshots)
+    }, product_ids
+
+
+def update_material_prices(updates: List[Tuple[int, float]]) -> List[Dict]:
+    """Apply several material price changes and their snapshots in one transaction"""
+    results = []
+    affected = set()
+    try:
+        for material_id, new_price in updates:
+            result, product_ids = apply_material_price(material_id, new_price)
+            results.append(result)
+            affected.update(product_ids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    dashboard_cache.invalidate()
+    for product_id in affected:
+        cost_cache.invalidate_product(product_id)
+    return results
+
+
+def update_material_price(material_id: int, new_price: float) -> Dict:
+    """Change one material price and propagate the delta to affected products"""
+    return update_material_prices([(material_id, new_price)])[0]
+
+
+# Cost analysis retention
+COST_ANALYSIS_VALUE_FIELDS = ('material_cost', 'labor_cost', 'overhead_cost', 'packaging_cost',
+                              'total_cost', 'recommended_price')
+COST_ANALYSIS_ARCHIVE_FIELDS = ('id', 'product_id', 'batch_size') + COST_ANALYSIS_VALUE_FIELDS + ('calculated_at',)
+
+
+def repeats_cost_analysis(latest: Optional[CostAnalysis], batch_size: float, cost_data: Dict) -> bool:
+    """Whether a cost would only repeat the product's latest stored analysis"""
+    return latest is not None and latest.batch_size == batch_size and all(
+        getattr(latest, field) == cost_data[field] for field in COST_ANALYSIS_VALUE_FIELDS
+    )
+
+
+def save_cost_analysis(product_id: int, batch_size: float, cost_data: Dict) -> Tuple[int, bool]:
+    """Store a CostAnalysis unless it repeats the product's latest one.
+
+    Returns the id of the stored (or repeated) analysis and whether a row
+    was added.
+    """
+    latest = CostAnalysis.query.filter(CostAnalysis.product_id == product_id).order_by(
+        CostAnalysis.calculated_at.desc(), CostAnalysis.id.desc()
+    ).first()
+    if repeats_cost_analysis(latest, batch_size, cost_data):
+        return latest.id, False
+
+    row = dict(product_id=product_id, batch_size=batch_size, calculated_at=datetime.utcnow(),
+               **{field: cost_data[field] for field in COST_ANALYSIS_VALUE_FIELDS})
+    analysis_id = run_write(
+        lambda: db.session.execute(CostAnalysis.__table__.insert(), row).inserted_primary_key[0]
+    )
+    dashboard_cache.invalidate()
+    return analysis_id, True
+
+
+def compact_cost_analyses(hot_days: Optional[int] = None, chunk_size: int = 5000) -> Dict:
+    """Archive CostAnalysis rows older than the hot window.
+
+    Cold rows are streamed in id order to a gzip CSV under the archive
+    directory, folded into per-product daily summaries and then deleted, so
+    the hot table only holds recent full-resolution data. The cutoff is
+    aligned to midnight so a day is always summarized in one run.
+    """
+    hot_days = app.config['COST_ANALYSIS_HOT_DAYS'] if hot_days is None else hot_days
+    cutoff = datetime.combine(datetime.utcnow().date() - timedelta(days=hot_days), datetime.min.time())
+
+    archive_dir = app.config['COST_ANALYSIS_ARCHIVE_DIR']
+    os.makedirs(archive_dir, exist_ok=True)
+    archive_path = os.path.join(archive_dir, f"cost_analysis_{datetime.utcnow():%Y%m%d%H%M%S}.csv.gz")
+
+    summaries = {}
+    archived = 0
+    last_id = 0
+    columns = [getattr(CostAnalysis, field) for field in COST_ANALYSIS_ARCHIVE_FIELDS]
+    # The archive only takes its final name once the rows it holds are deleted
+    partial_path = archive_path + '.part'
+    try:
+        with gzip.open(partial_path, 'wt', newline='') as archive:
+            writer = csv.writer(archive)
+            writer.writerow(COST_ANALYSIS_ARCHIVE_FIELDS)
+            while True:
+                rows = db.session.query(*columns).filter(
+                    CostAnalysis.id > last_id, CostAnalysis.calculated_at < cutoff
+                ).order_by(CostAnalysis.id).limit(chunk_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                archived += len(rows)
+
+                for row in rows:
+                    writer.writerow([row.calculated_at.isoformat() if field == 'calculated_at' else getattr(row, field)
+                                     for field in COST_ANALYSIS_ARCHIVE_FIELDS])
+                    key = (row.product_id, row.calculated_at.date())
+                    summary = summaries.get(key)
+                    if summary is None:
+                        summaries[key] = summary = {
+                            'product_id': row.product_id, 'day': key[1], 'analysis_count': 0,
+                            'min_total_cost': row.total_cost, 'max_total_cost': row.total_cost,
+                            'total_cost_sum': 0.0, 'recommended_price_sum': 0.0,
+                            'last_calculated_at': row.calculated_at
+                        }
+                    summary['analysis_count'] += 1
+                    summary['min_total_cost'] = min(summary['min_total_cost'], row.total_cost)
+                    summary['max_total_cost'] = max(summary['max_total_cost'], row.total_cost)
+                    summary['total_cost_sum'] += row.total_cost
+                    summary['recommended_price_sum'] += row.recommended_price
+                    if row.calculated_at >= summary['last_calculated_at']:
+                        summary.update(last_calculated_at=row.calculated_at, last_batch_size=row.batch_size,
+                                       last_total_cost=row.total_cost, last_recommended_price=row.recommended_price)
+
+        if not archived:
+            os.remove(partial_path)
+            return {'archived': 0, 'summaries': 0, 'archive': None, 'cutoff': cutoff.isoformat()}
+
+        table = CostAnalysisDaily.__table__
+        insert = sqlite_insert(table)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=['product_id', 'day'],
+            set_={
+                'analysis_count': table.c.analysis_count + insert.excluded.analysis_count,
+                'min_total_cost': func.min(table.c.min_total_cost, insert.excluded.min_total_cost),
+                'max_total_cost': func.max(table.c.max_total_cost, insert.excluded.max_total_cost),
+                'total_cost_sum': table.c.total_cost_sum + insert.excluded.total_cost_sum,
+                'recommended_price_sum': table.c.recommended_price_sum + insert.excluded.recommended_price_sum,
+                'last_batch_size': case((insert.excluded.last_calculated_at >= table.c.last_calculated_at,
+                                         insert.excluded.last_batch_size), else_=table.c.last_batch_size),
+                'last_total_cost': case((insert.excluded.last_calculated_at >= table.c.last_calculated_at,
+                                         insert.excluded.last_total_cost), else_=table.c.last_total_cost),
+                'last_recommended_price': case((insert.excluded.last_calculated_at >= table.c.last_calculated_at,
+                                                insert.excluded.last_recommended_price),
+                                               else_=table.c.last_recommended_price),
+                'last_calculated_at': func.max(table.c.last_calculated_at, insert.excluded.last_calculated_at)
+            }
+        ), list(summaries.values()))
+
+        CostAnalysis.query.filter(
+            CostAnalysis.id <= last_id, CostAnalysis.calculated_at < cutoff
+        ).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, archive_path)
+    dashboard_cache.invalidate()
+
+    return {
+        'archived': archived,
+        'summaries': len(summaries),
+        'archive': archive_path,
+        'cutoff': cutoff.isoformat()
+    }
+
+
+def run_retention_job(payload: Dict) -> Dict:
+    """Compact cold CostAnalysis rows in the background"""
+    return compact_cost_analyses(payload.get('hot_days'))
+
+
+# Catalog import/export
+CATALOG_IMPORT_CHUNK_SIZE = 1000
+CATALOG_MAX_REPORTED_ERRORS = 100
+CATALOG_FORMATS = ('csv', 'jsonl')
+
+# Field name -> (type, required) for each importable entity, in export column order
+CATALOG_FIELDS = {
+    'materials': {
+        'name': (str, True), 'unit': (str, True), 'current_price': (float, True),
+        'stock_quantity': (float, False), 'minimum_stock': (float, False), 'supplier': (str, False)
+    },
+    'products': {
+        'name': (str, True), 'category': (str, False), 'batch_size': (float, True),
+        'labor_cost_per_batch': (float, False), 'overhead_percentage': (float, False),
+        'packaging_cost': (float, False), 'profit_margin_percentage': (float, False)
+    },
+    'recipes': {
+        'product': (str, True), 'material': (str, True), 'quantity_per_batch': (float, False),
+        'percentage_value': (float, False), 'notes': (str, False)
+    }
+}
+
+
+def percentage_recipe_quantity(percentage: float, batch_size: float, unit: str,
+                               category: Optional[str] = None) -> float:
+    """Absolute batch quantity of a percentage-based recipe line"""
+    if unit == 'kg':
+        # Assume 20g per unit for powders and 1kg per litre for liquids
+        batch_weight = batch_size * (1.0 if category and 'Liquid' in category else 0.02)
+        return percentage / 100 * batch_weight
+    if unit == 'L':
+        return percentage / 100 * batch_size * 0.001
+    return percentage / 100 * batch_size
+
+
+def catalog_format(filename: Optional[str], mimetype: Optional[str] = None) -> Optional[str]:
+    """Guess csv or jsonl from a file name (optionally .gz) or a mimetype"""
+    name = (filename or '').lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith('.csv') or mimetype == 'text/csv':
+        return 'csv'
+    if name.endswith(('.jsonl', '.ndjson')) or mimetype in ('application/x-ndjson', 'application/jsonl'):
+        return 'jsonl'
+    return None
+
+
+def open_catalog_file(path: str, mode: str = 'r'):
+    """Open a catalog file as text, transparently (de)compressing .gz files"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def read_catalog_rows(stream, fmt: str) -> Iterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """Yield (line number, raw row, parse error) from a CSV or JSON-lines text stream"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row, None
+        return
+
+    for line_num, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_num, None, 'invalid JSON'
+            continue
+        if isinstance(row, dict):
+            yield line_num, row, None
+        else:
+            yield line_num, None, 'expected a JSON object'
+
+
+def validate_catalog_row(entity: str, row: Dict) -> Dict:
+    """Typed values of the known fields present in a row; raises ValueError"""
+    values = {}
+    for field, (field_type, required) in CATALOG_FIELDS[entity].items():
+        value = row.get(field)
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == '':
+            if required:
+                raise ValueError(f'{field} is required')
+            continue
+        if field_type is float:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f'{field} must be a number')
+            if not np.isfinite(value) or value < 0:
+                raise ValueError(f'{field} must be a non-negative number')
+        else:
+            value = str(value)
+        values[field] = value
+
+    if entity == 'recipes' and 'quantity_per_batch' not in values and 'percentage_value' not in values:
+        raise ValueError('quantity_per_batch or percentage_value is required')
+    if entity == 'products' and values['batch_size'] == 0:
+        raise ValueError('batch_size must be positive')
+    return values
+
+
+def executemany_by_shape(statement_for, rows: List[Dict]):
+    """executemany rows grouped by their key set, as each statement binds one shape"""
+    shapes = {}
+    for row in rows:
+        shapes.setdefault(tuple(sorted(row)), []).append(row)
+    for keys, group in shapes.items():
+        db.session.execute(statement_for(keys), group)
+
+
+class CatalogImporter:
+    """Upserts validated catalog rows in chunked transactions.
+
+    Materials and products are matched on name, recipe lines on their
+    product and material, through in-memory name indexes built once per
+    import. Each chunk is written with one executemany per row shape and
+    committed on its own; invalid rows are reported and skipped, and a chunk
+    the database rejects is rolled back without aborting the import.
+    """
+
+    def __init__(self, entity: str, chunk_size: int = CATALOG_IMPORT_CHUNK_SIZE,
+                 max_errors: int = CATALOG_MAX_REPORTED_ERRORS):
+        if entity not in CATALOG_FIELDS:
+            raise ValueError(f'Unknown catalog entity: {entity}')
+        self.entity = entity
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.inserted = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = []
+        self._materials = None  # name -> [id, unit, current_price]
+        self._products = None  # name -> [id, batch_size, category]
+
+    def material_index(self) -> Dict[str, list]:
+        if self._materials is None:
+            self._materials = {}
+            rows = db.session.query(RawMaterial.name, RawMaterial.id, RawMaterial.unit, RawMaterial.current_price)
+            for name, material_id, unit, price in rows.order_by(RawMaterial.id):
+                self._materials.setdefault(name, [material_id, unit, price])
+        return self._materials
+
+    def product_index(self) -> Dict[str, list]:
+        if self._products is None:
+            self._products = {}
+            rows = db.session.query(Product.name, Product.id, Product.batch_size, Product.category)
+            for name, product_id, batch_size, category in rows.order_by(Product.id):
+                self._products.setdefault(name, [product_id, batch_size, category])
+        return self._products
+
+    def error(self, line: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'error': message})
+
+    def run(self, rows: Iterable[Tuple[int, Optional[Dict], Optional[str]]]) -> Dict:
+        chunk = []
+        for line, row, error in rows:
+            if error is None:
+                try:
+                    chunk.append((line, validate_catalog_row(self.entity, row)))
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                self.error(line, error)
+            if len(chunk) >= self.chunk_size:
+                self._flush(chunk)
+                chunk = []
+        if chunk:
+            self._flush(chunk)
+
+        if self.inserted or self.updated:
+            cost_cache.clear()
+            cost_matrix_cache.invalidate()
+            material_usage_index.invalidate()
+            dashboard_cache.invalidate()
+        return self.stats()
+
+    def _flush(self, chunk: List[Tuple[int, Dict]]):
+        upsert = getattr(self, f'_upsert_{self.entity}')
+        try:
+            inserted, updated = upsert(chunk)
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            # The indexes may hold ids assigned inside the rolled back transaction
+            self._materials = self._products = None
+            self.error(chunk[0][0], f'lines {chunk[0][0]}-{chunk[-1][0]} not imported: {e.__class__.__name__}')
+            self.error_count += len(chunk) - 1
+            return
+        self.inserted += inserted
+        self.updated += updated
+
+    @staticmethod
+    def _split_by_name(chunk: List[Tuple[int, Dict]], index: Dict[str, list]):
+        rows = {}
+        for _, values in chunk:
+            rows[values['name']] = values  # the last row for a name wins
+        inserts = [values for name, values in rows.items() if name not in index]
+        updates = [dict(values, _id=index[name][0]) for name, values in rows.items() if name in index]
+        return inserts, updates
+
+    @staticmethod
+    def _update_by_id(table):
+        return lambda keys: table.update().where(table.c.id == bindparam('_id')).values(
+            {key: bindparam(key) for key in keys if key != '_id'}
+        )
+
+    @staticmethod
+    def _new_ids(model, names: List[str]) -> Dict[str, int]:
+        found = {}
+        for start in range(0, len(names), 500):
+            for name, row_id in db.session.query(model.name, model.id).filter(
+                model.name.in_(names[start:start + 500])
+            ).order_by(model.id):
+                found.setdefault(name, row_id)
+        return found
+
+    def _upsert_materials(self, chunk: List[Tuple[int, Dict]]) -> Tuple[int, int]:
+        index = self.material_index()
+        inserts, updates = self._split_by_name(chunk, index)
+        table = RawMaterial.__table__
+        now = datetime.utcnow()
+
+        changed = [values for values in updates
+                   if 'current_price' in values and values['current_price'] != index[values['name']][2]]
+        executemany_by_shape(lambda keys: table.insert(), inserts)
+        executemany_by_shape(self._update_by_id(table), updates)
+
+        for name, material_id in self._new_ids(RawMaterial, [values['name'] for values in inserts]).items():
+            index[name] = [material_id, None, None]
+        for values in inserts + updates:
+            entry = index[values['name']]
+            entry[1] = values.get('unit', entry[1])
+            entry[2] = values.get('current_price', entry[2])
+
+        record_price_points('material', [{
+            'key': material_series_key(index[values['name']][0]),
+            'name': values['name'],
+            'price': values['current_price'],
+            'recorded_at': now
+        } for values in inserts + changed])
+        return len(inserts), len(updates)
+
+    def _upsert_products(self, chunk: List[Tuple[int, Dict]]) -> Tuple[int, int]:
+        index = self.product_index()
+        inserts, updates = self._split_by_name(chunk, index)
+        table = Product.__table__
+
+        executemany_by_shape(lambda keys: table.insert(), inserts)
+        executemany_by_shape(self._update_by_id(table), updates)
+
+        for name, product_id in self._new_ids(Product, [values['name'] for values in inserts]).items():
+            index[name] = [product_id, None, None]
+        for values in inserts + updates:
+            entry = index[values['name']]
+            entry[1] = values.get('batch_size', entry[1])
+            entry[2] = values.get('category', entry[2])
+        return len(inserts), len(updates)
+
+    def _upsert_recipes(self, chunk: List[Tuple[int, Dict]]) -> Tuple[int, int]:
+        products = self.product_index()
+        materials = self.material_index()
+
+        rows = {}
+        for line, values in chunk:
+            product = products.get(values['product'])
+            material = materials.get(values['material'])
+            if product is None:
+                self.error(line, f"unknown product: {values['product']}")
+                continue
+            if material is None:
+                self.error(line, f"unknown material: {values['material']}")
+                continue
+
+            percentage = values.get('percentage_value')
+            quantity = values.get('quantity_per_batch')
+            if quantity is None:
+                quantity = percentage_recipe_quantity(percentage, product[1], material[1], product[2])
+            row = {
+                'product_id': product[0],
+                'material_id': material[0],
+                'quantity_per_batch': quantity,
+                'is_percentage_based': percentage is not None,
+                'percentage_value': percentage
+            }
+            if 'notes' in values:
+                row['notes'] = values['notes']
+            rows[(product[0], material[0])] = row  # the last line for a pair wins
+
+        existing = set()
+        product_ids = sorted({product_id for product_id, _ in rows})
+        for start in range(0, len(product_ids), 500):
+            existing.update(db.session.query(Recipe.product_id, Recipe.material_id).filter(
+                Recipe.product_id.in_(product_ids[start:start + 500])
+            ))
+
+        # The lookup only splits the counts, the writes themselves are upserts
+        now = datetime.utcnow()
+        executemany_by_shape(recipe_upsert_statement,
+                             [dict(row, created_at=now, updated_at=now) for row in rows.values()])
+        updated = len(existing.intersection(rows))
+        return len(rows) - updated, updated
+
+    def stats(self) -> Dict:
+        return {'inserted': self.inserted, 'updated': self.updated,
+                'error_count': self.error_count, 'errors': self.errors}
+
+
+def export_catalog_rows(entity: str, batch_size: int = 1000) -> Iterator[Dict]:
+    """Stream catalog rows in import format without loading the table"""
+    if entity == 'materials':
+        query = db.session.query(
+            RawMaterial.name, RawMaterial.unit, RawMaterial.current_price, RawMaterial.stock_quantity,
+            RawMaterial.minimum_stock, RawMaterial.supplier
+        ).order_by(RawMaterial.id)
+    elif entity == 'products':
+        query = db.session.query(
+            Product.name, Product.category, Product.batch_size, Product.labor_cost_per_batch,
+            Product.overhead_percentage, Product.packaging_cost, Product.profit_margin_percentage
+        ).order_by(Product.id)
+    elif entity == 'recipes':
+        query = db.session.query(
+            Product.name.label('product'), RawMaterial.name.label('material'), Recipe.quantity_per_batch,
+            Recipe.percentage_value, Recipe.notes
+        ).join(Product, Product.id == Recipe.product_id).join(
+            RawMaterial, RawMaterial.id == Recipe.material_id
+        ).order_by(Recipe.product_id, Recipe.id)
+    else:
+        raise ValueError(f'Unknown catalog entity: {entity}')
+
+    for row in query.yield_per(batch_size):
+        yield row._asdict()
+
+
+def format_catalog_rows(entity: str, rows: Iterable[Dict], fmt: str,
+                        buffer_size: int = 64 * 1024) -> Iterator[str]:
+    """Serialize rows as CSV or JSON lines, yielding text in buffered blocks"""
+    buffer = io.StringIO()
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(buffer, fieldnames=list(CATALOG_FIELDS[entity]))
+        writer.writeheader()
+
+    for row in rows:
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row) + '\n')
+        if buffer.tell() >= buffer_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+# Background jobs
+JOB_INSERT_CHUNK_SIZE = 500
+
+
+def enqueue_job(kind: str, payload: Dict) -> Job:
+    """Persist a job for the worker pool and return it immediately"""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    job = Job(kind=kind, payload=json.dumps(payload))
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def queued_job_response(job: Job):
+    """JSON reply for a queued job, pointing at its status endpoint"""
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': url_for('api_job_status', job_id=job.id)
+    })
+
+
+def claim_next_job() -> Optional[Job]:
+    """Atomically move the oldest queued job to running"""
+    while True:
+        job_id = db.session.query(Job.id).filter(Job.status == 'queued').order_by(Job.id).limit(1).scalar()
+        if job_id is None:
+            return None
+
+        claimed = Job.query.filter(Job.id == job_id, Job.status == 'queued').update({
+            'status': 'running',
+            'started_at': datetime.utcnow(),
+            'attempts': Job.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+
+
+def requeue_stale_jobs(stale_after: timedelta) -> int:
+    """Put back jobs left running by a worker that died"""
+    requeued = Job.query.filter(
+        Job.status == 'running',
+        Job.started_at < datetime.utcnow() - stale_after
+    ).update({'status': 'queued'}, synchronize_session=False)
+    db.session.commit()
+    return requeued
+
 
-        db.session.commit()
+def run_scrape_job(payload: Dict) -> Dict:
+    """Scrape search terms and ingest the results into MarketPrice"""
+    scraper = make_scraper()
+    results = scraper.scrape_jumia_bulk(payload.get('search_terms', []),
+                                        max_pages=int(payload.get('max_pages', 3)))
+    return ingest_market_prices(results, JOB_INSERT_CHUNK_SIZE)
+
+
+def run_costing_job(payload: Dict) -> Dict:
+    """Cost products with the batch engine and bulk insert CostAnalysis rows.
+
+    Like save_cost_analysis, a cost that repeats the product's latest stored
+    analysis is not stored again.
+    """
+    results = calculate_batch_costs(payload.get('product_ids'), payload.get('batch_sizes'),
+                                    include_details=False)
+    latest = latest_cost_analyses(list({result['product_id'] for result in results}))
+    now = datetime.utcnow()
+
+    rows = [{
+        'product_id': result['product_id'],
+        'batch_size': result['cost_data']['batch_size'],
+        'material_cost': result['cost_data']['material_cost'],
+        'labor_cost': result['cost_data']['labor_cost'],
+        'overhead_cost': result['cost_data']['overhead_cost'],
+        'packaging_cost': result['cost_data']['packaging_cost'],
+        'total_cost': result['cost_data']['total_cost'],
+        'recommended_price': result['cost_data']['recommended_price'],
+        'calculated_at': now
+    } for result in results if not repeats_cost_analysis(
+        latest.get(result['product_id']), result['cost_data']['batch_size'], result['cost_data']
+    )]
+    for start in range(0, len(rows), JOB_INSERT_CHUNK_SIZE):
+        db.session.bulk_insert_mappings(CostAnalysis, rows[start:start + JOB_INSERT_CHUNK_SIZE])
+    db.session.commit()
+    dashboard_cache.invalidate()
+
+    return {'count': len(results), 'saved': len(rows), 'results': results}
+
+
+JOB_HANDLERS = {
+    'scrape': run_scrape_job,
+    'costing': run_costing_job,
+    'retention': run_retention_job,
+}
+
+
+def execute_job(job: Job):
+    """Run a claimed job and record its outcome"""
+    job_id = job.id
+    try:
+        result = JOB_HANDLERS[job.kind](json.loads(job.payload or '{}'))
+        job = db.session.get(Job, job_id)
+        job.status = 'completed'
+        job.result = json.dumps(result)
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.status = 'failed'
+        job.error = str(e)
+
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def job_worker_loop(poll_interval: float, max_jobs: Optional[int] = None):
+    """Claim and execute jobs until max_jobs have run (forever by default)"""
+    with app.app_context():
+        # Never share pooled connections inherited from the parent process
+        db.engine.dispose()
+
+    processed = 0
+    while max_jobs is None or processed < max_jobs:
+        with app.app_context():
+            job = claim_next_job()
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+            execute_job(job)
+        processed += 1
+
+
+@app.route('/cost-analysis')
+def cost_analysis():
+    products = Product.query.all()
+    return render_template('cost_analysis.html', products=products)
+
+
+@app.route('/api/calculate-cost', methods=['POST'])
+def api_calculate_cost():
+    """Cost one product, or queue it as a costing job when ``async`` is true.
+
+    Only the synchronous reply carries the material breakdown and stock
+    check. Historical ``as_of`` costing is always answered directly since
+    it saves nothing.
+    """
+    data = request.json
+    product_id = data.get('product_id')
+    batch_size = data.get('batch_size')
+    as_of = data.get('as_of')
+
+    try:
+        if data.get('async') and not as_of:
+            Product.query.get_or_404(product_id)
+            return queued_job_response(enqueue_job('costing', {
+                'product_ids': [product_id],
+                'batch_sizes': [float(batch_size)] if batch_size else None
+            }))
+
+        if as_of:
+            # Historical what-if costing is neither cached nor saved
+            cost_data = calculate_product_cost(product_id, batch_size, parse_as_of(as_of))
+            stock_data = check_stock_availability(product_id, batch_size)
+            return jsonify({
+                'success': True,
+                'as_of': as_of,
+                'cost_data': {key: value for key, value in cost_data.items() if key != 'product'},
+                'stock_data': stock_data
+            })
+
+        cost_data = get_cached_product_cost(product_id, batch_size)
+        stock_data = check_stock_availability(product_id, batch_size)
+
+        # Save analysis, skipping exact repeats of the product's latest one
+        save_cost_analysis(product_id, batch_size, cost_data)
+
+        return jsonify({
+            'success': True,
+            'cost_data': {
+                'material_cost': cost_data['material_cost'],
+                'labor_cost': cost_data['labor_cost'],
+                'overhead_cost': cost_data['overhead_cost'],
+                'packaging_cost': cost_data['packaging_cost'],
+                'total_cost': cost_data['total_cost'],
+                'recommended_price': cost_data['recommended_price'],
+                'cost_per_unit': cost_data['cost_per_unit'],
+                'price_per_unit': cost_data['price_per_unit'],
+                'material_details': cost_data['material_details']
+            },
+            'stock_data': stock_data
+        })
+
+    except NotFound as e:
+        return jsonify({'success': False, 'error': e.description}), 404
+    except ServiceUnavailable as e:
+        return jsonify({'success': False, 'error': e.description}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/calculate-cost/batch', methods=['POST'])
+def api_calculate_cost_batch():
+    data = request.json or {}
+    product_ids = data.get('product_ids')
+    batch_sizes = data.get('batch_sizes')
+    include_details = data.get('include_details', True)
+
+    try:
+        results = calculate_batch_costs(product_ids, batch_sizes, include_details)
+
+        return jsonify({
+            'success': True,
+            'results': results,
+            'count': len(results)
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/market-intelligence')
+def market_intelligence():
+    try:
+        filters = parse_market_filters(request.args)
+        market_data, next_cursor = query_market_prices(
+            filters, request.args.get('cursor'), request.args.get('limit', MARKET_PAGE_SIZE, type=int)
+        )
+    except ValueError:
+        flash('Invalid market data filters', 'error')
+        filters = parse_market_filters({})
+        market_data, next_cursor = query_market_prices(filters)
+
+    competitors = [name for name, in db.session.query(MarketPrice.competitor).filter(
+        MarketPrice.competitor.isnot(None)
+    ).distinct().order_by(MarketPrice.competitor)]
+
+    filter_args = {key: value for key, value in request.args.items() if key != 'cursor' and value}
+    return render_template('market_intelligence.html',
+                           market_data=market_data,
+                           next_cursor=next_cursor,
+                           competitors=competitors,
+                           filter_args=filter_args)
+
+
+@app.route('/api/market-prices')
+def api_market_prices():
+    try:
+        filters = parse_market_filters(request.args)
+        market_data, next_cursor = query_market_prices(
+            filters, request.args.get('cursor'), request.args.get('limit', MARKET_PAGE_SIZE, type=int)
+        )
+
+        return jsonify({
+            'success': True,
+            'market_data': [{
+                'id': mp.id,
+                'name': mp.product_name,
+                'price': mp.price,
+                'competitor': mp.competitor,
+                'size_info': mp.size_info,
+                'url': mp.url,
+                'scraped_at': mp.scraped_at.strftime('%Y-%m-%d %H:%M')
+            } for mp in market_data],
+            'count': len(market_data),
+            'next_cursor': next_cursor
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/scrape-prices', methods=['POST'])
+def api_scrape_prices():
+    """Scrape one search term, or queue it as a scrape job when ``async`` is true"""
+    data = request.json
+    search_term = data.get('search_term', '')
+
+    if not search_term:
+        return jsonify({'success': False, 'error': 'Search term is required'})
+
+    try:
+        if data.get('async'):
+            return queued_job_response(enqueue_job('scrape', {'search_terms': [search_term], 'max_pages': 1}))
+
+        scraper = make_scraper()
+        results = scraper.scrape_jumia_prices(search_term)
+
+        # Save to database, skipping listings whose price has not changed
+        ingestion = ingest_market_prices(results)
+
+        return jsonify({
+            'success': True,
+            'results': results,
+            'count': len(results),
+            'inserted': ingestion['inserted'],
+            'skipped': ingestion['skipped']
+        })
+
+    except ServiceUnavailable as e:
+        return jsonify({'success': False, 'error': e.description}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/material-prices', methods=['POST'])
+def api_update_material_prices():
+    data = request.json or {}
+    updates = data.get('updates', [])
+
+    if not updates:
+        return jsonify({'success': False, 'error': 'At least one price update is required'})
+
+    try:
+        # All or nothing: a bad update rolls back the ones before it
+        results = update_material_prices([
+            (int(update['material_id']), float(update['price'])) for update in updates
+        ])
 
         return jsonify({
             'success': True,
@@ -508,10 +4508,265 @@ def api_scrape_prices():
             'count': len(results)
         })
 
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/products/<int:product_id>/recipe', methods=['PUT'])
+def api_replace_recipe(product_id):
+    """Replace a product's formulation with the posted lines in one transaction.
+
+    ``items`` are the raw material lines; ``components``, when given, replace
+    the intermediate products as well.
+    """
+    product = Product.query.get_or_404(product_id)
+    data = request.json or {}
+    items = data.get('items', [])
+
+    try:
+        material_ids = {int(item['material_id']) for item in items}
+        units = dict(db.session.query(RawMaterial.id, RawMaterial.unit).filter(RawMaterial.id.in_(material_ids)))
+        unknown = sorted(material_ids - set(units))
+        if unknown:
+            return jsonify({'success': False, 'error': f'Unknown material ids: {unknown}'})
+
+        lines = []
+        for item in items:
+            percentage = item.get('percentage_value')
+            quantity = item.get('quantity_per_batch')
+            if quantity is None:
+                if percentage is None:
+                    return jsonify({'success': False,
+                                    'error': 'Each line needs quantity_per_batch or percentage_value'})
+                quantity = percentage_recipe_quantity(float(percentage), product.batch_size,
+                                                      units[int(item['material_id'])], product.category)
+            lines.append(dict(item, quantity_per_batch=quantity, is_percentage_based=percentage is not None,
+                              percentage_value=float(percentage) if percentage is not None else None))
+
+        result = replace_product_recipe(product_id, lines)
+        if 'components' in data:
+            result.update(replace_product_components(product_id, data['components']))
+        db.session.commit()
+        invalidate_product_costs(product_id)
+        material_usage_index.invalidate()
+
+        return jsonify({'success': True, **result})
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/production-plan', methods=['POST'])
+def api_production_plan():
+    data = request.json or {}
+    orders = data.get('orders', [])
+
+    if not orders:
+        return jsonify({'success': False, 'error': 'At least one order is required'})
+
+    try:
+        return jsonify(dict(plan_production(orders), success=True))
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/production-mix', methods=['POST'])
+def api_production_mix():
+    data = request.json or {}
+
+    try:
+        result = optimize_production_mix(data.get('product_ids'), data.get('max_batches'),
+                                         data.get('solver', 'auto'))
+        return jsonify(dict(result, success=True))
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/production-mix/stats')
+def api_production_mix_stats():
+    return jsonify({'success': True, 'stats': optimizer_metrics})
+
+
+@app.route('/api/price-simulation', methods=['POST'])
+def api_price_simulation():
+    data = request.json or {}
+
+    try:
+        result = simulate_price_sensitivity(
+            volatility=data.get('volatility'),
+            default_volatility=float(data.get('default_volatility', 0.1)),
+            scenarios=int(data.get('scenarios', 10000)),
+            product_ids=data.get('product_ids'),
+            percentiles=data.get('percentiles', (5, 25, 50, 75, 95)),
+            seed=data.get('seed'),
+            history_days=int(data['history_days']) if data.get('history_days') is not None else None,
+            horizon_days=int(data.get('horizon_days', 30))
+        )
+        return jsonify(dict(result, success=True))
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/price-series')
+def api_price_series():
+    query = PriceSeries.query
+    if request.args.get('kind'):
+        query = query.filter(PriceSeries.kind == request.args['kind'])
+    if request.args.get('key'):
+        query = query.filter(PriceSeries.key == request.args['key'])
+    if request.args.get('q'):
+        query = query.filter(PriceSeries.name.contains(request.args['q']))
+    series = query.order_by(PriceSeries.id).limit(request.args.get('limit', 100, type=int)).all()
+
+    return jsonify({
+        'success': True,
+        'series': [{'id': s.id, 'kind': s.kind, 'key': s.key, 'name': s.name} for s in series]
+    })
+
+
+@app.route('/api/price-series/<int:series_id>/trend')
+def api_price_trend(series_id):
+    try:
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else None
+        trend = get_price_trend(series_id, request.args.get('period', 'day'), start, end)
+        return jsonify({'success': True, 'series_id': series_id, 'trend': trend})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/price-series/<int:series_id>/as-of')
+def api_price_as_of(series_id):
+    try:
+        as_of = parse_as_of(request.args['date'])
+        price = prices_as_of([series_id], as_of).get(series_id)
+        return jsonify({'success': True, 'series_id': series_id, 'as_of': as_of.isoformat(), 'price': price})
+
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 
+@app.route('/api/jobs', methods=['POST'])
+def api_enqueue_job():
+    data = request.json or {}
+    kind = data.get('kind')
+    payload = data.get('payload', {})
+
+    if kind == 'scrape' and not payload.get('search_terms'):
+        return jsonify({'success': False, 'error': 'At least one search term is required'})
+
+    try:
+        return queued_job_response(enqueue_job(kind, payload))
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/jobs/<int:job_id>')
+def api_job_status(job_id):
+    job = Job.query.get_or_404(job_id)
+    include_result = request.args.get('include_result', '1') != '0'
+    return jsonify({'success': True, 'job': job.to_dict(include_result)})
+
+
+@app.route('/api/cost-cache/stats')
+def api_cost_cache_stats():
+    return jsonify({'success': True, 'stats': cost_cache.stats()})
+
+
+@app.route('/api/scraper-cache/stats')
+def api_scraper_cache_stats():
+    if response_cache is None:
+        return jsonify({'success': True, 'enabled': False})
+    return jsonify({'success': True, 'enabled': True, 'stats': response_cache.stats()})
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics.enabled:
+        return Response('metrics are disabled\n', status=404, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/metrics/slow-queries')
+def api_slow_queries():
+    return jsonify({'success': True, 'threshold': app.config['SLOW_QUERY_THRESHOLD'],
+                    'slow_queries': list(metrics.slow_queries)})
+
+
+@app.route('/api/scrape-prices/bulk', methods=['POST'])
+def api_scrape_prices_bulk():
+    data = request.json or {}
+    search_terms = data.get('search_terms', [])
+    max_pages = int(data.get('max_pages', 3))
+
+    if not search_terms:
+        return jsonify({'success': False, 'error': 'At least one search term is required'})
+
+    scraper = make_scraper()
+
+    def generate():
+        ingestor = MarketPriceIngestor(chunk_size=50)
+        count = 0
+        for result in scraper.scrape_jumia_bulk(search_terms, max_pages=max_pages):
+            ingestor.add(result)
+            count += 1
+            yield json.dumps(result) + '\n'
+        ingestor.flush()
+        yield json.dumps(dict(ingestor.stats(), success=True, count=count)) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/api/catalog/<entity>/import', methods=['POST'])
+def api_catalog_import(entity):
+    if entity not in CATALOG_FIELDS:
+        return jsonify({'success': False, 'error': f'Unknown catalog entity: {entity}'}), 404
+
+    upload = request.files.get('file')
+    fmt = request.args.get('format') or catalog_format(upload.filename if upload else None, request.mimetype)
+    if fmt not in CATALOG_FORMATS:
+        return jsonify({'success': False, 'error': 'format must be csv or jsonl'}), 400
+
+    try:
+        stream = upload.stream if upload else request.stream
+        if (upload.filename if upload else '').endswith('.gz'):
+            stream = gzip.GzipFile(fileobj=stream)
+        text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+        importer = CatalogImporter(entity, chunk_size=int(request.args.get('chunk_size', CATALOG_IMPORT_CHUNK_SIZE)))
+        result = importer.run(read_catalog_rows(text_stream, fmt))
+        return jsonify(dict(result, success=True))
+
+    except Exception as e:
+        # Chunks committed before a malformed file stopped the import are kept
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+
+@app.route('/api/catalog/<entity>/export')
+def api_catalog_export(entity):
+    if entity not in CATALOG_FIELDS:
+        return jsonify({'success': False, 'error': f'Unknown catalog entity: {entity}'}), 404
+
+    fmt = request.args.get('format', 'csv')
+    if fmt not in CATALOG_FORMATS:
+        return jsonify({'success': False, 'error': 'format must be csv or jsonl'}), 400
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(
+        stream_with_context(format_catalog_rows(entity, export_catalog_rows(entity), fmt)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={entity}.{fmt}'}
+    )
+
+
 @app.route('/price-comparison')
 def price_comparison():
     products = Product.query.all()
@@ -521,13 +4776,11 @@ def price_comparison():
 @app.route('/api/price-comparison/<int:product_id>')
 def api_price_comparison(product_id):
     try:
-        cost_data = calculate_product_cost(product_id)
+        cost_data = get_cached_product_cost(product_id)
 
         # Get recent market data for similar products
         product = Product.query.get_or_404(product_id)
-        market_prices = MarketPrice.query.filter(
-            MarketPrice.product_name.contains(product.name.split()[0])
-        ).order_by(MarketPrice.scraped_at.desc()).limit(10).all()
+        market_prices = find_competitor_prices(product, sort=request.args.get('sort', 'relevance'))
 
         market_data = []
         for mp in market_prices:
@@ -536,6 +4789,9 @@ def api_price_comparison(product_id):
                 'price': mp.price,
                 'competitor': mp.competitor,
                 'size_info': mp.size_info,
+                'size_quantity': mp.size_quantity,
+                'size_unit': mp.size_unit,
+                'normalized_price': mp.normalized_price,
                 'scraped_at': mp.scraped_at.strftime('%Y-%m-%d %H:%M')
             })
 
@@ -548,7 +4804,8 @@ def api_price_comparison(product_id):
                 'cost_per_unit': cost_data['cost_per_unit'],
                 'price_per_unit': cost_data['price_per_unit']
             },
-            'market_data': market_data
+            'market_data': market_data,
+            'unit_price_summary': competitor_unit_price_summary([mp.id for mp in market_prices])
         })
 
     except Exception as e:
@@ -556,9 +4813,190 @@ def api_price_comparison(product_id):
 
 
 # Initialize database
+def add_missing_columns() -> List[Tuple[str, str]]:
+    """Add nullable model columns missing from tables created by older versions"""
+    inspector = sa_inspect(db.engine)
+    added = []
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                added.append((table.name, column.name))
+    return added
+
+
+def create_model_indexes(connection, *names: str):
+    """Create the named model indexes that do not exist yet"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in names:
+                index.create(connection, checkfirst=True)
+
+
+def remove_duplicate_recipe_lines(connection):
+    """Keep the most recently updated line of each (product, material) pair"""
+    removed = connection.execute(text(
+        'DELETE FROM recipe WHERE id IN ('
+        ' SELECT id FROM ('
+        '  SELECT id, ROW_NUMBER() OVER ('
+        '   PARTITION BY product_id, material_id ORDER BY updated_at DESC, id DESC'
+        '  ) AS position FROM recipe'
+        ' ) WHERE position > 1'
+        ')'
+    )).rowcount
+    if removed:
+        app.logger.warning('Removed %d duplicate recipe line(s) before adding the unique index', removed)
+    create_model_indexes(connection, 'uq_recipe_product_material')
+
+
+def add_hot_path_indexes(connection):
+    create_model_indexes(connection, 'ix_recipe_material_id', 'ix_recipe_updated_at',
+                         'ix_raw_material_last_updated', 'ix_job_status_id',
+                         'ix_cost_analysis_product_calculated_at')
+
+
+# Append only: each migration runs once, in order, and must be safe to re-run
+# on a database created from the current models
+def backfill_product_updated_at(connection):
+    # add_missing_columns adds the column empty on older databases
+    connection.execute(text('UPDATE product SET updated_at = created_at WHERE updated_at IS NULL'))
+    create_model_indexes(connection, 'ix_product_updated_at')
+
+
+SCHEMA_MIGRATIONS = [
+    (1, 'unique recipe product/material', remove_duplicate_recipe_lines),
+    (2, 'indexes on hot foreign keys and timestamps', add_hot_path_indexes),
+    (3, 'product updated_at', backfill_product_updated_at),
+]
+
+
+def run_schema_migrations() -> List[int]:
+    """Apply pending SCHEMA_MIGRATIONS, each in its own transaction"""
+    table = SchemaMigration.__table__
+    with db.engine.connect() as connection:
+        applied = {version for version, in connection.execute(select(table.c.version))}
+
+    ran = []
+    for version, name, migrate in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        with db.engine.begin() as connection:
+            migrate(connection)
+            # Another process starting at the same time may have recorded it already
+            connection.execute(sqlite_insert(table).on_conflict_do_nothing(), {
+                'version': version, 'name': name, 'applied_at': datetime.utcnow()
+            })
+        ran.append(version)
+    return ran
+
+
 def create_tables():
     with app.app_context():
+        added_columns = add_missing_columns()
         db.create_all()
+        run_schema_migrations()
+
+        # create_all skips indexes of tables that already exist
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+
+        create_market_search_index()
+
+        if ('market_price', 'normalized_price') in added_columns:
+            backfill_market_sizes()
+
+        seed_material_price_history()
+
+
+@app.cli.command('compact-cost-analyses')
+@click.option('--hot-days', default=None, type=int, help='Days of full-resolution analyses to keep.')
+def compact_cost_analyses_command(hot_days):
+    """Archive old cost analyses into daily summaries and a compressed CSV"""
+    create_tables()
+    with app.app_context():
+        result = compact_cost_analyses(hot_days)
+    click.echo(f"Archived {result['archived']} analyses into {result['summaries']} daily summaries")
+    if result['archive']:
+        click.echo(f"Archive written to {result['archive']}")
+
+
+@app.cli.command('import-catalog')
+@click.argument('entity', type=click.Choice(list(CATALOG_FIELDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(CATALOG_FORMATS), default=None,
+              help='Input format (guessed from the file name by default).')
+@click.option('--chunk-size', default=CATALOG_IMPORT_CHUNK_SIZE, show_default=True,
+              help='Rows written per transaction.')
+def import_catalog_command(entity, path, fmt, chunk_size):
+    """Upsert materials, products or recipes from a CSV or JSON-lines file"""
+    fmt = fmt or catalog_format(path)
+    if fmt is None:
+        raise click.UsageError('Cannot guess the format from the file name, use --format')
+
+    create_tables()
+    with app.app_context(), open_catalog_file(path) as stream:
+        result = CatalogImporter(entity, chunk_size=chunk_size).run(read_catalog_rows(stream, fmt))
+
+    click.echo(f"Inserted {result['inserted']}, updated {result['updated']}, rejected {result['error_count']}")
+    for error in result['errors']:
+        click.echo(f"  line {error['line']}: {error['error']}", err=True)
+    if result['error_count'] > len(result['errors']):
+        click.echo(f"  ... and {result['error_count'] - len(result['errors'])} more", err=True)
+
+
+@app.cli.command('export-catalog')
+@click.argument('entity', type=click.Choice(list(CATALOG_FIELDS)))
+@click.argument('path', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(CATALOG_FORMATS), default=None,
+              help='Output format (guessed from the file name, csv for stdout).')
+def export_catalog_command(entity, path, fmt):
+    """Write materials, products or recipes to a CSV or JSON-lines file"""
+    fmt = fmt or catalog_format(path) or 'csv'
+
+    create_tables()
+    with app.app_context():
+        blocks = format_catalog_rows(entity, export_catalog_rows(entity), fmt)
+        if path == '-':
+            for block in blocks:
+                click.echo(block, nl=False)
+        else:
+            with open_catalog_file(path, 'w') as stream:
+                stream.writelines(blocks)
+
+
+@app.cli.command('run-worker')
+@click.option('--processes', default=2, show_default=True, help='Number of worker processes.')
+@click.option('--poll-interval', default=None, type=float, help='Seconds to sleep when the queue is empty.')
+def run_worker_command(processes, poll_interval):
+    """Run a local pool of background job workers"""
+    create_tables()
+    with app.app_context():
+        requeued = requeue_stale_jobs(app.config['JOB_STALE_AFTER'])
+    if requeued:
+        click.echo(f"Requeued {requeued} stale job(s)")
+
+    poll_interval = poll_interval or app.config['JOB_POLL_INTERVAL']
+    workers = [
+        multiprocessing.Process(target=job_worker_loop, args=(poll_interval,), daemon=True)
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    click.echo(f"Started {processes} job worker(s)")
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
 
 
 if __name__ == '__main__':
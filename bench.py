@@ -0,0 +1,716 @@
+# Benchmark suite for the pricing system
+# Times costing, stock checks, scraper parsing and the heavy pages against synthetic databases
+#
+#   python bench.py --scales small,medium --output baseline.json
+#   python bench.py --scales small,medium --baseline baseline.json
+#
+#   python bench.py --stress 1,2,4,8 --profiles default,production
+#   python bench.py --check query-counts,scraper,stress
+#
+# Each scale runs in its own process with DATABASE_URL pointing at a cached
+# synthetic SQLite database, so the real database is never touched and peak
+# memory of one scale does not leak into the next. The stress mode runs
+# several worker processes with mixed reads and writes against one database
+# file per DATABASE_PROFILE and reports throughput, lock errors and lost
+# writes. Checks are pass/fail regression guards, each run against its own
+# scratch database; the scraper check serves bench_fixtures from a local
+# HTTP server and the stress check fails on any lock error or lost write.
+# The script exits non-zero when one fails.
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BENCH_DIR, 'bench_fixtures')
+
+SCALES = {
+    'small': {'products': 100, 'materials': 50, 'market_rows': 10_000},
+    'medium': {'products': 10_000, 'materials': 500, 'market_rows': 100_000},
+    'large': {'products': 100_000, 'materials': 2_000, 'market_rows': 1_000_000},
+}
+PARSER_GROUP = 'parser'
+
+COMPETITORS = ['Jumia', 'Kilimall', 'Naivas', 'Carrefour', 'Quickmart']
+MARKET_SIZES = ['200g', '500g', '1kg', '2kg', '5kg', '400ml', '750ml', '1L', '2L', '5L', '6 pcs']
+INSERT_CHUNK_SIZE = 10_000
+
+
+def build_database(scale: str, seed: int):
+    """Fill the database named by DATABASE_URL with a synthetic catalog and market listings"""
+    from app import app, db, MarketPrice, create_tables, normalized_size_fields
+    import inject
+
+    config = SCALES[scale]
+    materials, products = inject.generate_synthetic_catalog(config['products'], config['materials'], seed)
+    inject.load_catalog(products, materials)
+
+    rng = random.Random(seed)
+    names = [product['name'] for product in inject.KENYAN_DETERGENT_PRODUCTS]
+    now = datetime.utcnow()
+    with app.app_context():
+        with db.engine.begin() as connection:
+            for start in range(0, config['market_rows'], INSERT_CHUNK_SIZE):
+                rows = []
+                for i in range(start, min(config['market_rows'], start + INSERT_CHUNK_SIZE)):
+                    size = rng.choice(MARKET_SIZES)
+                    name = f'{rng.choice(names)} {size}'
+                    price = round(rng.uniform(50, 3000), 0)
+                    rows.append(dict(
+                        product_name=name,
+                        competitor=rng.choice(COMPETITORS),
+                        price=price,
+                        url=f'https://example.co.ke/listing/{i}.html',
+                        scraped_at=now - timedelta(minutes=i),
+                        size_info=size,
+                        **normalized_size_fields(name, price)
+                    ))
+                connection.execute(MarketPrice.__table__.insert(), rows)
+        # Start the price history of the generated materials
+        create_tables()
+
+
+def measure(func: Callable, iterations: int, query_counter: Dict, warmup: int = 2) -> Dict:
+    """Latency percentiles, throughput, SQL statements per call and traced peak memory"""
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    queries_before = query_counter['count']
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    queries = query_counter['count'] - queries_before
+
+    # Memory is traced in a separate call, tracemalloc would skew the timings
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ms = np.array(timings) * 1000
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+    return {
+        'iterations': iterations,
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(p50),
+        'p90_ms': float(p90),
+        'p99_ms': float(p99),
+        'max_ms': float(ms.max()),
+        'throughput_per_s': float(iterations / sum(timings)),
+        'queries_per_op': queries / iterations,
+        'peak_memory_kb': peak / 1024
+    }
+
+
+def run_parser_benchmarks(iterations: int) -> Dict:
+    """Every available parser backend over every saved Jumia page"""
+    from app import MarketScraper, lxml_html
+
+    backends = ['soup', 'stream'] + (['lxml'] if lxml_html is not None else [])
+    results = {}
+    for fixture in sorted(os.listdir(FIXTURE_DIR)):
+        if not fixture.endswith('.html'):
+            continue
+        with open(os.path.join(FIXTURE_DIR, fixture), 'rb') as f:
+            content = f.read()
+
+        for backend in backends:
+            scraper = MarketScraper(parser=backend)
+            cards = len(scraper._parse_jumia_page(content))
+            stats = measure(lambda: scraper._parse_jumia_page(content), iterations, {'count': 0})
+            stats['cards'] = cards
+            stats['cards_per_s'] = cards * stats['throughput_per_s']
+            results[f'parse[{backend}]:{fixture}'] = stats
+    return results
+
+
+def run_scale_benchmarks(iterations: int, seed: int) -> Dict:
+    from sqlalchemy import event
+    from app import app, db, Product, MarketPrice, calculate_product_cost, check_stock_availability, create_tables
+
+    # Cached databases may predate the current schema
+    create_tables()
+    rng = random.Random(seed)
+    query_counter = {'count': 0}
+    with app.app_context():
+        def count_query(*args):
+            query_counter['count'] += 1
+
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+        product_ids = [product_id for product_id, in db.session.query(Product.id)]
+        competitor = db.session.query(MarketPrice.competitor).first()[0]
+
+    def direct(func):
+        def call():
+            # A fresh context per call, so nothing is memoized on g between iterations
+            with app.app_context():
+                func(rng.choice(product_ids))
+        return call
+
+    client = app.test_client()
+
+    def page(url_for_call):
+        def call():
+            response = client.get(url_for_call())
+            if response.status_code != 200:
+                raise RuntimeError(f'{response.status_code} from {response.request.path}')
+        return call
+
+    cases = {
+        'calculate_product_cost': direct(calculate_product_cost),
+        'check_stock_availability': direct(lambda product_id: check_stock_availability(product_id, 100.0)),
+        'GET /market-intelligence': page(lambda: '/market-intelligence'),
+        'GET /market-intelligence?competitor': page(lambda: f'/market-intelligence?competitor={competitor}'),
+        'GET /products/<id>/recipe': page(lambda: f'/products/{rng.choice(product_ids)}/recipe'),
+    }
+    return {name: measure(func, iterations, query_counter) for name, func in cases.items()}
+
+
+QUERY_COUNT_RECIPE_LENGTHS = (2, 20)
+
+
+def check_query_counts() -> List[str]:
+    """SQL statements per request must not depend on how many recipe lines a product has"""
+    from sqlalchemy import event
+    from app import app, db, RawMaterial, Product, ProductComponent, MarketPrice, create_tables, cost_cache, \
+        upsert_recipe_item
+
+    create_tables()
+    with app.app_context():
+        materials = [RawMaterial(name=f'Material {i}', unit='kg', current_price=10.0 + i,
+                                 stock_quantity=1000, minimum_stock=10)
+                     for i in range(max(QUERY_COUNT_RECIPE_LENGTHS))]
+        products = [Product(name=f'Query Count Powder {length}', category='Laundry Powder', batch_size=100)
+                    for length in QUERY_COUNT_RECIPE_LENGTHS]
+        # Every product is also made from an intermediate, so stock checks explode a sub-graph
+        base = Product(name='Query Count Base', category='Intermediate', batch_size=50)
+        db.session.add_all(materials + products + [base])
+        db.session.flush()
+        for material in materials[:2]:
+            upsert_recipe_item(base.id, material.id, 2.0)
+        for product, length in zip(products, QUERY_COUNT_RECIPE_LENGTHS):
+            for material in materials[:length]:
+                upsert_recipe_item(product.id, material.id, 1.5)
+            db.session.add(ProductComponent(product_id=product.id, component_product_id=base.id,
+                                            quantity_per_batch=5))
+            db.session.add(MarketPrice(product_name=f'{product.name} 1kg', competitor='Jumia', price=250.0,
+                                       url=f'https://example.co.ke/{product.id}.html', size_info='1kg'))
+        db.session.commit()
+        product_ids = [product.id for product in products]
+        base_material_id = materials[0].id
+
+        statements = {'count': 0}
+
+        def count_statement(*args):
+            statements['count'] += 1
+
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+
+    client = app.test_client()
+
+    def calculate_cost(product_id):
+        return client.post('/api/calculate-cost', json={'product_id': product_id, 'batch_size': 250})
+
+    cases = {
+        'POST /api/calculate-cost': calculate_cost,
+        'POST /api/calculate-cost, new price': calculate_cost,
+        'GET /api/price-comparison/<id>': lambda product_id: client.get(f'/api/price-comparison/{product_id}'),
+        'GET /products/<id>/recipe': lambda product_id: client.get(f'/products/{product_id}/recipe'),
+    }
+
+    # Uncounted requests made before a case's request
+    prepare = {
+        # A price change in the intermediate's recipe, so the stock check sees new prices
+        'POST /api/calculate-cost, new price': lambda product_id: client.post('/api/material-prices', json={
+            'updates': [{'material_id': base_material_id, 'price': 20.0 + product_id}]}),
+    }
+
+    failures = []
+    for name, call in cases.items():
+        counts = []
+        for product_id in product_ids:
+            # Every product starts from the same cold caches
+            cost_cache.clear()
+            if name in prepare and not prepare[name](product_id).json['success']:
+                failures.append(f'{name}: preparing the request failed')
+            before = statements['count']
+            response = call(product_id)
+            if response.status_code != 200:
+                failures.append(f'{name}: HTTP {response.status_code}')
+            counts.append(statements['count'] - before)
+        print(f"{name:36} statements at {' / '.join(map(str, QUERY_COUNT_RECIPE_LENGTHS))} recipe lines: "
+              f"{' / '.join(map(str, counts))}", file=sys.stderr)
+        if len(set(counts)) > 1:
+            failures.append(f'{name}: {counts} statements for {QUERY_COUNT_RECIPE_LENGTHS} recipe lines')
+    return failures
+
+
+SCRAPER_FIXTURE_PAGES = 2
+
+
+def serve_fixtures(flaky_urls: set):
+    """A local catalog site serving the saved Jumia pages.
+
+    ``/catalog/?q=laundry+powder`` is bench_fixtures/jumia_laundry_powder.html;
+    the same page is served as page 2, and pages beyond SCRAPER_FIXTURE_PAGES
+    have no products. Paths in ``flaky_urls`` answer 503 once, so retries
+    are exercised too.
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    class FixtureHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            term = query.get('q', [''])[0]
+            page = int(query.get('page', ['1'])[0])
+            fixture = os.path.join(FIXTURE_DIR, f"jumia_{term.replace(' ', '_')}.html")
+
+            if self.path in flaky_urls:
+                flaky_urls.discard(self.path)
+                self.send_error(503)
+                return
+            if url.path != '/catalog/' or not os.path.exists(fixture):
+                self.send_error(404)
+                return
+            if page > SCRAPER_FIXTURE_PAGES:
+                content = b'<html><body><p>No results found</p></body></html>'
+            else:
+                with open(fixture, 'rb') as f:
+                    content = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check_scraper() -> List[str]:
+    """Every parser backend scrapes the saved pages from a local server like the reference parse"""
+    from app import MarketScraper, lxml_html
+
+    terms = sorted(fixture[len('jumia_'):-len('.html')].replace('_', ' ')
+                   for fixture in os.listdir(FIXTURE_DIR)
+                   if fixture.startswith('jumia_') and fixture.endswith('.html'))
+    retried_urls = {f"/catalog/?q={term.replace(' ', '+')}&page=2" for term in terms}
+    flaky_urls = set()
+    server = serve_fixtures(flaky_urls)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    failures = []
+    try:
+        reference = MarketScraper(base_url=base_url, parser='soup')
+        expected = {}
+        for term in terms:
+            with open(os.path.join(FIXTURE_DIR, f"jumia_{term.replace(' ', '_')}.html"), 'rb') as f:
+                expected[term] = reference._parse_jumia_page(f.read())
+            if not expected[term]:
+                failures.append(f"reference parse of '{term}' found no products")
+
+        for backend in ['soup', 'stream'] + (['lxml'] if lxml_html is not None else []):
+            flaky_urls.update(retried_urls)
+            scraper = MarketScraper(base_url=base_url, requests_per_second=None, max_retries=2,
+                                    backoff_factor=0.01, timeout=5, parser=backend, cache=None)
+            for term in terms:
+                listings = scraper.scrape_jumia_prices(term)
+                if listings != expected[term][:10]:
+                    failures.append(f"[{backend}] scrape_jumia_prices('{term}') returned {len(listings)} "
+                                    f"listings that differ from the reference parse")
+
+            bulk = {}
+            for product in scraper.scrape_jumia_bulk(terms, max_pages=SCRAPER_FIXTURE_PAGES + 1):
+                bulk.setdefault((product.pop('search_term'), product.pop('page')), []).append(product)
+            expected_bulk = {(term, page): expected[term]
+                             for term in terms for page in range(1, SCRAPER_FIXTURE_PAGES + 1)}
+            if sorted(bulk) != sorted(expected_bulk):
+                failures.append(f'[{backend}] bulk scrape returned pages {sorted(bulk)}, '
+                                f'expected {sorted(expected_bulk)}')
+            for key, products in expected_bulk.items():
+                if bulk.get(key, products) != products:
+                    failures.append(f'[{backend}] bulk listings of {key} differ from the reference parse')
+            if flaky_urls:
+                failures.append(f'[{backend}] pages answering 503 were never requested: {sorted(flaky_urls)}')
+            print(f'{backend:8} {sum(map(len, bulk.values()))} listings from {len(bulk)} pages', file=sys.stderr)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return failures
+
+
+STRESS_CHECK = {'profile': 'production', 'workers': 4, 'seconds': 5.0, 'products': 50, 'materials': 20}
+
+
+def check_stress() -> List[str]:
+    """Concurrent workers on the production profile lose no writes and never see a locked database"""
+    from app import app, create_tables
+    import inject
+
+    create_tables()
+    materials, products = inject.generate_synthetic_catalog(STRESS_CHECK['products'], STRESS_CHECK['materials'], 42)
+    inject.load_catalog(products, materials)
+    database = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+
+    result = run_stress(database, STRESS_CHECK['profile'], STRESS_CHECK['workers'], STRESS_CHECK['seconds'], 42)
+    print(f"{result['workers']} workers  {result['writes_per_s']:.1f} writes/s  lock errors {result['lock_errors']}  "
+          f"other errors {result['errors']}  lost writes {result['lost_writes']}", file=sys.stderr)
+
+    failures = []
+    if not result['writes']:
+        failures.append('no writes completed')
+    for key in ('crashed_workers', 'lost_writes', 'lock_errors', 'errors'):
+        if result[key]:
+            failures.append(f"{key.replace('_', ' ')}: {result[key]}")
+    return failures
+
+
+CHECKS = {
+    'query-counts': check_query_counts,
+    'scraper': check_scraper,
+    'stress': check_stress,
+}
+
+
+def run_check_worker(name: str, result_file: str):
+    with open(result_file, 'w') as f:
+        json.dump(CHECKS[name](), f)
+
+
+def run_checks(names: List[str]) -> Dict[str, List[str]]:
+    """Run each check in its own process against a scratch database"""
+    failures = {}
+    for name in names:
+        work_dir = tempfile.mkdtemp(prefix='pricing-check-')
+        result_file = os.path.join(work_dir, 'result.json')
+        try:
+            run_in_subprocess(['--check-worker', name, '--result-file', result_file],
+                              f"sqlite:///{os.path.join(work_dir, 'check.db')}")
+            with open(result_file) as f:
+                failures[name] = json.load(f)
+        except subprocess.CalledProcessError as e:
+            failures[name] = [f'check crashed with exit status {e.returncode}']
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print(f"check {name}: {'FAIL' if failures[name] else 'ok'}", file=sys.stderr)
+        for failure in failures[name]:
+            print(f'  {failure}', file=sys.stderr)
+    return failures
+
+
+def run_worker(group: str, iterations: int, seed: int, result_file: str):
+    if group == PARSER_GROUP:
+        results = run_parser_benchmarks(iterations)
+    else:
+        results = run_scale_benchmarks(iterations, seed)
+    with open(result_file, 'w') as f:
+        json.dump(results, f)
+
+
+def run_in_subprocess(args: List[str], database_url: str):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    subprocess.run([sys.executable, os.path.abspath(__file__)] + args, env=env, cwd=BENCH_DIR, check=True)
+
+
+def ensure_database(scale: str, db_dir: str, seed: int, rebuild: bool) -> str:
+    """Path of the cached database for a scale, building it first if needed"""
+    path = os.path.join(db_dir, f'bench_{scale}_seed{seed}.db')
+    if os.path.exists(path) and not rebuild:
+        return path
+
+    partial = path + '.partial'
+    for stale in (path, partial):
+        if os.path.exists(stale):
+            os.remove(stale)
+
+    print(f'Building {scale} database ({SCALES[scale]})...', file=sys.stderr)
+    started = time.perf_counter()
+    run_in_subprocess(['--build', scale, '--seed', str(seed)], f'sqlite:///{partial}')
+    os.replace(partial, path)
+    print(f'Built {path} in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+    return path
+
+
+def run_group(group: str, database_url: str, iterations: int, seed: int) -> Dict:
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+        result_file = f.name
+    try:
+        run_in_subprocess(['--worker', group, '--iterations', str(iterations), '--seed', str(seed),
+                           '--result-file', result_file], database_url)
+        with open(result_file) as f:
+            return json.load(f)
+    finally:
+        os.remove(result_file)
+
+
+def run_stress_worker(seconds: float, seed: int, start_at: float, result_file: str):
+    """Mixed reads and high-frequency writes until the deadline, counting lock errors"""
+    from app import app, db, Product, ingest_market_prices
+
+    rng = random.Random(seed)
+    client = app.test_client()
+    with app.app_context():
+        product_ids = [product_id for product_id, in db.session.query(Product.id)]
+    batch_sizes = itertools.count(seed * 10 ** 6 + 1)
+
+    counts = {'reads': 0, 'writes': 0, 'lock_errors': 0, 'errors': 0, 'cost_analysis': 0, 'market_price': 0}
+    latencies = []
+
+    def record_error(message: str):
+        counts['lock_errors' if 'locked' in message or 'busy' in message else 'errors'] += 1
+
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        choice = rng.random()
+        started = time.perf_counter()
+        try:
+            if choice < 0.5:
+                response = client.get('/api/market-prices?limit=20')
+                kind = 'reads'
+            elif choice < 0.85:
+                # A new batch size always stores a fresh CostAnalysis
+                response = client.post('/api/calculate-cost', json={
+                    'product_id': rng.choice(product_ids), 'batch_size': next(batch_sizes)
+                })
+                kind = 'writes'
+                stored = ('cost_analysis', 1)
+            else:
+                with app.app_context():
+                    ingestion = ingest_market_prices([{
+                        'name': f'Stress Listing {rng.randint(1, 10 ** 6)} 1kg',
+                        'price': float(rng.randint(50, 3000)),
+                        'url': f'https://example.co.ke/stress/{rng.randint(1, 10 ** 6)}.html',
+                        'competitor': 'Jumia',
+                        'size_info': '1kg'
+                    } for _ in range(10)])
+                response = None
+                kind = 'writes'
+                stored = ('market_price', ingestion['inserted'])
+
+            if response is not None and (response.status_code != 200 or not response.json.get('success')):
+                record_error(str(response.json.get('error') if response.is_json else response.status_code))
+                continue
+        except Exception as e:
+            record_error(str(e))
+            continue
+        counts[kind] += 1
+        if kind == 'writes':
+            counts[stored[0]] += stored[1]
+        latencies.append(time.perf_counter() - started)
+
+    with open(result_file, 'w') as f:
+        json.dump(dict(counts, latencies=latencies), f)
+
+
+STRESS_TABLES = ('cost_analysis', 'market_price')
+
+
+def table_counts(database: str) -> Dict[str, int]:
+    with sqlite3.connect(database) as connection:
+        return {table: connection.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in STRESS_TABLES}
+
+
+def run_stress(base_db: str, profile: str, workers: int, seconds: float, seed: int) -> Dict:
+    """Run concurrent worker processes against a fresh copy of a database.
+
+    Rows the workers report as written are compared with the row counts of
+    the tables afterwards; any difference is reported as lost writes.
+    """
+    work_dir = tempfile.mkdtemp(prefix='pricing-stress-')
+    database = os.path.join(work_dir, 'stress.db')
+    shutil.copyfile(base_db, database)
+    rows_before = table_counts(database)
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{database}', DATABASE_PROFILE=profile, METRICS_ENABLED='0')
+
+    start_at = time.time() + 3.0  # time for every worker to import the app
+    result_files = [os.path.join(work_dir, f'worker{i}.json') for i in range(workers)]
+    processes = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '--stress-worker',
+                          '--stress-seconds', str(seconds), '--seed', str(seed + i),
+                          '--start-at', str(start_at), '--result-file', result_file],
+                         env=env, cwd=BENCH_DIR)
+        for i, result_file in enumerate(result_files)
+    ]
+    crashed = sum(process.wait() != 0 for process in processes)
+
+    totals = {'reads': 0, 'writes': 0, 'lock_errors': 0, 'errors': 0, 'cost_analysis': 0, 'market_price': 0}
+    latencies = []
+    for result_file in result_files:
+        if not os.path.exists(result_file):
+            continue
+        with open(result_file) as f:
+            result = json.load(f)
+        latencies.extend(result.pop('latencies'))
+        for key in totals:
+            totals[key] += result[key]
+    rows_after = table_counts(database)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    lost_writes = sum(totals.pop(table) - (rows_after[table] - rows_before[table]) for table in STRESS_TABLES)
+    ms = np.array(latencies or [0.0]) * 1000
+    p50, p99 = np.percentile(ms, [50, 99])
+    return dict(totals, workers=workers, seconds=seconds, crashed_workers=crashed, lost_writes=lost_writes,
+                ops_per_s=(totals['reads'] + totals['writes']) / seconds,
+                writes_per_s=totals['writes'] / seconds,
+                p50_ms=float(p50), p99_ms=float(p99))
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[Dict]:
+    """Cases whose median latency grew by more than threshold or that issue more SQL"""
+    regressions = []
+    for group, cases in current['results'].items():
+        for case, stats in cases.items():
+            base = baseline.get('results', {}).get(group, {}).get(case)
+            if base is None:
+                continue
+            ratio = stats['p50_ms'] / base['p50_ms'] if base['p50_ms'] else 1.0
+            slower = ratio > 1 + threshold
+            more_queries = stats['queries_per_op'] > base['queries_per_op']
+            flag = 'REGRESSION' if slower or more_queries else ''
+            print(f"{group:8} {case:40} p50 {base['p50_ms']:9.3f} -> {stats['p50_ms']:9.3f} ms "
+                  f"({ratio - 1:+7.1%})  queries {base['queries_per_op']:g} -> {stats['queries_per_op']:g}  {flag}")
+            if flag:
+                regressions.append({'group': group, 'case': case, 'p50_ratio': ratio,
+                                    'queries': [base['queries_per_op'], stats['queries_per_op']]})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark costing, stock checks, parsing and heavy pages')
+    parser.add_argument('--scales', default='small',
+                        help=f"comma separated scales: {', '.join(SCALES)} (default: small)")
+    parser.add_argument('--iterations', type=int, default=50, help='timed calls per case (default: 50)')
+    parser.add_argument('--seed', type=int, default=42, help='seed for data generation and inputs')
+    parser.add_argument('--db-dir', default=os.path.join(tempfile.gettempdir(), 'pricing-bench'),
+                        help='where synthetic databases are cached')
+    parser.add_argument('--rebuild', action='store_true', help='regenerate cached databases')
+    parser.add_argument('--skip-parser', action='store_true', help='do not run the HTML parser benchmarks')
+    parser.add_argument('--output', help='write results JSON here (default: stdout)')
+    parser.add_argument('--baseline', help='compare against a previous results JSON')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed p50 slowdown before a case counts as a regression (default: 0.2)')
+    parser.add_argument('--stress', help='comma separated worker process counts for the concurrency stress run')
+    parser.add_argument('--profiles', default='default,production',
+                        help='DATABASE_PROFILE values to stress (default: default,production)')
+    parser.add_argument('--stress-seconds', type=float, default=10.0, help='duration of each stress run')
+    parser.add_argument('--check', help=f"run pass/fail checks instead of timings: {', '.join(CHECKS)} or all")
+    parser.add_argument('--build', help=argparse.SUPPRESS)
+    parser.add_argument('--check-worker', help=argparse.SUPPRESS)
+    parser.add_argument('--stress-worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--start-at', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.build:
+        build_database(args.build, args.seed)
+        return
+    if args.worker:
+        run_worker(args.worker, args.iterations, args.seed, args.result_file)
+        return
+    if args.stress_worker:
+        run_stress_worker(args.stress_seconds, args.seed, args.start_at, args.result_file)
+        return
+    if args.check_worker:
+        run_check_worker(args.check_worker, args.result_file)
+        return
+    if args.check:
+        names = list(CHECKS) if args.check == 'all' else [name.strip() for name in args.check.split(',')]
+        unknown = [name for name in names if name not in CHECKS]
+        if unknown:
+            parser.error(f"unknown check(s): {', '.join(unknown)}")
+        if any(run_checks(names).values()):
+            sys.exit(1)
+        return
+
+    scales = [scale.strip() for scale in args.scales.split(',') if scale.strip()]
+    unknown = [scale for scale in scales if scale not in SCALES]
+    if unknown:
+        parser.error(f"unknown scale(s): {', '.join(unknown)}")
+    os.makedirs(args.db_dir, exist_ok=True)
+
+    results = {}
+    if not args.skip_parser:
+        results[PARSER_GROUP] = run_group(PARSER_GROUP, 'sqlite://', args.iterations, args.seed)
+    for scale in scales:
+        path = ensure_database(scale, args.db_dir, args.seed, args.rebuild)
+        results[scale] = run_group(scale, f'sqlite:///{path}', args.iterations, args.seed)
+
+    stress = {}
+    if args.stress:
+        base_db = ensure_database('small', args.db_dir, args.seed, False)
+        for profile in [profile.strip() for profile in args.profiles.split(',') if profile.strip()]:
+            stress[profile] = []
+            for workers in [int(count) for count in args.stress.split(',')]:
+                result = run_stress(base_db, profile, workers, args.stress_seconds, args.seed)
+                stress[profile].append(result)
+                print(f"{profile:10} {workers:3} workers  {result['ops_per_s']:8.1f} ops/s  "
+                      f"{result['writes_per_s']:8.1f} writes/s  p99 {result['p99_ms']:8.1f} ms  "
+                      f"lock errors {result['lock_errors']}  other errors {result['errors']}  "
+                      f"lost writes {result['lost_writes']}", file=sys.stderr)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'iterations': args.iterations,
+            'seed': args.seed,
+            'scales': {scale: SCALES[scale] for scale in scales}
+        },
+        'results': results
+    }
+    if stress:
+        report['stress'] = stress
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s) against {args.baseline}', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
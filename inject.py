@@ -1,16 +1,18 @@
 # Kenyan Detergent Market Data Injection Script
 # This script populates the database with realistic Kenyan detergent products and recipes
 
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+import argparse
+import random
 from datetime import datetime
-import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
 
-# Initialize Flask app context for database operations
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///pricing_system.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+from sqlalchemy import func, select
+
+from app import app, db, RawMaterial, Product, Recipe, create_tables, percentage_recipe_quantity
+
+PRODUCT_FIELDS = ('name', 'category', 'batch_size', 'labor_cost_per_batch', 'overhead_percentage',
+                  'packaging_cost', 'profit_margin_percentage')
+LOAD_CHUNK_SIZE = 1000
 
 # Sample data for Kenyan detergent market
 KENYAN_DETERGENT_PRODUCTS = [
@@ -232,142 +234,207 @@ KENYAN_DETERGENT_PRODUCTS = [
 ]
 
 
+def load_material_index(connection) -> Dict[str, Tuple[int, str]]:
+    """Material name -> (id, unit), read once (the lowest id wins for duplicate names)"""
+    index = {}
+    table = RawMaterial.__table__
+    for material_id, name, unit in connection.execute(
+        select(table.c.id, table.c.name, table.c.unit).order_by(table.c.id)
+    ):
+        index.setdefault(name, (material_id, unit))
+    return index
+
+
+def recipe_rows(product_data: Dict, product_id: int, materials: Dict[str, Tuple[int, str]],
+                now: datetime) -> Tuple[List[Dict], List[str]]:
+    """Recipe insert rows for one product and the names of materials not in the index"""
+    rows, missing = [], []
+    for recipe_item in product_data['recipe']:
+        material = materials.get(recipe_item['material'])
+        if material is None:
+            missing.append(recipe_item['material'])
+            continue
+
+        material_id, unit = material
+        if 'percentage' in recipe_item:
+            percentage_value = recipe_item['percentage']
+            quantity = percentage_recipe_quantity(percentage_value, product_data['batch_size'], unit,
+                                                  product_data['category'])
+        else:
+            percentage_value = None
+            quantity = recipe_item['quantity']
+
+        rows.append({
+            'product_id': product_id,
+            'material_id': material_id,
+            'quantity_per_batch': quantity,
+            'is_percentage_based': percentage_value is not None,
+            'percentage_value': percentage_value,
+            'notes': recipe_item.get('notes', ''),
+            'created_at': now,
+            'updated_at': now
+        })
+    return rows, missing
+
+
+def load_catalog(products: Iterable[Dict], materials: Optional[List[Dict]] = None,
+                 chunk_size: int = LOAD_CHUNK_SIZE) -> Dict:
+    """Insert materials, products and their recipes in one transaction.
+
+    ``products`` use the KENYAN_DETERGENT_PRODUCTS layout; ``materials`` are
+    RawMaterial column dicts to create first. The material name map is read
+    once, recipe quantities are computed up front and every table is written
+    with executemany per chunk of products. Recipe lines naming unknown
+    materials are skipped and reported.
+    """
+    product_table = Product.__table__
+    now = datetime.utcnow()
+    stats = {'materials': 0, 'products': 0, 'recipes': 0, 'missing_materials': set()}
+
+    def insert_products(connection, chunk, material_index):
+        # Rows added in this transaction are the only ones above the previous maximum id
+        last_id = connection.execute(select(func.coalesce(func.max(product_table.c.id), 0))).scalar()
+        connection.execute(product_table.insert(), [
+            dict({field: product_data[field] for field in PRODUCT_FIELDS}, created_at=now, updated_at=now)
+            for product_data in chunk
+        ])
+        new_ids = [product_id for product_id, in connection.execute(
+            select(product_table.c.id).where(product_table.c.id > last_id).order_by(product_table.c.id)
+        )]
+
+        rows = []
+        for product_data, product_id in zip(chunk, new_ids):
+            product_rows, missing = recipe_rows(product_data, product_id, material_index, now)
+            rows.extend(product_rows)
+            stats['missing_materials'].update(missing)
+        if rows:
+            connection.execute(Recipe.__table__.insert(), rows)
+        stats['products'] += len(chunk)
+        stats['recipes'] += len(rows)
+
+    with app.app_context():
+        create_tables()
+        with db.engine.begin() as connection:
+            if materials:
+                for start in range(0, len(materials), chunk_size):
+                    connection.execute(RawMaterial.__table__.insert(), [
+                        dict(material, last_updated=now) for material in materials[start:start + chunk_size]
+                    ])
+                stats['materials'] = len(materials)
+
+            material_index = load_material_index(connection)
+            chunk = []
+            for product_data in products:
+                chunk.append(product_data)
+                if len(chunk) >= chunk_size:
+                    insert_products(connection, chunk, material_index)
+                    chunk = []
+            if chunk:
+                insert_products(connection, chunk, material_index)
+
+    stats['missing_materials'] = sorted(stats['missing_materials'])
+    return stats
+
+
+def base_material_units() -> Dict[str, str]:
+    """Unit of every material used by the sample recipes (ml for dosed liquids, else kg)"""
+    units = {}
+    for product in KENYAN_DETERGENT_PRODUCTS:
+        for recipe_item in product['recipe']:
+            units.setdefault(recipe_item['material'], recipe_item.get('unit', 'kg'))
+    return units
+
+
+def generate_synthetic_catalog(n_products: int, n_materials: int,
+                               seed: Optional[int] = None) -> Tuple[List[Dict], Iterable[Dict]]:
+    """Materials and a lazily generated product stream modelled on the sample data.
+
+    Material k is a grade of sample material ``k % B`` (B distinct sample
+    materials, so at least B are created). Product i follows sample product
+    ``i % len(KENYAN_DETERGENT_PRODUCTS)`` with jittered costs and
+    percentages, and each recipe line uses a random grade of its material.
+    """
+    rng = random.Random(seed)
+    units = base_material_units()
+    base_names = sorted(units)
+    n_materials = max(n_materials, len(base_names))
+    run_id = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+
+    materials = []
+    grades = {name: [] for name in base_names}
+    for k in range(n_materials):
+        base = base_names[k % len(base_names)]
+        name = f'{base} [grade {k // len(base_names) + 1}]'
+        grades[base].append(name)
+        materials.append({
+            'name': name,
+            'unit': units[base],
+            'current_price': round(rng.uniform(20, 600), 2),
+            'stock_quantity': round(rng.uniform(0, 5000), 1),
+            'minimum_stock': round(rng.uniform(10, 200), 1),
+            'supplier': f'Supplier {rng.randint(1, 50)}'
+        })
+
+    def jitter(value, spread=0.15):
+        return round(value * rng.uniform(1 - spread, 1 + spread), 3)
+
+    def products():
+        for i in range(n_products):
+            template = KENYAN_DETERGENT_PRODUCTS[i % len(KENYAN_DETERGENT_PRODUCTS)]
+            recipe = []
+            for recipe_item in template['recipe']:
+                item = dict(recipe_item, material=rng.choice(grades[recipe_item['material']]))
+                if 'percentage' in item:
+                    item['percentage'] = jitter(item['percentage'])
+                else:
+                    item['quantity'] = jitter(item['quantity'])
+                recipe.append(item)
+            yield {
+                'name': f"{template['name']} #{run_id}-{i + 1}",
+                'category': template['category'],
+                'batch_size': template['batch_size'],
+                'labor_cost_per_batch': jitter(template['labor_cost_per_batch']),
+                'overhead_percentage': jitter(template['overhead_percentage']),
+                'packaging_cost': jitter(template['packaging_cost']),
+                'profit_margin_percentage': jitter(template['profit_margin_percentage']),
+                'recipe': recipe
+            }
+
+    return materials, products()
+
+
 def create_sample_data():
     """Create sample detergent products and recipes for Kenyan market"""
+    print("🧼 Creating Kenyan detergent market sample data...")
+    print("=" * 60)
+
+    stats = load_catalog(KENYAN_DETERGENT_PRODUCTS)
+    for material_name in stats['missing_materials']:
+        print(f"  ⚠️  Material '{material_name}' not found in database")
+    if stats['missing_materials']:
+        print("Run the materials setup script first, or add the missing materials manually.")
+
+    print("=" * 60)
+    print(f"🎉 Successfully created {stats['products']} products with {stats['recipes']} recipe items!")
+    print("\nProducts created:")
+    for product in KENYAN_DETERGENT_PRODUCTS:
+        print(f"  • {product['name']} ({product['category']})")
 
-    with app.app_context():
-        try:
-            print("🧼 Creating Kenyan detergent market sample data...")
-            print("=" * 60)
-
-            # Get material IDs mapping
-            materials = {}
-            conn = sqlite3.connect('pricing_system.db')
-            cursor = conn.cursor()
-
-            cursor.execute("SELECT id, name FROM raw_material")
-            for material_id, name in cursor.fetchall():
-                materials[name] = material_id
-
-            conn.close()
-
-            products_created = 0
-            recipes_created = 0
-
-            for product_data in KENYAN_DETERGENT_PRODUCTS:
-                try:
-                    # Create product
-                    cursor = sqlite3.connect('pricing_system.db').cursor()
-
-                    cursor.execute("""
-                        INSERT INTO product (name, category, batch_size, labor_cost_per_batch, 
-                                           overhead_percentage, packaging_cost, profit_margin_percentage, created_at)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        product_data['name'],
-                        product_data['category'],
-                        product_data['batch_size'],
-                        product_data['labor_cost_per_batch'],
-                        product_data['overhead_percentage'],
-                        product_data['packaging_cost'],
-                        product_data['profit_margin_percentage'],
-                        datetime.now()
-                    ))
-
-                    product_id = cursor.lastrowid
-                    cursor.connection.commit()
-                    products_created += 1
-
-                    print(f"✓ Created product: {product_data['name']}")
-
-                    # Create recipes
-                    for recipe_item in product_data['recipe']:
-                        material_name = recipe_item['material']
-
-                        if material_name not in materials:
-                            print(f"  ⚠️  Material '{material_name}' not found in database")
-                            continue
-
-                        material_id = materials[material_name]
-                        notes = recipe_item.get('notes', '')
-
-                        # Handle percentage vs absolute quantities
-                        if 'percentage' in recipe_item:
-                            # Percentage-based recipe
-                            percentage_value = recipe_item['percentage']
-                            is_percentage_based = True
-
-                            # Calculate absolute quantity based on batch size and material type
-                            cursor.execute("SELECT unit FROM raw_material WHERE id = ?", (material_id,))
-                            unit = cursor.fetchone()[0]
-
-                            batch_size = product_data['batch_size']
-
-                            if unit == 'kg':
-                                # Assume 20g per unit for powder products, 1kg per unit for liquid
-                                if 'Liquid' in product_data['category']:
-                                    estimated_batch_weight = batch_size * 1.0  # 1kg per liter
-                                else:
-                                    estimated_batch_weight = batch_size * 0.02  # 20g per unit
-                                actual_quantity = (percentage_value / 100) * estimated_batch_weight
-                            elif unit in ['ml', 'L']:
-                                # For liquids and fragrances
-                                if unit == 'L':
-                                    actual_quantity = (percentage_value / 100) * batch_size * 0.001
-                                else:
-                                    actual_quantity = (percentage_value / 100) * batch_size
-                            else:
-                                # For pieces
-                                actual_quantity = (percentage_value / 100) * batch_size
-
-                        else:
-                            # Absolute quantity
-                            actual_quantity = recipe_item['quantity']
-                            percentage_value = None
-                            is_percentage_based = False
-
-                        # Insert recipe
-                        cursor.execute("""
-                            INSERT INTO recipe (product_id, material_id, quantity_per_batch, 
-                                              is_percentage_based, percentage_value, notes, created_at, updated_at)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                        """, (
-                            product_id,
-                            material_id,
-                            actual_quantity,
-                            is_percentage_based,
-                            percentage_value,
-                            notes,
-                            datetime.now(),
-                            datetime.now()
-                        ))
-
-                        recipes_created += 1
-
-                        if is_percentage_based:
-                            print(f"  + {material_name}: {percentage_value}% ({actual_quantity:.3f} {unit}) - {notes}")
-                        else:
-                            print(f"  + {material_name}: {actual_quantity} - {notes}")
-
-                    cursor.connection.commit()
-                    cursor.connection.close()
-                    print()
-
-                except Exception as e:
-                    print(f"❌ Error creating product {product_data['name']}: {e}")
-                    continue
-
-            print("=" * 60)
-            print(f"🎉 Successfully created {products_created} products with {recipes_created} recipe items!")
-            print("\nProducts created:")
-            for product in KENYAN_DETERGENT_PRODUCTS:
-                print(f"  • {product['name']} ({product['category']})")
-
-            print(f"\n💡 These products represent common detergent formulations in the Kenyan market.")
-            print(f"📊 You can now use the cost analysis features to calculate pricing for these products.")
-
-        except Exception as e:
-            print(f"❌ Error during data creation: {e}")
+    print(f"\n💡 These products represent common detergent formulations in the Kenyan market.")
+    print(f"📊 You can now use the cost analysis features to calculate pricing for these products.")
+
+
+def create_synthetic_data(n_products: int, n_materials: int, seed: Optional[int] = None):
+    """Seed a load-test catalog of n_products over n_materials generated materials"""
+    print(f"🧪 Generating {n_products} products over {n_materials} materials...")
+    started = datetime.utcnow()
+
+    materials, products = generate_synthetic_catalog(n_products, n_materials, seed)
+    stats = load_catalog(products, materials)
+
+    elapsed = (datetime.utcnow() - started).total_seconds()
+    print(f"🎉 Created {stats['materials']} materials, {stats['products']} products and "
+          f"{stats['recipes']} recipe items in {elapsed:.1f}s")
 
 
 def verify_materials():
@@ -378,12 +445,10 @@ def verify_materials():
         for recipe_item in product['recipe']:
             required_materials.add(recipe_item['material'])
 
-    conn = sqlite3.connect('pricing_system.db')
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT name FROM raw_material")
-    existing_materials = {row[0] for row in cursor.fetchall()}
-    conn.close()
+    with app.app_context():
+        create_tables()
+        with db.engine.connect() as connection:
+            existing_materials = set(load_material_index(connection))
 
     missing_materials = required_materials - existing_materials
 
@@ -399,13 +464,22 @@ def verify_materials():
 
 
 if __name__ == '__main__':
-    print("🧼 Kenyan Detergent Market Data Injection")
-    print("=" * 50)
-
-    # Verify materials first
-    if verify_materials():
-        print("\n🚀 Starting data injection...")
-        create_sample_data()
+    parser = argparse.ArgumentParser(description='Seed the pricing database with detergent products')
+    parser.add_argument('--synthetic', nargs=2, type=int, metavar=('PRODUCTS', 'MATERIALS'),
+                        help='generate a synthetic catalog instead of the sample products')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for --synthetic')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        create_synthetic_data(*args.synthetic, seed=args.seed)
     else:
-        print("\n❌ Cannot proceed without required materials.")
-        print("Run the materials setup script first, or add the missing materials manually.")
\ No newline at end of file
+        print("🧼 Kenyan Detergent Market Data Injection")
+        print("=" * 50)
+
+        # Verify materials first
+        if verify_materials():
+            print("\n🚀 Starting data injection...")
+            create_sample_data()
+        else:
+            print("\n❌ Cannot proceed without required materials.")
+            print("Run the materials setup script first, or add the missing materials manually.")